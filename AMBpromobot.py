@@ -26,6 +26,8 @@ from telegram.ext import (
     ConversationHandler,
     JobQueue
 )
+from migrations import migrate
+from promo_codes import allocate_codes
 
 # Helper to notify a user of a new simple referral
 async def notify_simple_referral(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
@@ -66,6 +68,10 @@ async def credit_loyal_referral(context: ContextTypes.DEFAULT_TYPE) -> None:
                 "UPDATE users SET loyal_referrals = loyal_referrals + 1 WHERE user_id = ?",
                 (referrer_id,)
             )
+            cursor.execute(
+                "INSERT INTO loyalty_ledger (user_id, earned, reason, ref_id) VALUES (?, 1, 'referral', ?)",
+                (referrer_id, referral_id)
+            )
             conn.commit()
             await context.bot.send_message(
                 chat_id=referrer_id,
@@ -135,129 +141,8 @@ MEMES_DIR = os.path.join(BASE_DIR, "memes")
 SCREENSHOTS_DIR = os.path.join(BASE_DIR, "screenshots")
 
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT,
-    first_name TEXT,
-    last_name TEXT,
-    ref_by INTEGER
-)
-''')
-
-# ——— Миграция: проверяем и добавляем недостающие колонки в users ———
-cursor.execute("PRAGMA table_info(users)")
-cols = [row[1] for row in cursor.fetchall()]
-
-# promo_code
-if 'promo_code' not in cols:
-    cursor.execute("ALTER TABLE users ADD COLUMN promo_code TEXT")
-
-# referrals_count
-if 'referrals_count' not in cols:
-    cursor.execute("ALTER TABLE users ADD COLUMN referrals_count INTEGER DEFAULT 0")
-
-conn.commit()
-
-# Уникальный индекс на promo_code
-cursor.execute("""
-    CREATE UNIQUE INDEX IF NOT EXISTS idx_users_promo_code
-      ON users(promo_code)
-""")
-conn.commit()
-
-# ### 2.1. Берём всех, у кого promo_code IS NULL
-cursor.execute("SELECT user_id FROM users WHERE promo_code IS NULL")
-rows = cursor.fetchall()
-for (uid,) in rows:
-    # Генерируем 6 символов из A–Z и 0–9
-    code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    cursor.execute(
-        "UPDATE users SET promo_code = ? WHERE user_id = ?",
-        (code, uid)
-    )
-conn.commit()
-
-# Ensure joined_date and used_loyal columns exist
-for column, definition in [
-    ("joined_date", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
-    ("used_loyal", "INTEGER DEFAULT 0"),
-]:
-    try:
-        cursor.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
-    except sqlite3.OperationalError:
-        # Column already exists
-        pass
-conn.commit()
-
-# Add column to permanently track earned loyal referrals
-try:
-    cursor.execute("ALTER TABLE users ADD COLUMN loyal_referrals INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-conn.commit()
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS tasks (
-    task_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    task_description TEXT,
-    status TEXT DEFAULT 'pending',
-    task_type TEXT,
-    screenshot_path TEXT,
-    created_at TIMESTAMP,
-    FOREIGN KEY(user_id) REFERENCES users(user_id)
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS coupons (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    code TEXT,
-    type TEXT,
-    used INTEGER DEFAULT 0
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS meme_templates (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    file_path TEXT,
-    text TEXT
-)
-''')
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS text_templates (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    text TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS allowed_chats (
-    chat_username TEXT PRIMARY KEY
-)
-''')
-
-# --- PROMO OFFERS TABLE ---
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS promo_offers (
-    offer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    title TEXT NOT NULL,
-    cost INTEGER NOT NULL
-)
-''')
-conn.commit()
-
-try:
-    cursor.execute("ALTER TABLE users ADD COLUMN pending_tasks INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-try:
-    cursor.execute("ALTER TABLE users ADD COLUMN completed_tasks INTEGER DEFAULT 0")
-except sqlite3.OperationalError:
-    pass
-conn.commit()
+# Схема и миграции общие с database.py
+migrate(conn)
 
 inline_participate_markup = InlineKeyboardMarkup(
     [[InlineKeyboardButton("🚀 Участвовать", callback_data='participate')]]
@@ -364,8 +249,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cursor.execute("SELECT ref_by FROM users WHERE user_id = ?", (user.id,))
     existing = cursor.fetchone()
     if existing is None:
-        cursor.execute("INSERT INTO users (user_id, username, first_name, last_name, ref_by) VALUES (?, ?, ?, ?, ?)",
-                       (user.id, user.username, user.first_name, user.last_name, ref_by))
+        joined = datetime.now()
+        cursor.execute("INSERT INTO users (user_id, username, first_name, last_name, ref_by, joined_date, joined_ts) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (user.id, user.username, user.first_name, user.last_name, ref_by,
+                        joined.isoformat(), int(joined.timestamp())))
         conn.commit()
         # Schedule loyalty credit in 3 days if a referrer was set
         if ref_by is not None and ref_by != user.id:
@@ -399,7 +287,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Сразу после вставки/обновления пользователя
     cursor.execute("SELECT promo_code FROM users WHERE user_id = ?", (user.id,))
     if cursor.fetchone()[0] is None:
-        new_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+        new_code = allocate_codes(cursor)[0]
         cursor.execute(
             "UPDATE users SET promo_code = ? WHERE user_id = ?",
             (new_code, user.id)
@@ -837,30 +725,27 @@ async def promo_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TY
         return
     title, cost = row
     user_id = query.from_user.id
-    # Recount available
-    cursor.execute("SELECT loyal_referrals FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    total_loyal = row[0] if row else 0
-        
-    cursor.execute("SELECT used_loyal FROM users WHERE user_id = ?", (user_id,))
-    used_loyal = cursor.fetchone()[0] or 0
-    available = total_loyal - used_loyal
-    if available < cost:
-        await query.answer("Недостаточно преданных рефералов.", show_alert=True)
-        return
-    # Deduct the cost from the user's loyal referrals
+    # Conditional debit: succeeds only if the available balance covers the cost
     cursor.execute(
-        "UPDATE users SET used_loyal = used_loyal + ? WHERE user_id = ?",
-        (cost, user_id)
+        "UPDATE users SET used_loyal = used_loyal + ? WHERE user_id = ? AND loyal_referrals - used_loyal >= ?",
+        (cost, user_id, cost)
     )
-    conn.commit()
+    if cursor.rowcount == 0:
+        conn.rollback()
+        await query.answer("Недостаточно преданных рефералов.", show_alert=True)
+        return
     # Create promo task
     now = datetime.now()
     cursor.execute(
-        "INSERT INTO tasks (user_id, task_type, task_description, created_at) VALUES (?, 'promo', ?, ?)",
-        (user_id, f"offer:{oid}", now)
+        "INSERT INTO tasks (user_id, task_type, task_description, created_at, created_ts) VALUES (?, 'promo', ?, ?, ?)",
+        (user_id, f"offer:{oid}", now, int(now.timestamp()))
     )
     task_id = cursor.lastrowid
+    cursor.execute("UPDATE users SET total_tasks = total_tasks + 1 WHERE user_id = ?", (user_id,))
+    cursor.execute(
+        "INSERT INTO loyalty_ledger (user_id, spent, reason, ref_id) VALUES (?, ?, 'purchase', ?)",
+        (user_id, cost, task_id)
+    )
     conn.commit()
 
     # Notify all admins of new promo request
@@ -1046,7 +931,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
         # generic approval for other tasks
-        cursor.execute("UPDATE tasks SET status='approved' WHERE task_id = ?", (task_id,))
+        cursor.execute(
+            "UPDATE tasks SET status='approved', decided_at = ? WHERE task_id = ?", (datetime.now(), task_id)
+        )
         cursor.execute(
             "UPDATE users SET pending_tasks = pending_tasks - 1, completed_tasks = completed_tasks + 1 WHERE user_id = ?",
             (user_id,)
@@ -1076,7 +963,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         cursor.execute("SELECT user_id FROM tasks WHERE task_id = ?", (task_id,))
         user_id = cursor.fetchone()[0]
         # update task status
-        cursor.execute("UPDATE tasks SET status='declined' WHERE task_id = ?", (task_id,))
+        cursor.execute(
+            "UPDATE tasks SET status='declined', decided_at = ? WHERE task_id = ?", (datetime.now(), task_id)
+        )
         # update user counters
         cursor.execute(
             "UPDATE users SET pending_tasks = pending_tasks - 1 WHERE user_id = ?",
@@ -1340,15 +1229,15 @@ async def handle_task_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     # 2) Регистрируем задачу в БД
     now = datetime.now()
     cursor.execute(
-        "INSERT INTO tasks (user_id, task_type, task_description, created_at) "
-        "VALUES (?, 'meme', ?, ?)",
-        (query.from_user.id, panel, now)
+        "INSERT INTO tasks (user_id, task_type, task_description, created_at, created_ts) "
+        "VALUES (?, 'meme', ?, ?, ?)",
+        (query.from_user.id, panel, now, int(now.timestamp()))
     )
     conn.commit()
 
     # 3) Увеличиваем счётчик ожидающих заданий
     cursor.execute(
-        "UPDATE users SET pending_tasks = pending_tasks + 1 WHERE user_id = ?",
+        "UPDATE users SET pending_tasks = pending_tasks + 1, total_tasks = total_tasks + 1 WHERE user_id = ?",
         (query.from_user.id,)
     )
     conn.commit()
@@ -1411,15 +1300,15 @@ async def handle_task_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     # 2) Регистрируем задачу в БД
     now = datetime.now()
     cursor.execute(
-        "INSERT INTO tasks (user_id, task_type, task_description, created_at) "
-        "VALUES (?, ?, ?, ?)",
-        (query.from_user.id, 'text', txt, now)
+        "INSERT INTO tasks (user_id, task_type, task_description, created_at, created_ts) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (query.from_user.id, 'text', txt, now, int(now.timestamp()))
     )
     conn.commit()
 
     # 3) Увеличиваем счётчик ожидающих заданий у пользователя
     cursor.execute(
-        "UPDATE users SET pending_tasks = pending_tasks + 1 WHERE user_id = ?",
+        "UPDATE users SET pending_tasks = pending_tasks + 1, total_tasks = total_tasks + 1 WHERE user_id = ?",
         (query.from_user.id,)
     )
     conn.commit()
@@ -1515,12 +1404,12 @@ async def handle_task_other_meme(update: Update, context: ContextTypes.DEFAULT_T
     )
     now = datetime.now()
     cursor.execute(
-        "INSERT INTO tasks (user_id, task_type, task_description, created_at) "
-        "VALUES (?, 'meme', ?, ?)",
-        (query.from_user.id, panel, now)
+        "INSERT INTO tasks (user_id, task_type, task_description, created_at, created_ts) "
+        "VALUES (?, 'meme', ?, ?, ?)",
+        (query.from_user.id, panel, now, int(now.timestamp()))
     )
     cursor.execute(
-        "UPDATE users SET pending_tasks = pending_tasks + 1 WHERE user_id = ?",
+        "UPDATE users SET pending_tasks = pending_tasks + 1, total_tasks = total_tasks + 1 WHERE user_id = ?",
         (query.from_user.id,)
     )
     conn.commit()
@@ -1567,12 +1456,12 @@ async def handle_task_repost(update, context):
     txt = "Пожалуйста, сделайте репост нашего канала @ambsharing в одном из чатов ниже:"
     now = datetime.now()
     cursor.execute(
-        "INSERT INTO tasks (user_id, task_type, task_description, created_at) VALUES (?, ?, ?, ?)",
-        (query.from_user.id, 'repost', txt, now)
+        "INSERT INTO tasks (user_id, task_type, task_description, created_at, created_ts) VALUES (?, ?, ?, ?, ?)",
+        (query.from_user.id, 'repost', txt, now, int(now.timestamp()))
     )
     conn.commit()
     # bump pending task count for user
-    cursor.execute("UPDATE users SET pending_tasks = pending_tasks + 1 WHERE user_id = ?", (query.from_user.id,))
+    cursor.execute("UPDATE users SET pending_tasks = pending_tasks + 1, total_tasks = total_tasks + 1 WHERE user_id = ?", (query.from_user.id,))
     conn.commit()
     cursor.execute("SELECT chat_username FROM allowed_chats ORDER BY RANDOM()")
     chats = [row[0] for row in cursor.fetchall()]
@@ -1780,7 +1669,9 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         task_id = context.user_data['task_id']
         user_id = context.user_data['task_user_id']
         # update task status
-        cursor.execute("UPDATE tasks SET status='approved' WHERE task_id = ?", (task_id,))
+        cursor.execute(
+            "UPDATE tasks SET status='approved', decided_at = ? WHERE task_id = ?", (datetime.now(), task_id)
+        )
         # update user counters
         cursor.execute(
             "UPDATE users SET pending_tasks = pending_tasks - 1, completed_tasks = completed_tasks + 1 WHERE user_id = ?",
@@ -1820,7 +1711,9 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reason = update.message.text.strip()
         task_id = context.user_data['task_id']
         user_id = context.user_data['task_user_id']
-        cursor.execute("UPDATE tasks SET status='declined' WHERE task_id = ?", (task_id,))
+        cursor.execute(
+            "UPDATE tasks SET status='declined', decided_at = ? WHERE task_id = ?", (datetime.now(), task_id)
+        )
         # decrement pending tasks on decline
         cursor.execute(
             "UPDATE users SET pending_tasks = pending_tasks - 1 WHERE user_id = ?",
@@ -2034,15 +1927,15 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     # Пришло сегодня
     cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE joined_date >= ?",
-        (today_start.isoformat(),)
+        "SELECT COUNT(*) FROM users WHERE joined_ts >= ?",
+        (int(today_start.timestamp()),)
     )
     today_count = cursor.fetchone()[0]
 
     # Пришло за неделю
     cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE joined_date >= ?",
-        (week_start.isoformat(),)
+        "SELECT COUNT(*) FROM users WHERE joined_ts >= ?",
+        (int(week_start.timestamp()),)
     )
     week_count = cursor.fetchone()[0]
 
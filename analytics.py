@@ -0,0 +1,143 @@
+import asyncio
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from config import (
+    ANALYTICS_DB_PATH, ANALYTICS_MAX_AGE_MINUTES, BACKUP_PAGES, BACKUP_STEP_PAUSE_MS, logger
+)
+from database import Database, db, async_db
+
+# Режимы источника данных для админских команд
+MODE_SNAPSHOT = 'snapshot'
+MODE_FRESH = 'fresh'
+MODE_LIVE = 'live'
+
+class AnalyticsSnapshot:
+    """Read-only копия базы для тяжелых админских запросов.
+
+    Копия строится backup API рядом с рабочей базой и атомарно подменяется,
+    поэтому выгрузки и статистика не занимают соединения пользователей.
+    Запросы берутся из Database: у снимка тот же интерфейс _read().
+    """
+
+    def __init__(self, database=db, path=ANALYTICS_DB_PATH):
+        self.database = database
+        self.path = path
+        self.refreshed_at = None
+        self._conn = None
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """Пересборка снимка; возвращает длительность в секундах"""
+        with self._refresh_lock:
+            started = time.monotonic()
+            tmp_path = self.path + ".tmp"
+            target = sqlite3.connect(tmp_path)
+            try:
+                self.database.backup_to(target, pages=BACKUP_PAGES, pause=BACKUP_STEP_PAUSE_MS / 1000)
+                # Снимок больше не меняется: без WAL его можно открыть как immutable
+                target.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                target.close()
+            os.replace(tmp_path, self.path)
+
+            uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro&immutable=1"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            with self._lock:
+                old, self._conn = self._conn, conn
+                self.refreshed_at = datetime.now()
+            if old is not None:
+                old.close()
+
+            duration = time.monotonic() - started
+            logger.info(f"Analytics snapshot refreshed in {duration:.2f}s")
+            return duration
+
+    def age(self):
+        """Возраст снимка в секундах; None, если снимка еще нет"""
+        if self.refreshed_at is None:
+            return None
+        return (datetime.now() - self.refreshed_at).total_seconds()
+
+    def ensure_fresh(self, max_age=ANALYTICS_MAX_AGE_MINUTES * 60):
+        """Обновление снимка, если его нет или он старше max_age секунд"""
+        age = self.age()
+        if age is None or age > max_age:
+            self.refresh()
+
+    @contextmanager
+    def _read(self):
+        """Курсор снимка; подмена снимка ждет окончания чтения"""
+        with self._lock:
+            cur = self._conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def count_users(self):
+        """Общее количество пользователей"""
+        with self._read() as cur:
+            cur.execute("SELECT COUNT(*) FROM users")
+            return cur.fetchone()[0]
+
+    count_users_joined_since = Database.count_users_joined_since
+    get_recent_users = Database.get_recent_users
+    get_referrals_to_verify = Database.get_referrals_to_verify
+    export_users = Database.export_users
+
+    def close(self):
+        """Закрытие соединения со снимком"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class AsyncAnalytics:
+    """Асинхронный фасад снимка: запросы выполняются в отдельном потоке"""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    async def refresh(self):
+        return await asyncio.to_thread(self._snapshot.refresh)
+
+    def close(self):
+        self._snapshot.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self._snapshot, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return method
+
+def parse_mode(args):
+    """Режим из аргументов команды: live, fresh или снимок по умолчанию"""
+    mode = (args[0].lower() if args else MODE_SNAPSHOT)
+    return mode if mode in (MODE_LIVE, MODE_FRESH) else MODE_SNAPSHOT
+
+async def source_for(mode):
+    """Источник админских запросов и подпись к ответу.
+
+    live - рабочая база, fresh - снимок, пересобранный прямо сейчас,
+    по умолчанию - текущий снимок, если он не старше ANALYTICS_MAX_AGE_MINUTES.
+    """
+    if mode == MODE_LIVE:
+        return async_db, "🟢 Данные: рабочая база"
+    if mode == MODE_FRESH:
+        await asyncio.to_thread(snapshot.refresh)
+    else:
+        await asyncio.to_thread(snapshot.ensure_fresh)
+    return async_snapshot, f"📸 Данные: снимок от {snapshot.refreshed_at.strftime('%d.%m %H:%M')}"
+
+# Глобальный снимок для админских и аналитических запросов
+snapshot = AnalyticsSnapshot()
+async_snapshot = AsyncAnalytics(snapshot)
@@ -0,0 +1,85 @@
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from config import BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES, BACKUP_STEP_PAUSE_MS, logger
+from database import db
+
+SNAPSHOT_PREFIX = "snapshot_"
+SNAPSHOT_SUFFIX = ".db.gz"
+
+# Одновременно выполняется только один снимок
+_snapshot_lock = threading.Lock()
+
+class SnapshotInProgress(Exception):
+    """Снимок уже создается"""
+
+def list_snapshots(directory=BACKUP_DIR):
+    """Снимки в каталоге, от старых к новым"""
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)
+    )
+    return [os.path.join(directory, name) for name in names]
+
+def rotate_snapshots(directory=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Удаление старых снимков сверх keep последних"""
+    snapshots = list_snapshots(directory)
+    for path in snapshots[:max(0, len(snapshots) - keep)]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить старый снимок {path}: {e}")
+
+def create_snapshot(database=db, directory=BACKUP_DIR, keep=BACKUP_KEEP,
+                    pages=BACKUP_PAGES, pause_ms=BACKUP_STEP_PAUSE_MS):
+    """Онлайн-снимок базы в gzip с ротацией.
+
+    Возвращает (путь, длительность в секундах, размер сжатого файла в байтах).
+    """
+    if not _snapshot_lock.acquire(blocking=False):
+        raise SnapshotInProgress()
+    try:
+        started = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        name = f"{SNAPSHOT_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        raw_path = os.path.join(directory, name + ".db.tmp")
+        path = os.path.join(directory, name + SNAPSHOT_SUFFIX)
+
+        gz_tmp_path = path + ".tmp"
+        # Недописанные файлы удаляются при любой ошибке: ротация видит только готовые *.db.gz
+        try:
+            target = sqlite3.connect(raw_path)
+            try:
+                database.backup_to(target, pages=pages, pause=pause_ms / 1000)
+            finally:
+                target.close()
+
+            # Сжимаем уже после копирования, блокировка писателя к этому моменту отпущена
+            with open(raw_path, 'rb') as src, gzip.open(gz_tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(gz_tmp_path, path)
+        finally:
+            for tmp_path in (raw_path, gz_tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+
+        rotate_snapshots(directory, keep)
+        duration = time.monotonic() - started
+        size = os.path.getsize(path)
+        logger.info(f"Database snapshot {path}: {size:,} bytes in {duration:.2f}s")
+        return path, duration, size
+    finally:
+        _snapshot_lock.release()
+
+async def snapshot(**kwargs):
+    """Снимок в отдельном потоке, не занимая event loop и поток-писатель БД"""
+    return await asyncio.to_thread(create_snapshot, **kwargs)
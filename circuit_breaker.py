@@ -0,0 +1,81 @@
+import time
+from collections import deque
+from config import logger
+
+class CircuitBreaker:
+    """Предохранитель для вызовов внешнего API.
+
+    closed: вызовы идут, исходы копятся в скользящем окне window секунд. Если за
+    окно набралось min_calls вызовов и доля ошибок не меньше failure_rate,
+    предохранитель размыкается (open) на open_seconds: вызовы не делаются.
+    Потом half_open: проходит один пробный вызов, успех замыкает цепь, ошибка
+    снова размыкает ее.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, window=30, min_calls=10, failure_rate=0.5, open_seconds=30):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self):
+        """Можно ли сейчас сделать вызов; в half_open разрешается один пробный"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                self.stats['rejected'] += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                self.stats['rejected'] += 1
+                return False
+            self._probing = True
+        return True
+
+    def record(self, ok):
+        """Исход разрешенного вызова"""
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if ok:
+                logger.info(f"Circuit {self.name} closed after a successful probe")
+                self._reset()
+            else:
+                self._open("probe failed")
+            return
+        if self.state == self.OPEN:
+            return
+
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        self._failures += not ok
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, old_ok = self._outcomes.popleft()
+            self._failures -= not old_ok
+        calls = len(self._outcomes)
+        if calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+            self._open(f"{self._failures}/{calls} calls failed")
+
+    def _open(self, reason):
+        logger.warning(f"Circuit {self.name} opened ({reason}), pausing calls for {self.open_seconds} s")
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self.stats['opened'] += 1
+        self._outcomes.clear()
+        self._failures = 0
+
+    def _reset(self):
+        self.state = self.CLOSED
+        self._outcomes.clear()
+        self._failures = 0
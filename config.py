@@ -19,10 +19,76 @@ ADMIN_IDS = [6798547914]
 
 # ID канала для проверки подписки
 CHANNEL_ID = -1002090905218
+# Кэш проверки подписки: срок жизни подтвержденной подписки и отсутствия подписки (секунды), максимум записей
+SUBSCRIPTION_CACHE_TTL_SECONDS = int(os.environ.get("SUBSCRIPTION_CACHE_TTL_SECONDS", 300))
+SUBSCRIPTION_NEGATIVE_TTL_SECONDS = int(os.environ.get("SUBSCRIPTION_NEGATIVE_TTL_SECONDS", 30))
+SUBSCRIPTION_CACHE_MAX = int(os.environ.get("SUBSCRIPTION_CACHE_MAX", 50000))
+# Предохранитель проверок подписки: таймаут запроса (секунды), окно подсчета ошибок (секунды), минимум запросов
+# в окне, доля ошибок для размыкания, пауза без запросов (секунды); пускать ли неизвестных, пока он разомкнут
+SUBSCRIPTION_CHECK_TIMEOUT_SECONDS = float(os.environ.get("SUBSCRIPTION_CHECK_TIMEOUT_SECONDS", 5))
+SUBSCRIPTION_BREAKER_WINDOW_SECONDS = int(os.environ.get("SUBSCRIPTION_BREAKER_WINDOW_SECONDS", 30))
+SUBSCRIPTION_BREAKER_MIN_CALLS = int(os.environ.get("SUBSCRIPTION_BREAKER_MIN_CALLS", 10))
+SUBSCRIPTION_BREAKER_FAILURE_RATE = float(os.environ.get("SUBSCRIPTION_BREAKER_FAILURE_RATE", 0.5))
+SUBSCRIPTION_BREAKER_OPEN_SECONDS = int(os.environ.get("SUBSCRIPTION_BREAKER_OPEN_SECONDS", 30))
+SUBSCRIPTION_DEGRADED_ALLOW_UNKNOWN = os.environ.get("SUBSCRIPTION_DEGRADED_ALLOW_UNKNOWN", "1") == "1"
+# Сколько секунд статус из таблицы channel_members считается актуальным без запроса к API
+CHANNEL_MEMBER_FRESH_SECONDS = int(os.environ.get("CHANNEL_MEMBER_FRESH_SECONDS", 24 * 60 * 60))
+# Массовая проверка преданных рефералов: одновременных запросов get_chat_member, запросов в секунду,
+# рефералов в одной пачке (пачка сохраняется одной транзакцией) и период обновления прогресса (секунды)
+LOYALTY_CHECK_CONCURRENCY = int(os.environ.get("LOYALTY_CHECK_CONCURRENCY", 8))
+LOYALTY_CHECK_RATE_PER_SECOND = float(os.environ.get("LOYALTY_CHECK_RATE_PER_SECOND", 20))
+LOYALTY_CHECK_BATCH_SIZE = int(os.environ.get("LOYALTY_CHECK_BATCH_SIZE", 200))
+LOYALTY_CHECK_PROGRESS_SECONDS = float(os.environ.get("LOYALTY_CHECK_PROGRESS_SECONDS", 5))
 
 # Пути к файлам
 BASE_DIR = os.environ.get("BASE_DIR", os.path.dirname(__file__))
 DB_PATH = os.environ.get("DB_PATH", "bot_database.db")
+# Количество read-only соединений в пуле читателей SQLite
+DB_READERS = int(os.environ.get("DB_READERS", 4))
+# Занятость файла другим процессом: таймаут SQLite (мс), число повторов BEGIN IMMEDIATE и задержки между ними (мс)
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 1000))
+DB_BUSY_RETRIES = int(os.environ.get("DB_BUSY_RETRIES", 8))
+DB_BUSY_BACKOFF_MS = int(os.environ.get("DB_BUSY_BACKOFF_MS", 10))
+DB_BUSY_BACKOFF_MAX_MS = int(os.environ.get("DB_BUSY_BACKOFF_MAX_MS", 500))
+# Групповой коммит записей заданий: окно ожидания (мс) и максимум записей в одной транзакции (0 - выключен)
+DB_GROUP_COMMIT_MS = int(os.environ.get("DB_GROUP_COMMIT_MS", 5))
+DB_GROUP_COMMIT_MAX_ROWS = int(os.environ.get("DB_GROUP_COMMIT_MAX_ROWS", 64))
+# Контрольные точки WAL: страховочный автоматический checkpoint (страниц, 0 - выключен), период проверки и
+# пауза без записей для PASSIVE (секунды), размер WAL для PASSIVE без ожидания паузы (байты), час TRUNCATE (UTC)
+DB_WAL_AUTOCHECKPOINT_PAGES = int(os.environ.get("DB_WAL_AUTOCHECKPOINT_PAGES", 10000))
+DB_CHECKPOINT_INTERVAL_SECONDS = int(os.environ.get("DB_CHECKPOINT_INTERVAL_SECONDS", 15))
+DB_CHECKPOINT_IDLE_SECONDS = float(os.environ.get("DB_CHECKPOINT_IDLE_SECONDS", 2))
+DB_WAL_MAX_BYTES = int(os.environ.get("DB_WAL_MAX_BYTES", 16 * 1024 * 1024))
+DB_CHECKPOINT_TRUNCATE_HOUR = int(os.environ.get("DB_CHECKPOINT_TRUNCATE_HOUR", 3))
+# Статистика запросов: порог медленного запроса (мс) и максимум различных запросов в статистике
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", 100))
+DB_QUERY_STATS_MAX = int(os.environ.get("DB_QUERY_STATS_MAX", 500))
+# Фоновая проверка целостности: интервал quick_check (минуты) и час полной проверки (UTC)
+DB_QUICK_CHECK_INTERVAL_MINUTES = int(os.environ.get("DB_QUICK_CHECK_INTERVAL_MINUTES", 60))
+DB_FULL_CHECK_HOUR = int(os.environ.get("DB_FULL_CHECK_HOUR", 4))
+# Архивация решенных заданий: возраст в днях и размер пачки, интервал запуска в часах
+TASK_ARCHIVE_DAYS = int(os.environ.get("TASK_ARCHIVE_DAYS", 30))
+TASK_ARCHIVE_BATCH_SIZE = int(os.environ.get("TASK_ARCHIVE_BATCH_SIZE", 500))
+TASK_ARCHIVE_INTERVAL_HOURS = int(os.environ.get("TASK_ARCHIVE_INTERVAL_HOURS", 24))
+# Перевод на auto_vacuum=INCREMENTAL при запуске только для баз не больше этого размера (МБ);
+# большие переводятся вручную через vacuum_db.py при остановленном боте
+DB_AUTO_VACUUM_MIGRATE_MAX_MB = int(os.environ.get("DB_AUTO_VACUUM_MIGRATE_MAX_MB", 64))
+# Снимки базы: каталог, сколько хранить, страниц за шаг, пауза между шагами (мс), интервал (часы)
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", 256))
+BACKUP_STEP_PAUSE_MS = int(os.environ.get("BACKUP_STEP_PAUSE_MS", 5))
+BACKUP_INTERVAL_HOURS = int(os.environ.get("BACKUP_INTERVAL_HOURS", 6))
+# Снимок базы для админской аналитики: путь, период обновления и максимальный возраст перед запросом (минуты)
+ANALYTICS_DB_PATH = os.environ.get("ANALYTICS_DB_PATH", os.path.join(BASE_DIR, "analytics.db"))
+ANALYTICS_REFRESH_MINUTES = int(os.environ.get("ANALYTICS_REFRESH_MINUTES", 15))
+ANALYTICS_MAX_AGE_MINUTES = int(os.environ.get("ANALYTICS_MAX_AGE_MINUTES", 60))
+# Массовый импорт пользователей: записей в одной транзакции
+DB_IMPORT_CHUNK_SIZE = int(os.environ.get("DB_IMPORT_CHUNK_SIZE", 1000))
+# Размер пачки для backfill-миграций (строк на один коммит)
+MIGRATION_BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", 5000))
+# Ключ перестановки номеров промокодов; при смене ключа новые коды не пересекутся со старыми благодаря уникальному индексу
+PROMO_CODE_KEY = os.environ.get("PROMO_CODE_KEY", "amb-promo-codes")
 REMINDER_IMAGE_PATH = os.path.join(BASE_DIR, "reminder.png")
 WELCOME_IMAGE_PATH = os.path.join(BASE_DIR, "welcome.jpg")
 STATIC_DIR = os.environ.get("STATIC_DIR", BASE_DIR)
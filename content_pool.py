@@ -0,0 +1,73 @@
+import random
+import threading
+from collections import OrderedDict
+
+class ContentPool:
+    """Пул контента в памяти: случайный выбор за O(1) без ORDER BY RANDOM().
+
+    Элементы загружаются функцией loader() -> [(id, payload), ...] при первом
+    обращении и после invalidate(). Для каждого пользователя может вестись своя
+    перемешанная очередь, чтобы "🔄 Другой" не повторялся, пока пул не исчерпан.
+    """
+
+    def __init__(self, loader, max_user_orders=10000):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._items = None
+        self._by_id = {}
+        self._user_orders = OrderedDict()
+        self._max_user_orders = max_user_orders
+
+    def reload(self):
+        """Загрузка пула из базы данных"""
+        items = list(self._loader())
+        with self._lock:
+            self._items = items
+            self._by_id = dict(items)
+        return items
+
+    def invalidate(self):
+        """Сброс пула после изменения контента админом"""
+        with self._lock:
+            self._items = None
+
+    def _ensure_loaded(self):
+        items = self._items
+        if items is None:
+            items = self.reload()
+        return items
+
+    def __len__(self):
+        return len(self._ensure_loaded())
+
+    def random(self):
+        """Случайный элемент (id, payload) или None, если пул пуст"""
+        items = self._ensure_loaded()
+        return random.choice(items) if items else None
+
+    def sample(self, k):
+        """k различных случайных элементов"""
+        items = self._ensure_loaded()
+        return random.sample(items, min(k, len(items)))
+
+    def next_for_user(self, user_id):
+        """Следующий элемент из личной перестановки пользователя без повторов"""
+        self._ensure_loaded()
+
+        with self._lock:
+            if not self._by_id:
+                return None
+            order = self._user_orders.pop(user_id, None)
+            while True:
+                if not order:
+                    order = list(self._by_id)
+                    random.shuffle(order)
+                item_id = order.pop()
+                # Удаленные после перемешивания элементы пропускаем
+                if item_id in self._by_id:
+                    break
+
+            self._user_orders[user_id] = order
+            if len(self._user_orders) > self._max_user_orders:
+                self._user_orders.popitem(last=False)
+            return item_id, self._by_id[item_id]
@@ -1,15 +1,122 @@
 import sqlite3
 import os
-import string
+import asyncio
+import functools
+import itertools
+import pathlib
+import queue
 import random
-from datetime import datetime
-from config import DB_PATH, logger
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from config import (
+    DB_PATH, DB_READERS, DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX_ROWS,
+    DB_BUSY_TIMEOUT_MS, DB_BUSY_RETRIES, DB_BUSY_BACKOFF_MS, DB_BUSY_BACKOFF_MAX_MS,
+    DB_WAL_AUTOCHECKPOINT_PAGES, DB_IMPORT_CHUNK_SIZE, TASK_ARCHIVE_DAYS, TASK_ARCHIVE_BATCH_SIZE,
+    LOYALTY_CHECK_BATCH_SIZE, logger
+)
+from content_pool import ContentPool
+from migrations import migrate, TASK_COLUMNS
+from promo_codes import allocate_codes
+from query_stats import QueryStats, TimedConnection
+from storage import reader, in_memory, grouped, next_channel_member
+from user_mirror import UserMirror
+from utils import render_task_description, to_epoch
+
+# Запросы горячих путей. Для каждого из них миграции создают индекс,
+# test_query_plans.py проверяет, что ни один не уходит в полный скан таблицы
+SQL_LAST_PENDING_TASK = (
+    "SELECT task_id FROM tasks WHERE user_id = ? AND status = 'pending' ORDER BY created_ts DESC LIMIT 1"
+)
+SQL_NEXT_TASK_FOR_REVIEW = """
+    SELECT task_id, user_id, screenshot_path, created_at 
+    FROM tasks 
+    WHERE status='pending' AND screenshot_path IS NOT NULL 
+    ORDER BY created_ts ASC LIMIT 1
+"""
+SQL_COUNT_USERS_JOINED_SINCE = "SELECT COUNT(*) FROM users WHERE joined_ts >= ?"
+SQL_REFERRALS_TO_VERIFY = """
+    SELECT u.user_id, u.ref_by
+    FROM users u
+    WHERE u.user_id > ? AND u.ref_by IS NOT NULL AND u.joined_ts < ?
+    AND NOT EXISTS (
+        SELECT 1 FROM loyal_referrals_tracking t WHERE t.referrer_id = u.ref_by AND t.referral_id = u.user_id
+    )
+    ORDER BY u.user_id
+    LIMIT ?
+"""
+SQL_RECENT_USERS = """
+    SELECT user_id, username, joined_date 
+    FROM users 
+    ORDER BY joined_ts DESC 
+    LIMIT ?
+"""
+
+# Колонки users в порядке полей UserRecord
+USER_MIRROR_COLUMNS = (
+    "user_id, username, promo_code, ref_by, referrals_count, "
+    "loyal_referrals, used_loyal, pending_tasks, completed_tasks, total_tasks"
+)
+# Поля записи массового импорта пользователей (порядок для кортежей и CSV)
+USER_IMPORT_FIELDS = ('user_id', 'username', 'first_name', 'last_name', 'ref_by', 'joined_date', 'promo_code')
+# Вставка или обновление пользователя при импорте; промокод и дата прихода у существующих не меняются
+SQL_UPSERT_USER = """
+    INSERT INTO users (user_id, username, first_name, last_name, ref_by, promo_code, joined_date, joined_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, users.username),
+        first_name = COALESCE(excluded.first_name, users.first_name),
+        last_name = COALESCE(excluded.last_name, users.last_name),
+        ref_by = COALESCE(users.ref_by, excluded.ref_by)
+"""
+
+# Допустимые режимы PRAGMA wal_checkpoint
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+# Сколько ошибок целостности сохранять в отчете
+INTEGRITY_MAX_ERRORS = 10
+
+HOT_QUERIES = {
+    'last_pending_task': SQL_LAST_PENDING_TASK,
+    'next_task_for_review': SQL_NEXT_TASK_FOR_REVIEW,
+    'count_users_joined_since': SQL_COUNT_USERS_JOINED_SINCE,
+    'recent_users': SQL_RECENT_USERS,
+    'referrals_to_verify': SQL_REFERRALS_TO_VERIFY,
+}
+
+# Счетчики массовой проверки преданных рефералов (колонки loyalty_checks)
+LOYALTY_CHECK_COUNTERS = ('processed', 'subscribed', 'credited', 'too_recent', 'failed')
+
+def _is_busy(error):
+    """Ошибка занятости файла другим соединением (SQLITE_BUSY/SQLITE_LOCKED)"""
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
 
 class Database:
-    def __init__(self):
+    def __init__(self, path=None, readers=DB_READERS):
+        self.path = path or DB_PATH
+        self._write_lock = threading.RLock()
+        self._readers = queue.Queue()
+        self._pending = []
+        self._savepoints = []
+        self._lock_stats = {
+            'transactions': 0, 'retries': 0, 'failures': 0, 'wait_total': 0.0, 'wait_max': 0.0
+        }
+        self._integrity = {'quick': None, 'full': None}
+        self._integrity_lock = threading.Lock()
+        self.last_write = time.monotonic()
+        self._checkpoint_conn = None
+        self._checkpoint_lock = threading.Lock()
+        self.users = UserMirror()
+        self.channel_members = {}
+        self.query_stats = QueryStats()
         try:
             # Проверяем, существует ли директория для БД
-            db_dir = os.path.dirname(DB_PATH)
+            db_dir = os.path.dirname(self.path)
             if db_dir and not os.path.exists(db_dir):
                 os.makedirs(db_dir, exist_ok=True)
                 # Устанавливаем права на запись
@@ -17,404 +124,1296 @@ class Database:
                 logger.info(f"Created directory for database: {db_dir}")
             
             # Проверяем права на запись в директорию
-            if not os.access(db_dir, os.W_OK):
+            if not os.access(db_dir or '.', os.W_OK):
                 logger.error(f"No write access to directory: {db_dir}")
                 # Пытаемся создать БД в текущей директории как fallback
-                fallback_path = "bot_database.db"
-                logger.info(f"Falling back to: {fallback_path}")
-                self.conn = sqlite3.connect(fallback_path, check_same_thread=False)
-            else:
-                # Подключаемся к БД с улучшенными настройками
-                self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-            self.cursor = self.conn.cursor()
+                self.path = "bot_database.db"
+                logger.info(f"Falling back to: {self.path}")
+            # Единственное соединение-писатель: все записи идут через него по очереди
+            self.conn = sqlite3.connect(
+                self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                factory=TimedConnection
+            )
+            self.conn.stats = self.query_stats
             
             # Включаем WAL режим для лучшей производительности и надежности
-            self.cursor.execute("PRAGMA journal_mode=WAL")
-            self.cursor.execute("PRAGMA synchronous=NORMAL")
-            self.cursor.execute("PRAGMA cache_size=10000")
-            self.cursor.execute("PRAGMA temp_store=MEMORY")
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA cache_size=10000")
+            self.conn.execute("PRAGMA temp_store=MEMORY")
+            # Checkpoint'ы делает CheckpointManager вне пользовательских commit'ов,
+            # автоматический остается страховкой на случай очень большого WAL
+            self.conn.execute(f"PRAGMA wal_autocheckpoint={DB_WAL_AUTOCHECKPOINT_PAGES}")
             
-            logger.info(f"Database connected successfully: {DB_PATH}")
+            logger.info(f"Database connected successfully: {self.path}")
             self.init_database()
             
+            # Соединения-читатели открываются только на чтение и в WAL не ждут писателя
+            for _ in range(max(1, readers)):
+                self._readers.put(self._connect_reader())
+            self._load_users()
+            self._load_channel_members()
+            
+            # Пулы контента для случайного выбора без ORDER BY RANDOM()
+            self.memes = ContentPool(lambda: self._load_content("SELECT id, file_path FROM meme_templates"))
+            self.texts = ContentPool(lambda: self._load_content("SELECT id, text FROM text_templates"))
+            self.chats = ContentPool(lambda: self._load_content("SELECT chat_username, chat_username FROM allowed_chats"))
+            for pool in (self.memes, self.texts, self.chats):
+                pool.reload()
+            
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
             raise
     
-    def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
-        # Создание таблицы пользователей
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                ref_by INTEGER
-            )
-        ''')
-        
-        # Создание таблицы заданий
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                task_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                task_description TEXT,
-                status TEXT DEFAULT 'pending',
-                task_type TEXT,
-                screenshot_path TEXT,
-                created_at TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES users(user_id)
-            )
-        ''')
-        
-        # Создание таблицы купонов
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS coupons (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT,
-                type TEXT,
-                used INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Создание таблицы шаблонов мемов
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS meme_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_path TEXT,
-                text TEXT
-            )
-        ''')
-        
-        # Создание таблицы текстовых шаблонов
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS text_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text TEXT
-            )
-        ''')
-        
-        # Создание таблицы разрешенных чатов
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS allowed_chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER UNIQUE,
-                chat_title TEXT
-            )
-        ''')
-        
-        # Создание таблицы промо-предложений
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS promo_offers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT,
-                description TEXT,
-                cost INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Создание таблицы для отслеживания преданных рефералов
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS loyal_referrals_tracking (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER,
-                referral_id INTEGER,
-                credited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(referrer_id, referral_id),
-                FOREIGN KEY(referrer_id) REFERENCES users(user_id),
-                FOREIGN KEY(referral_id) REFERENCES users(user_id)
-            )
-        ''')
-        
-        self.conn.commit()
-        self.run_migrations()
-    
-    def run_migrations(self):
-        """Выполнение миграций базы данных"""
-        # Проверяем существующие колонки в таблице users
-        self.cursor.execute("PRAGMA table_info(users)")
-        cols = [row[1] for row in self.cursor.fetchall()]
-        
-        # Добавляем недостающие колонки
-        migrations = [
-            ("promo_code", "TEXT"),
-            ("referrals_count", "INTEGER DEFAULT 0"),
-            ("joined_date", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
-            ("used_loyal", "INTEGER DEFAULT 0"),
-            ("loyal_referrals", "INTEGER DEFAULT 0"),
-            ("pending_tasks", "INTEGER DEFAULT 0"),
-            ("completed_tasks", "INTEGER DEFAULT 0")
-        ]
-        
-        for column, definition in migrations:
-            if column not in cols:
-                try:
-                    self.cursor.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
-                    logger.info(f"Added column {column} to users table")
-                except sqlite3.OperationalError as e:
-                    logger.warning(f"Column {column} already exists: {e}")
+    def _connect_reader(self):
+        """Открытие read-only соединения для пула читателей"""
+        uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=TimedConnection)
+        conn.stats = self.query_stats
+        conn.execute("PRAGMA cache_size=10000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def _load_content(self, sql):
+        """Загрузка пар (id, payload) для пула контента"""
+        with self._read() as cur:
+            cur.execute(sql)
+            return cur.fetchall()
+    
+    def _load_users(self):
+        """Загрузка зеркала пользователей из базы"""
+        with self._read() as cur:
+            cur.execute(f"SELECT {USER_MIRROR_COLUMNS} FROM users ORDER BY user_id")
+            self.users.load(cur)
+        logger.info(f"Loaded {len(self.users)} users into memory")
+    
+    def _load_channel_members(self):
+        """Загрузка статусов участников канала в память"""
+        with self._read() as cur:
+            cur.execute("SELECT user_id, status, joined_ts, left_ts, updated_ts FROM channel_members")
+            self.channel_members = {row[0]: row[1:] for row in cur}
+        logger.info(f"Loaded {len(self.channel_members)} channel members into memory")
+    
+    def _mirror_user(self, cur, user_id):
+        """Загрузка в зеркало пользователя, записанного в базу мимо этого процесса"""
+        cur.execute(f"SELECT {USER_MIRROR_COLUMNS} FROM users WHERE user_id = ?", (user_id,))
+        row = cur.fetchone()
+        if row:
+            self.users.load_one(row)
+            logger.info(f"Loaded user {user_id} written by another process into memory")
+    
+    @contextmanager
+    def _read(self):
+        """Курсор на свободном соединении-читателе"""
+        conn = self._readers.get()
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            self._readers.put(conn)
+    
+    @contextmanager
+    def _write(self):
+        """Курсор писателя; записи сериализуются общей блокировкой.
+
+        Вне открытой транзакции запись начинается с BEGIN IMMEDIATE с повтором, как
+        в transaction(), а не с неявной отложенной транзакцией, которая при записи
+        второго процесса падает с "database is locked". Незакрытая вызывающим
+        транзакция коммитится на выходе, при исключении откатывается.
+        """
+        with self._write_lock:
+            outer = not self.conn.in_transaction
+            if outer:
+                self._begin_immediate()
+            cur = self.conn.cursor()
+            try:
+                yield cur
+                if outer and self.conn.in_transaction:
+                    self.conn.commit()
+                    self._apply_pending()
+            except BaseException:
+                if outer and self.conn.in_transaction:
+                    self.conn.rollback()
+                    self._pending.clear()
+                raise
+            finally:
+                cur.close()
+    
+    def _after_commit(self, func, *args, **kwargs):
+        """Действие над зеркалом, которое выполнится только после COMMIT записи"""
+        self._pending.append(functools.partial(func, *args, **kwargs))
+    
+    def _apply_pending(self):
+        """Действия после COMMIT: обновление зеркала и отметка времени последней записи"""
+        self.last_write = time.monotonic()
+        pending, self._pending = self._pending, []
+        for action in pending:
+            action()
+    
+    def _commit(self):
+        """Commit записи; внутри transaction() и группового коммита его делает внешняя транзакция"""
+        if not self._savepoints:
+            self.conn.commit()
+            self._apply_pending()
+    
+    def _rollback(self):
+        """Откат записи; внутри транзакции откатывается только текущий SAVEPOINT"""
+        if self._savepoints:
+            self._rollback_to_savepoint()
+        else:
+            self.conn.rollback()
+            self._pending.clear()
+    
+    def _rollback_to_savepoint(self):
+        name, mark = self._savepoints[-1]
+        self.conn.execute(f"ROLLBACK TO {name}")
+        del self._pending[mark:]
+    
+    @contextmanager
+    def _savepoint(self):
+        """SAVEPOINT в открытой транзакции; исключение откатывает только его"""
+        name = f"sp{len(self._savepoints)}"
+        self.conn.execute(f"SAVEPOINT {name}")
+        self._savepoints.append((name, len(self._pending)))
+        try:
+            yield
+        except BaseException:
+            self._rollback_to_savepoint()
+            raise
+        finally:
+            self._savepoints.pop()
+            self.conn.execute(f"RELEASE {name}")
+    
+    def _begin_immediate(self):
+        """BEGIN IMMEDIATE с повтором, пока файл занят другим процессом"""
+        started = time.monotonic()
+        for attempt in range(DB_BUSY_RETRIES + 1):
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or attempt == DB_BUSY_RETRIES:
+                    self._lock_stats['failures'] += 1
+                    raise
+                # Экспоненциальная задержка с джиттером, чтобы процессы не просыпались хором
+                delay = min(DB_BUSY_BACKOFF_MAX_MS, DB_BUSY_BACKOFF_MS * 2 ** attempt) / 1000
+                time.sleep(random.uniform(delay / 2, delay))
         
-        # Создаем уникальный индекс на promo_code
-        self.cursor.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS idx_users_promo_code
-              ON users(promo_code)
-        """)
+        waited = time.monotonic() - started
+        stats = self._lock_stats
+        stats['transactions'] += 1
+        stats['retries'] += attempt
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция из нескольких запросов: with db.transaction() as cur.
         
-        # Генерируем промокоды для пользователей без них
-        self.cursor.execute("SELECT user_id FROM users WHERE promo_code IS NULL")
-        rows = self.cursor.fetchall()
-        for (uid,) in rows:
-            code = self.generate_promo_code()
-            self.cursor.execute(
-                "UPDATE users SET promo_code = ? WHERE user_id = ?",
-                (code, uid)
-            )
+        Снаружи это BEGIN IMMEDIATE с повтором при SQLITE_BUSY, поэтому файл можно
+        делить со вторым процессом. Вложенные вызовы и вызовы внутри группового
+        коммита становятся SAVEPOINT. Зеркало обновляется после итогового COMMIT.
+        """
+        with self._write_lock:
+            outer = not self.conn.in_transaction
+            if outer:
+                self._begin_immediate()
+            cur = self.conn.cursor()
+            try:
+                with self._savepoint():
+                    yield cur
+                if outer:
+                    self.conn.commit()
+                    self._apply_pending()
+            except BaseException:
+                if outer:
+                    self.conn.rollback()
+                    self._pending.clear()
+                raise
+            finally:
+                cur.close()
+    
+    @in_memory
+    def get_lock_stats(self):
+        """Статистика ожидания блокировки записи"""
+        stats = dict(self._lock_stats)
+        stats['wait_avg'] = stats['wait_total'] / stats['transactions'] if stats['transactions'] else 0.0
+        return stats
+    
+    @in_memory
+    def get_query_stats(self, limit=5):
+        """Самые затратные запросы и последние медленные"""
+        return self.query_stats.top(limit), list(self.query_stats.slow_log)
+    
+    def run_batch(self, jobs):
+        """Выполнение пачки записей [(func, args, kwargs)] одной транзакцией.
         
-        self.conn.commit()
+        Каждая запись идет в своем SAVEPOINT, поэтому ошибка откатывает только ее.
+        Возвращает [(True, результат) или (False, исключение)] в порядке jobs.
+        """
+        results = []
+        with self._write_lock:
+            self._begin_immediate()
+            try:
+                for func, args, kwargs in jobs:
+                    try:
+                        with self._savepoint():
+                            result = func(*args, **kwargs)
+                        results.append((True, result))
+                    except Exception as e:
+                        results.append((False, e))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                self._pending.clear()
+                raise
+            self._apply_pending()
+        return results
+    
+    def init_database(self):
+        """Инициализация базы данных: применение недостающих миграций схемы"""
+        with self._write_lock:
+            migrate(self.conn)
     
     def generate_promo_code(self):
-        """Генерация уникального промокода"""
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-            self.cursor.execute("SELECT user_id FROM users WHERE promo_code = ?", (code,))
-            if not self.cursor.fetchone():
-                return code
+        """Выдача нового промокода из аллокатора (без проверочных SELECT)"""
+        with self._write() as cur:
+            return allocate_codes(cur)[0]
     
     def get_or_create_user(self, user_id, username=None, first_name=None, last_name=None, ref_by=None):
         """Получение или создание пользователя с улучшенной обработкой ошибок"""
-        try:
-            self.cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            user = self.cursor.fetchone()
+        with self._write() as cur:
+            try:
+                cur.execute("SELECT ref_by, promo_code FROM users WHERE user_id = ?", (user_id,))
+                user = cur.fetchone()
             
-            if user is None:
-                # Создаем нового пользователя
-                promo_code = self.generate_promo_code()
-                now = datetime.now().isoformat()
-                
-                self.cursor.execute(
-                    "INSERT INTO users (user_id, username, first_name, last_name, ref_by, promo_code, joined_date) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (user_id, username, first_name, last_name, ref_by, promo_code, now)
-                )
-                self.conn.commit()
-                
-                logger.info(f"Created new user: {user_id} (@{username or 'нет'})")
-                return promo_code
-            else:
-                # Обновляем существующего пользователя если нужно
-                if ref_by is not None and user[4] is None:  # user[4] = ref_by
-                    self.cursor.execute(
-                        "UPDATE users SET ref_by = ? WHERE user_id = ?",
-                        (ref_by, user_id)
+                if user is None:
+                    # Создаем нового пользователя
+                    now = datetime.now()
+                    while True:
+                        promo_code = self.generate_promo_code()
+                        try:
+                            cur.execute(
+                                "INSERT INTO users (user_id, username, first_name, last_name, ref_by, promo_code, "
+                                "joined_date, joined_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (user_id, username, first_name, last_name, ref_by, promo_code,
+                                 now.isoformat(), to_epoch(now))
+                            )
+                            break
+                        except sqlite3.IntegrityError as e:
+                            # Совпадение со старым случайным кодом - берем следующий номер
+                            if 'promo_code' not in str(e):
+                                raise
+                    self._after_commit(
+                        self.users.add, user_id,
+                        username=username, promo_code=promo_code, ref_by=ref_by
                     )
-                    self.conn.commit()
-                    logger.info(f"Updated user {user_id} with referrer {ref_by}")
+                    self._commit()
                 
-                return user[5]  # user[5] = promo_code
+                    logger.info(f"Created new user: {user_id} (@{username or 'нет'})")
+                    return promo_code
+                else:
+                    # Пользователя мог добавить другой процесс (импорт, обслуживание, старый бот)
+                    if user_id not in self.users:
+                        self._mirror_user(cur, user_id)
+                    # Обновляем существующего пользователя если нужно
+                    if ref_by is not None and user[0] is None:  # user[0] = ref_by
+                        cur.execute(
+                            "UPDATE users SET ref_by = ? WHERE user_id = ?",
+                            (ref_by, user_id)
+                        )
+                        self._after_commit(self.users.update, user_id, ref_by=ref_by)
+                        self._commit()
+                        logger.info(f"Updated user {user_id} with referrer {ref_by}")
                 
-        except Exception as e:
-            logger.error(f"Error in get_or_create_user for {user_id}: {e}")
-            # Пытаемся откатить транзакцию
-            try:
-                self.conn.rollback()
-            except:
-                pass
-            raise
+                    return user[1]  # user[1] = promo_code
+                
+            except Exception as e:
+                logger.error(f"Error in get_or_create_user for {user_id}: {e}")
+                # Пытаемся откатить транзакцию
+                try:
+                    self._rollback()
+                except:
+                    pass
+                raise
     
-    def get_user_stats(self, user_id):
-        """Получение статистики пользователя"""
-        self.cursor.execute("""
-            SELECT 
-                u.promo_code,
-                u.referrals_count,
-                u.loyal_referrals,
-                u.used_loyal,
-                u.pending_tasks,
-                u.completed_tasks,
-                COUNT(t.task_id) as total_tasks
-            FROM users u
-            LEFT JOIN tasks t ON u.user_id = t.user_id
-            WHERE u.user_id = ?
-            GROUP BY u.user_id
-        """, (user_id,))
+    def _import_record(self, record, now):
+        """Запись импорта (dict или последовательность в порядке USER_IMPORT_FIELDS) -> кортеж полей.
         
-        row = self.cursor.fetchone()
-        if row:
-            return {
-                'promo_code': row[0],
-                'referrals_count': row[1],
-                'loyal_referrals': row[2],
-                'used_loyal': row[3],
-                'pending_tasks': row[4],
-                'completed_tasks': row[5],
-                'total_tasks': row[6]
-            }
-        return None
+        Текстовые даты без смещения считаются местным временем, как в datetime.now() бота
+        и в backfill epoch-колонок; даты со смещением переводятся в местное время.
+        Некорректная запись дает ValueError или TypeError.
+        """
+        if not isinstance(record, dict):
+            record = dict(zip(USER_IMPORT_FIELDS, record))
+        values = {field: record.get(field) or None for field in USER_IMPORT_FIELDS}
+        values['user_id'] = int(values['user_id'])
+        if values['ref_by'] is not None:
+            values['ref_by'] = int(values['ref_by'])
+        joined = values['joined_date'] or now
+        if isinstance(joined, str):
+            joined = datetime.fromisoformat(joined)
+        if joined.tzinfo is not None:
+            joined = joined.astimezone().replace(tzinfo=None)
+        values['joined_date'] = joined.isoformat()
+        return values, to_epoch(joined)
+    
+    def _assign_import_codes(self, cur, rows):
+        """Промокоды для новых строк: переданный код, если он свободен, иначе из аллокатора"""
+        wanted = [row['promo_code'] for row in rows if row['promo_code']]
+        taken = set()
+        for start in range(0, len(wanted), 500):
+            part = wanted[start:start + 500]
+            cur.execute(
+                f"SELECT promo_code FROM users WHERE promo_code IN ({','.join('?' * len(part))})", part
+            )
+            taken.update(code for (code,) in cur.fetchall())
+        
+        missing = []
+        for row in rows:
+            code = row['promo_code']
+            if code and code not in taken:
+                taken.add(code)
+            else:
+                missing.append(row)
+        
+        # Коды аллокатора могут совпасть только со старыми случайными - их пропускаем
+        while missing:
+            codes = allocate_codes(cur, len(missing))
+            cur.execute(
+                f"SELECT promo_code FROM users WHERE promo_code IN ({','.join('?' * len(codes))})", codes
+            )
+            taken.update(code for (code,) in cur.fetchall())
+            still_missing = []
+            for row, code in zip(missing, codes):
+                if code in taken:
+                    still_missing.append(row)
+                else:
+                    row['promo_code'] = code
+                    taken.add(code)
+            missing = still_missing
+    
+    def _mirror_import(self, inserted, updated):
+        """Перенос результата импорта в зеркало пользователей"""
+        for row in inserted:
+            self.users.add(
+                row['user_id'], username=row['username'], promo_code=row['promo_code'], ref_by=row['ref_by']
+            )
+        for row in updated:
+            record = self.users.get(row['user_id'])
+            if record is None:
+                continue
+            fields = {'username': row['username'] or record.username}
+            if record.ref_by is None and row['ref_by'] is not None:
+                fields['ref_by'] = row['ref_by']
+            self.users.update(row['user_id'], **fields)
     
-    def create_task(self, user_id, task_type, task_description):
-        """Создание нового задания"""
+    def bulk_upsert_users(self, records, chunk_size=DB_IMPORT_CHUNK_SIZE, progress=None):
+        """Потоковый импорт пользователей пачками по chunk_size в одной транзакции каждая.
+        
+        records - итерируемое dict'ов или кортежей в порядке USER_IMPORT_FIELDS.
+        Новые пользователи получают промокод из записи (если он свободен) или из
+        аллокатора; у существующих обновляются имена, а реферер ставится, только если
+        его еще не было, как в get_or_create_user. progress(stats) вызывается после
+        каждой пачки. Некорректные записи пропускаются с предупреждением в логе и
+        считаются в skipped. Возвращает статистику с пропускной способностью.
+        """
+        stats = {
+            'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'chunks': 0, 'seconds': 0.0, 'rows_per_sec': 0.0
+        }
+        started = time.monotonic()
         now = datetime.now()
-        self.cursor.execute(
-            "INSERT INTO tasks (user_id, task_type, task_description, created_at) "
-            "VALUES (?, ?, ?, ?)",
-            (user_id, task_type, task_description, now)
-        )
-        task_id = self.cursor.lastrowid
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            # Дубликаты внутри пачки: побеждает последняя запись
+            rows = {}
+            for record in chunk:
+                try:
+                    values, joined_ts = self._import_record(record, now)
+                except (ValueError, TypeError) as e:
+                    stats['skipped'] += 1
+                    logger.warning(f"Skipped import record {record!r}: {e}")
+                    continue
+                values['joined_ts'] = joined_ts
+                rows[values['user_id']] = values
+            rows = list(rows.values())
+            
+            with self.transaction() as cur:
+                ids = [row['user_id'] for row in rows]
+                existing = set()
+                for start in range(0, len(ids), 500):
+                    part = ids[start:start + 500]
+                    cur.execute(f"SELECT user_id FROM users WHERE user_id IN ({','.join('?' * len(part))})", part)
+                    existing.update(uid for (uid,) in cur.fetchall())
+                inserted = [row for row in rows if row['user_id'] not in existing]
+                updated = [row for row in rows if row['user_id'] in existing]
+                self._assign_import_codes(cur, inserted)
+                
+                cur.executemany(SQL_UPSERT_USER, [
+                    (row['user_id'], row['username'], row['first_name'], row['last_name'], row['ref_by'],
+                     row['promo_code'] if row['user_id'] not in existing else None,
+                     row['joined_date'], row['joined_ts'])
+                    for row in rows
+                ])
+                self._after_commit(self._mirror_import, inserted, updated)
+            
+            stats['rows'] += len(chunk)
+            stats['inserted'] += len(inserted)
+            stats['updated'] += len(updated)
+            stats['chunks'] += 1
+            stats['seconds'] = time.monotonic() - started
+            stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+            if progress is not None:
+                progress(dict(stats))
         
-        # Увеличиваем счетчик ожидающих заданий
-        self.cursor.execute(
-            "UPDATE users SET pending_tasks = pending_tasks + 1 WHERE user_id = ?",
-            (user_id,)
+        logger.info(
+            f"Imported {stats['rows']} users ({stats['inserted']} new, {stats['updated']} updated, "
+            f"{stats['skipped']} skipped) "
+            f"in {stats['seconds']:.2f}s, {stats['rows_per_sec']:.0f} rows/s"
         )
+        return stats
+    
+    @in_memory
+    def get_user_stats(self, user_id):
+        """Получение статистики пользователя"""
+        user = self.users.get(user_id)
+        return user.as_stats() if user else None
+    
+    @grouped
+    def create_task(self, user_id, task_type, template_id=None):
+        """Создание нового задания (хранится ссылка на шаблон и промокод, а не текст)"""
+        with self._write() as cur:
+            now = datetime.now()
+            cur.execute(
+                "INSERT INTO tasks (user_id, task_type, template_id, template_kind, promo_code, created_at, created_ts) "
+                "VALUES (?, ?, ?, ?, (SELECT promo_code FROM users WHERE user_id = ?), ?, ?)",
+                (user_id, task_type, template_id, task_type, user_id, now, to_epoch(now))
+            )
+            task_id = cur.lastrowid
+        
+            # Увеличиваем счетчики ожидающих и всех заданий
+            cur.execute(
+                "UPDATE users SET pending_tasks = pending_tasks + 1, total_tasks = total_tasks + 1 WHERE user_id = ?",
+                (user_id,)
+            )
         
-        self.conn.commit()
-        return task_id
+            self._after_commit(self.users.increment, user_id, 'pending_tasks')
+            self._after_commit(self.users.increment, user_id, 'total_tasks')
+            self._commit()
+            return task_id
     
+    @grouped
     def approve_task(self, task_id, user_id):
         """Одобрение задания"""
-        self.cursor.execute("UPDATE tasks SET status='approved' WHERE task_id = ?", (task_id,))
-        self.cursor.execute(
-            "UPDATE users SET pending_tasks = pending_tasks - 1, completed_tasks = completed_tasks + 1 "
-            "WHERE user_id = ?", (user_id,)
-        )
-        self.conn.commit()
+        with self._write() as cur:
+            cur.execute(
+                "UPDATE tasks SET status='approved', decided_at = ? WHERE task_id = ?",
+                (datetime.now(), task_id)
+            )
+            cur.execute(
+                "UPDATE users SET pending_tasks = pending_tasks - 1, completed_tasks = completed_tasks + 1 "
+                "WHERE user_id = ?", (user_id,)
+            )
+            self._after_commit(self.users.increment, user_id, 'pending_tasks', -1)
+            self._after_commit(self.users.increment, user_id, 'completed_tasks')
+            self._commit()
     
+    @grouped
     def decline_task(self, task_id, user_id):
         """Отклонение задания"""
-        self.cursor.execute("UPDATE tasks SET status='declined' WHERE task_id = ?", (task_id,))
-        self.cursor.execute(
-            "UPDATE users SET pending_tasks = pending_tasks - 1 WHERE user_id = ?", (user_id,)
-        )
-        self.conn.commit()
+        with self._write() as cur:
+            cur.execute(
+                "UPDATE tasks SET status='declined', decided_at = ? WHERE task_id = ?",
+                (datetime.now(), task_id)
+            )
+            cur.execute(
+                "UPDATE users SET pending_tasks = pending_tasks - 1 WHERE user_id = ?", (user_id,)
+            )
+            self._after_commit(self.users.increment, user_id, 'pending_tasks', -1)
+            self._commit()
     
+    @grouped
     def cancel_task(self, user_id):
         """Отмена последнего задания пользователя"""
-        # Находим последнее ожидающее задание пользователя
-        self.cursor.execute(
-            "SELECT task_id FROM tasks WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
-            (user_id,)
-        )
-        row = self.cursor.fetchone()
-        if row:
-            task_id = row[0]
-            # Удаляем задание и уменьшаем счетчик
-            self.cursor.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
-            self.cursor.execute(
-                "UPDATE users SET pending_tasks = pending_tasks - 1 WHERE user_id = ? AND pending_tasks > 0",
-                (user_id,)
-            )
-            self.conn.commit()
-            return True
-        return False
+        with self._write() as cur:
+            # Находим последнее ожидающее задание пользователя
+            cur.execute(SQL_LAST_PENDING_TASK, (user_id,))
+            row = cur.fetchone()
+            if row:
+                task_id = row[0]
+                # Удаляем задание и уменьшаем счетчик
+                cur.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+                cur.execute(
+                    "UPDATE users SET pending_tasks = pending_tasks - 1 WHERE user_id = ? AND pending_tasks > 0",
+                    (user_id,)
+                )
+                cur.execute("UPDATE users SET total_tasks = total_tasks - 1 WHERE user_id = ?", (user_id,))
+                self._after_commit(self.users.increment, user_id, 'pending_tasks', -1, 0)
+                self._after_commit(self.users.increment, user_id, 'total_tasks', -1)
+                self._commit()
+                return True
+            return False
     
-    def get_random_meme(self):
-        """Получение случайного мема"""
-        self.cursor.execute("SELECT id, file_path FROM meme_templates ORDER BY RANDOM() LIMIT 1")
-        return self.cursor.fetchone()
+    @reader
+    def get_random_meme(self, user_id=None):
+        """Получение случайного мема (без повторов для user_id, пока мемы не закончатся)"""
+        if user_id is not None:
+            return self.memes.next_for_user(user_id)
+        return self.memes.random()
     
     def delete_meme(self, meme_id):
         """Удаление мема по ID"""
-        # Получаем путь к файлу перед удалением
-        self.cursor.execute("SELECT file_path FROM meme_templates WHERE id = ?", (meme_id,))
-        row = self.cursor.fetchone()
-        if not row:
-            return False
+        with self._write() as cur:
+            # Получаем путь к файлу перед удалением
+            cur.execute("SELECT file_path FROM meme_templates WHERE id = ?", (meme_id,))
+            row = cur.fetchone()
+            if not row:
+                return False
         
-        file_path = row[0]
+            file_path = row[0]
         
-        # Удаляем запись из базы данных
-        self.cursor.execute("DELETE FROM meme_templates WHERE id = ?", (meme_id,))
+            # Удаляем запись из базы данных
+            cur.execute("DELETE FROM meme_templates WHERE id = ?", (meme_id,))
         
-        # Пытаемся удалить файл
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить файл {file_path}: {e}")
+            # Пытаемся удалить файл
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            except Exception as e:
+                logger.warning(f"Не удалось удалить файл {file_path}: {e}")
         
-        self.conn.commit()
+            self._commit()
+        self.memes.invalidate()
         return True
     
-    def get_random_text(self):
-        """Получение случайного текста"""
-        self.cursor.execute("SELECT id, text FROM text_templates ORDER BY RANDOM() LIMIT 1")
-        return self.cursor.fetchone()
+    @reader
+    def get_random_text(self, user_id=None):
+        """Получение случайного текста (без повторов для user_id, пока тексты не закончатся)"""
+        if user_id is not None:
+            return self.texts.next_for_user(user_id)
+        return self.texts.random()
     
+    @reader
     def get_random_chats(self, limit=5):
         """Получение случайных чатов"""
-        self.cursor.execute("SELECT chat_username FROM allowed_chats ORDER BY RANDOM() LIMIT ?", (limit,))
-        return [row[0] for row in self.cursor.fetchall()]
+        return [chat for chat, _ in self.chats.sample(limit)]
     
+    @reader
     def get_pending_tasks(self):
         """Получение ожидающих заданий"""
-        self.cursor.execute("""
-            SELECT task_id, user_id, screenshot_path, created_at 
-            FROM tasks 
-            WHERE status='pending' AND screenshot_path IS NOT NULL 
-            ORDER BY created_at ASC LIMIT 1
-        """)
-        return self.cursor.fetchone()
+        with self._read() as cur:
+            cur.execute(SQL_NEXT_TASK_FOR_REVIEW)
+            return cur.fetchone()
     
+    @in_memory
     def get_all_users(self):
         """Получение всех пользователей"""
-        self.cursor.execute("SELECT user_id FROM users")
-        return [row[0] for row in self.cursor.fetchall()]
+        return self.users.user_ids()
     
+    @in_memory
     def get_user_by_username(self, username):
         """Получение пользователя по username"""
-        self.cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-        row = self.cursor.fetchone()
-        return row[0] if row else None
+        return self.users.by_username(username)
     
+    @in_memory
     def get_user_by_promo_code(self, promo_code):
         """Получение пользователя по промокоду"""
-        self.cursor.execute("SELECT user_id FROM users WHERE promo_code = ?", (promo_code,))
-        row = self.cursor.fetchone()
-        return row[0] if row else None
+        return self.users.by_promo_code(promo_code)
     
+    @grouped
     def update_screenshot_path(self, task_id, screenshot_path):
         """Обновление пути к скриншоту для задания"""
-        try:
-            self.cursor.execute(
-                "UPDATE tasks SET screenshot_path = ? WHERE task_id = ?",
-                (screenshot_path, task_id)
-            )
-            self.conn.commit()
-        except Exception as e:
-            logger.error(f"Error updating screenshot path: {e}")
-            self.conn.rollback()
+        with self._write() as cur:
+            try:
+                cur.execute(
+                    "UPDATE tasks SET screenshot_path = ? WHERE task_id = ?",
+                    (screenshot_path, task_id)
+                )
+                self._commit()
+            except Exception as e:
+                logger.error(f"Error updating screenshot path: {e}")
+                self._rollback()
     
+    @reader
     def is_loyal_referral_credited(self, referrer_id, referral_id):
         """Проверяет, был ли уже начислен преданный реферал"""
+        with self._read() as cur:
+            try:
+                cur.execute("""
+                    SELECT id FROM loyal_referrals_tracking 
+                    WHERE referrer_id = ? AND referral_id = ?
+                """, (referrer_id, referral_id))
+                return cur.fetchone() is not None
+            except Exception as e:
+                logger.error(f"Error checking loyal referral credit: {e}")
+                return False
+    
+    @in_memory
+    def user_exists(self, user_id):
+        """Проверка существования пользователя"""
+        return user_id in self.users
+    
+    @in_memory
+    def get_username(self, user_id):
+        """Получение username пользователя"""
+        user = self.users.get(user_id)
+        return user.username if user else None
+    
+    @in_memory
+    def get_ref_by(self, user_id):
+        """Получение реферера пользователя"""
+        user = self.users.get(user_id)
+        return user.ref_by if user else None
+    
+    def set_referrer(self, user_id, referrer_id):
+        """Привязка реферера и увеличение его счетчика рефералов"""
+        with self._write() as cur:
+            cur.execute("UPDATE users SET ref_by = ? WHERE user_id = ?", (referrer_id, user_id))
+            cur.execute(
+                "UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?",
+                (referrer_id,)
+            )
+            self._after_commit(self.users.update, user_id, ref_by=referrer_id)
+            self._after_commit(self.users.increment, referrer_id, 'referrals_count')
+            self._commit()
+    
+    @in_memory
+    def get_loyal_balance(self, user_id):
+        """Получение (loyal_referrals, used_loyal) пользователя"""
+        user = self.users.get(user_id)
+        return (user.loyal_referrals, user.used_loyal) if user else None
+    
+    def _post_loyalty(self, cur, user_id, earned=0, spent=0, reason='adjust', ref_id=None):
+        """Запись в журнал лояльности и изменение баланса в users в текущей транзакции.
+        
+        Списание условное: UPDATE проходит, только если доступного баланса хватает,
+        поэтому параллельные покупки не уходят в минус без блокировок в приложении.
+        Возвращает False, если пользователя нет или баланса не хватило.
+        """
+        cur.execute("""
+            UPDATE users SET loyal_referrals = loyal_referrals + ?, used_loyal = used_loyal + ?
+            WHERE user_id = ? AND (? <= 0 OR loyal_referrals - used_loyal + ? >= ?)
+        """, (earned, spent, user_id, spent, earned, spent))
+        if cur.rowcount == 0:
+            return False
+        cur.execute("""
+            INSERT INTO loyalty_ledger (user_id, earned, spent, reason, ref_id)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, earned, spent, reason, ref_id))
+        if earned:
+            self._after_commit(self.users.increment, user_id, 'loyal_referrals', earned)
+        if spent:
+            self._after_commit(self.users.increment, user_id, 'used_loyal', spent)
+        return True
+    
+    def set_loyal_referrals(self, user_id, value):
+        """Установка счетчика преданных рефералов корректирующей записью журнала"""
+        with self.transaction() as cur:
+            cur.execute("SELECT loyal_referrals FROM users WHERE user_id = ?", (user_id,))
+            row = cur.fetchone()
+            if row and value != (row[0] or 0):
+                self._post_loyalty(cur, user_id, earned=value - (row[0] or 0), reason='adjust')
+    
+    def add_used_loyal(self, user_id, amount):
+        """Списание преданных рефералов; False если баланса не хватает"""
+        if not amount:
+            return True
+        with self.transaction() as cur:
+            return self._post_loyalty(cur, user_id, spent=amount, reason='spend')
+    
+    def fold_loyalty_ledger(self):
+        """Инкрементальная сверка: свертка новых записей журнала в снимок балансов.
+        
+        Читаются только записи после контрольной точки, и сверяются только
+        затронутые ими пользователи. Расхождение в users исправляется по журналу.
+        """
+        with self.transaction() as cur:
+            cur.execute("SELECT last_entry_id FROM loyalty_fold WHERE id = 1")
+            last = cur.fetchone()[0]
+            cur.execute("SELECT MAX(entry_id) FROM loyalty_ledger")
+            head = cur.fetchone()[0] or 0
+            if head <= last:
+                return {'entries': 0, 'users': 0, 'repaired': 0}
+            
+            cur.execute("""
+                INSERT INTO loyalty_balances (user_id, earned, spent)
+                SELECT user_id, SUM(earned), SUM(spent) FROM loyalty_ledger
+                WHERE entry_id > ? AND entry_id <= ?
+                GROUP BY user_id
+                ON CONFLICT(user_id) DO UPDATE SET
+                    earned = earned + excluded.earned,
+                    spent = spent + excluded.spent
+            """, (last, head))
+            cur.execute("""
+                SELECT b.user_id, b.earned, b.spent, u.loyal_referrals, u.used_loyal
+                FROM loyalty_balances b
+                JOIN users u ON u.user_id = b.user_id
+                WHERE b.user_id IN (
+                    SELECT user_id FROM loyalty_ledger WHERE entry_id > ? AND entry_id <= ?
+                )
+            """, (last, head))
+            touched = cur.fetchall()
+            
+            repaired = 0
+            for user_id, earned, spent, loyal, used in touched:
+                if (loyal, used) == (earned, spent):
+                    continue
+                logger.warning(
+                    f"Loyalty balance drift for {user_id}: ({loyal}, {used}) -> ledger ({earned}, {spent})"
+                )
+                cur.execute(
+                    "UPDATE users SET loyal_referrals = ?, used_loyal = ? WHERE user_id = ?",
+                    (earned, spent, user_id)
+                )
+                self._after_commit(self.users.update, user_id, loyal_referrals=earned, used_loyal=spent)
+                repaired += 1
+            
+            cur.execute("UPDATE loyalty_fold SET last_entry_id = ? WHERE id = 1", (head,))
+            return {'entries': head - last, 'users': len(touched), 'repaired': repaired}
+    
+    @in_memory
+    def count_users(self):
+        """Общее количество пользователей"""
+        return len(self.users)
+    
+    @reader
+    def count_users_joined_since(self, since_ts):
+        """Количество пользователей, пришедших начиная с момента (секунды Unix)"""
+        with self._read() as cur:
+            cur.execute(SQL_COUNT_USERS_JOINED_SINCE, (since_ts,))
+            return cur.fetchone()[0]
+    
+    @reader
+    def get_recent_users(self, limit=3):
+        """Последние зарегистрированные пользователи"""
+        with self._read() as cur:
+            cur.execute(SQL_RECENT_USERS, (limit,))
+            return cur.fetchall()
+    
+    @reader
+    def export_users(self):
+        """Выгрузка пользователей для CSV"""
+        with self._read() as cur:
+            cur.execute("SELECT user_id, username, first_name, last_name, ref_by, joined_date FROM users")
+            return cur.fetchall()
+    
+    def check_integrity(self, full=False):
+        """Проверка целостности на отдельном read-only соединении с кэшированием отчета.
+        
+        quick_check не сверяет индексы с таблицами и идет быстро, полный
+        integrity_check - долго, поэтому вызывается из фоновых заданий.
+        Возвращает отчет или None, если проверка уже идет.
+        """
+        if not self._integrity_lock.acquire(blocking=False):
+            return None
         try:
-            self.cursor.execute("""
-                SELECT id FROM loyal_referrals_tracking 
-                WHERE referrer_id = ? AND referral_id = ?
-            """, (referrer_id, referral_id))
-            return self.cursor.fetchone() is not None
-        except Exception as e:
-            logger.error(f"Error checking loyal referral credit: {e}")
+            pragma = "integrity_check" if full else "quick_check"
+            started = time.monotonic()
+            conn = self._connect_reader()
+            try:
+                rows = [row[0] for row in conn.execute(f"PRAGMA {pragma}({INTEGRITY_MAX_ERRORS})")]
+            finally:
+                conn.close()
+            report = {
+                'ok': rows == ['ok'],
+                'errors': [] if rows == ['ok'] else rows,
+                'full': full,
+                'checked_at': datetime.now(),
+                'duration': time.monotonic() - started,
+            }
+            self._integrity['full' if full else 'quick'] = report
+            if report['ok']:
+                logger.info(f"Database {pragma} ok in {report['duration']:.2f}s")
+            else:
+                logger.error(f"Database {pragma} failed: {rows}")
+            return report
+        finally:
+            self._integrity_lock.release()
+    
+    @in_memory
+    def get_integrity_report(self):
+        """Последние результаты быстрой и полной проверки целостности"""
+        return dict(self._integrity)
+    
+    @in_memory
+    def get_channel_member(self, user_id):
+        """(status, joined_ts, left_ts, updated_ts) участника канала или None"""
+        return self.channel_members.get(user_id)
+    
+    @grouped
+    def record_channel_member(self, user_id, status, changed_ts=None):
+        """Сохранение статуса участника канала.
+        
+        changed_ts - момент смены статуса из обновления chat_member; без него это
+        результат запроса к API, и смена статуса датируется моментом наблюдения.
+        Запоздавшие события (старше последнего вступления/выхода) игнорируются.
+        """
+        with self._write() as cur:
+            recorded = self._record_channel_member(cur, user_id, status, changed_ts)
+            self._commit()
+            return recorded
+    
+    def _record_channel_member(self, cur, user_id, status, changed_ts=None):
+        """Запись статуса участника канала в текущей транзакции; False для запоздавшего события"""
+        cur.execute(
+            "SELECT status, joined_ts, left_ts, updated_ts FROM channel_members WHERE user_id = ?", (user_id,)
+        )
+        member = next_channel_member(cur.fetchone(), status, changed_ts, to_epoch())
+        if member is None:
             return False
+        cur.execute(
+            "INSERT OR REPLACE INTO channel_members (user_id, status, joined_ts, left_ts, updated_ts) "
+            "VALUES (?, ?, ?, ?, ?)", (user_id, *member)
+        )
+        self._after_commit(self.channel_members.__setitem__, user_id, member)
+        return True
+    
+    @reader
+    def get_referrals_to_verify(self, before_ts, after_user_id=0, limit=LOYALTY_CHECK_BATCH_SIZE):
+        """Следующая страница (user_id, ref_by) еще не засчитанных рефералов, пришедших до before_ts"""
+        with self._read() as cur:
+            cur.execute(SQL_REFERRALS_TO_VERIFY, (after_user_id, before_ts, limit))
+            return cur.fetchall()
+    
+    def start_loyalty_check(self, cutoff_ts):
+        """Незавершенная проверка (продолжение после перезапуска) или новая с порогом cutoff_ts.
+        
+        Возвращает (check_id, cutoff_ts, last_user_id, счетчики).
+        """
+        with self.transaction() as cur:
+            cur.execute(f"""
+                SELECT check_id, cutoff_ts, last_user_id, {', '.join(LOYALTY_CHECK_COUNTERS)}
+                FROM loyalty_checks WHERE status = 'running' ORDER BY check_id DESC LIMIT 1
+            """)
+            row = cur.fetchone()
+            if row:
+                return row[0], row[1], row[2], dict(zip(LOYALTY_CHECK_COUNTERS, row[3:]))
+            cur.execute(
+                "INSERT INTO loyalty_checks (cutoff_ts, started_ts) VALUES (?, ?)", (cutoff_ts, to_epoch())
+            )
+            return cur.lastrowid, cutoff_ts, 0, dict.fromkeys(LOYALTY_CHECK_COUNTERS, 0)
+    
+    def save_loyalty_check_batch(self, check_id, last_user_id, members, credits, counters):
+        """Результаты пачки одной транзакцией: статусы из API, начисления и контрольная точка.
+        
+        members - [(user_id, status)] полученные из API, credits - [(referrer_id, referral_id)],
+        counters - итоговые счетчики проверки. Возвращает число новых начислений.
+        """
+        with self.transaction() as cur:
+            for user_id, status in members:
+                self._record_channel_member(cur, user_id, status)
+            credited = sum(
+                self._credit_loyal_referral(cur, referrer_id, referral_id) for referrer_id, referral_id in credits
+            )
+            counters = dict(counters, credited=counters['credited'] + credited)
+            cur.execute(f"""
+                UPDATE loyalty_checks SET last_user_id = ?, {', '.join(f'{name} = ?' for name in LOYALTY_CHECK_COUNTERS)}
+                WHERE check_id = ?
+            """, (last_user_id, *(counters[name] for name in LOYALTY_CHECK_COUNTERS), check_id))
+            return credited
+    
+    def finish_loyalty_check(self, check_id):
+        """Отметка о завершении проверки"""
+        with self._write() as cur:
+            cur.execute(
+                "UPDATE loyalty_checks SET status = 'done', finished_ts = ? WHERE check_id = ?", (to_epoch(), check_id)
+            )
+            self._commit()
+    
+    @reader
+    def get_task(self, task_id):
+        """Получение (user_id, task_type) задания"""
+        with self._read() as cur:
+            cur.execute("SELECT user_id, task_type FROM tasks WHERE task_id = ?", (task_id,))
+            return cur.fetchone()
+    
+    @reader
+    def get_task_description(self, task_id):
+        """Текст задания, собранный из шаблона и промокода"""
+        with self._read() as cur:
+            cur.execute("""
+                SELECT t.template_kind, t.promo_code, tt.text, t.task_description
+                FROM tasks_all t
+                LEFT JOIN text_templates tt ON t.template_kind = 'text' AND tt.id = t.template_id
+                WHERE t.task_id = ?
+            """, (task_id,))
+            row = cur.fetchone()
+            return render_task_description(*row) if row else None
+    
+    @reader
+    def get_last_pending_task(self, user_id):
+        """Получение ID последнего ожидающего задания пользователя"""
+        with self._read() as cur:
+            cur.execute(SQL_LAST_PENDING_TASK, (user_id,))
+            row = cur.fetchone()
+            return row[0] if row else None
     
-    def mark_loyal_referral_credited(self, referrer_id, referral_id):
-        """Отмечает, что преданный реферал был начислен"""
+    def create_promo_task(self, user_id, offer_id):
+        """Создание заявки на промо"""
+        with self._write() as cur:
+            now = datetime.now()
+            cur.execute(
+                "INSERT INTO tasks (user_id, task_type, task_description, created_at, created_ts) "
+                "VALUES (?, 'promo', ?, ?, ?)",
+                (user_id, f"offer:{offer_id}", now, to_epoch(now))
+            )
+            task_id = cur.lastrowid
+            cur.execute("UPDATE users SET total_tasks = total_tasks + 1 WHERE user_id = ?", (user_id,))
+            self._after_commit(self.users.increment, user_id, 'total_tasks')
+            self._commit()
+            return task_id
+    
+    def purchase_offer(self, user_id, offer_id):
+        """Покупка промо-оффера: проверка баланса, списание и заявка одной транзакцией.
+        
+        Возвращает (task_id, title, cost), либо None если оффер не найден,
+        либо (None, title, cost) если не хватает преданных рефералов.
+        """
+        with self.transaction() as cur:
+            cur.execute("SELECT title, cost FROM promo_offers WHERE offer_id = ?", (offer_id,))
+            offer = cur.fetchone()
+            if not offer:
+                return None
+            title, cost = offer
+            
+            task_id = self.create_promo_task(user_id, offer_id)
+            # Условное списание: при нехватке баланса заявка откатывается вместе с ним
+            if not self._post_loyalty(cur, user_id, spent=cost, reason='purchase', ref_id=task_id):
+                self._rollback()
+                return None, title, cost
+            return task_id, title, cost
+    
+    def credit_loyal_referral(self, referrer_id, referral_id):
+        """Начисление преданного реферала ровно один раз; True если начислен сейчас"""
+        with self.transaction() as cur:
+            return self._credit_loyal_referral(cur, referrer_id, referral_id)
+    
+    def _credit_loyal_referral(self, cur, referrer_id, referral_id):
+        """Начисление преданного реферала в текущей транзакции"""
+        cur.execute("SELECT 1 FROM users WHERE user_id = ?", (referrer_id,))
+        if not cur.fetchone():
+            return False
+        cur.execute("""
+            INSERT OR IGNORE INTO loyal_referrals_tracking (referrer_id, referral_id)
+            VALUES (?, ?)
+        """, (referrer_id, referral_id))
+        if cur.rowcount == 0:
+            return False
+        return self._post_loyalty(cur, referrer_id, earned=1, reason='referral', ref_id=referral_id)
+    
+    def add_coupon(self, code, coupon_type):
+        """Сохранение выданного купона"""
+        with self._write() as cur:
+            cur.execute("INSERT INTO coupons (code, type) VALUES (?, ?)", (code, coupon_type))
+            self._commit()
+    
+    @reader
+    def get_all_memes(self):
+        """Получение всех мемов"""
+        with self._read() as cur:
+            cur.execute("SELECT id, file_path FROM meme_templates")
+            return cur.fetchall()
+    
+    def add_meme(self, file_path, text=""):
+        """Добавление шаблона мема"""
+        with self._write() as cur:
+            cur.execute("INSERT INTO meme_templates (file_path, text) VALUES (?, ?)", (file_path, text))
+            self._commit()
+        self.memes.invalidate()
+    
+    @reader
+    def get_all_texts(self):
+        """Получение всех текстовых шаблонов"""
+        with self._read() as cur:
+            cur.execute("SELECT id, text FROM text_templates")
+            return cur.fetchall()
+    
+    def add_text(self, text):
+        """Добавление текстового шаблона"""
+        with self._write() as cur:
+            cur.execute("INSERT INTO text_templates (text) VALUES (?)", (text,))
+            self._commit()
+        self.texts.invalidate()
+    
+    def delete_text(self, text_id):
+        """Удаление текстового шаблона"""
+        with self._write() as cur:
+            # Задания со ссылкой на шаблон сохраняют его текст у себя
+            cur.execute("""
+                UPDATE tasks SET task_description = (SELECT text FROM text_templates WHERE id = ?),
+                                 template_id = NULL, template_kind = NULL
+                WHERE template_kind = 'text' AND template_id = ?
+            """, (text_id, text_id))
+            cur.execute("DELETE FROM text_templates WHERE id = ?", (text_id,))
+            self._commit()
+        self.texts.invalidate()
+    
+    @reader
+    def get_all_chats(self):
+        """Получение всех чатов, отсортированных по имени"""
+        with self._read() as cur:
+            cur.execute("SELECT chat_username FROM allowed_chats ORDER BY chat_username")
+            return [row[0] for row in cur.fetchall()]
+    
+    def add_chat(self, chat_username):
+        """Добавление разрешенного чата"""
+        with self._write() as cur:
+            cur.execute("INSERT OR IGNORE INTO allowed_chats (chat_username) VALUES (?)", (chat_username,))
+            self._commit()
+        self.chats.invalidate()
+    
+    def delete_chat(self, chat_username):
+        """Удаление разрешенного чата"""
+        with self._write() as cur:
+            cur.execute("DELETE FROM allowed_chats WHERE chat_username = ?", (chat_username,))
+            self._commit()
+        self.chats.invalidate()
+    
+    @reader
+    def get_promo_offers(self):
+        """Получение списка промо-офферов"""
+        with self._read() as cur:
+            cur.execute("SELECT offer_id, title, cost FROM promo_offers")
+            return cur.fetchall()
+    
+    @reader
+    def get_promo_offer(self, offer_id):
+        """Получение (title, cost) промо-оффера"""
+        with self._read() as cur:
+            cur.execute("SELECT title, cost FROM promo_offers WHERE offer_id = ?", (offer_id,))
+            return cur.fetchone()
+    
+    def add_promo_offer(self, title, cost):
+        """Добавление промо-оффера"""
+        with self._write() as cur:
+            cur.execute("INSERT INTO promo_offers (title, cost) VALUES (?, ?)", (title, cost))
+            self._commit()
+    
+    def delete_promo_offer(self, offer_id):
+        """Удаление промо-оффера"""
+        with self._write() as cur:
+            cur.execute("DELETE FROM promo_offers WHERE offer_id = ?", (offer_id,))
+            self._commit()
+    
+    def backup_to(self, target, pages=256, pause=0.005):
+        """Онлайн-копия базы в соединение target шагами по pages страниц.
+        
+        Блокировка писателя держится только на время шага. Между шагами записи
+        идут через то же соединение-источник и сразу попадают в копию, поэтому
+        бэкап не перезапускается и не тормозит пользователей.
+        """
+        def between_steps(status, remaining, total):
+            self._write_lock.release()
+            try:
+                time.sleep(pause)
+            finally:
+                self._write_lock.acquire()
+        
+        with self._write_lock:
+            self.conn.backup(target, pages=pages, progress=between_steps)
+    
+    def archive_tasks(self, older_than_days=TASK_ARCHIVE_DAYS, batch_size=TASK_ARCHIVE_BATCH_SIZE):
+        """Перенос давно решенных заданий в tasks_archive небольшими пачками.
+        
+        Между пачками блокировка писателя отпускается, чтобы задания пользователей
+        не ждали архиватор. Освободившиеся страницы отдаются через incremental_vacuum.
+        """
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+        moved = 0
+        while True:
+            with self._write() as cur:
+                cur.execute("""
+                    SELECT task_id FROM tasks
+                    WHERE status IN ('approved', 'declined') AND decided_at < ?
+                    LIMIT ?
+                """, (cutoff, batch_size))
+                ids = [row[0] for row in cur.fetchall()]
+                if not ids:
+                    break
+                placeholders = ','.join('?' * len(ids))
+                cur.execute(
+                    f"INSERT OR REPLACE INTO tasks_archive ({TASK_COLUMNS}) "
+                    f"SELECT {TASK_COLUMNS} FROM tasks WHERE task_id IN ({placeholders})",
+                    ids
+                )
+                cur.execute(f"DELETE FROM tasks WHERE task_id IN ({placeholders})", ids)
+                self._commit()
+                moved += len(ids)
+        
+        with self._write() as cur:
+            cur.execute("PRAGMA freelist_count")
+            free_pages = cur.fetchone()[0]
+            cur.execute("PRAGMA incremental_vacuum")
+            cur.fetchall()
+        
+        if moved:
+            logger.info(f"Archived {moved} tasks, released {free_pages} free pages")
+        return moved
+    
+    def checkpoint(self, mode='PASSIVE'):
+        """PRAGMA wal_checkpoint на отдельном соединении, не занимая блокировку писателя.
+        
+        Возвращает (busy, кадров в WAL, перенесено кадров в базу).
+        """
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError(f"Unknown checkpoint mode: {mode}")
+        with self._checkpoint_lock:
+            if self._checkpoint_conn is None:
+                self._checkpoint_conn = sqlite3.connect(
+                    self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+                )
+            return tuple(self._checkpoint_conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+    
+    def wal_size(self):
+        """Размер WAL-файла в байтах"""
         try:
-            self.cursor.execute("""
-                INSERT INTO loyal_referrals_tracking (referrer_id, referral_id)
-                VALUES (?, ?)
-            """, (referrer_id, referral_id))
-            self.conn.commit()
-            logger.info(f"Marked loyal referral credited: {referrer_id} <- {referral_id}")
-        except Exception as e:
-            logger.error(f"Error marking loyal referral credited: {e}")
-            self.conn.rollback()
+            return os.path.getsize(self.path + "-wal")
+        except OSError:
+            return 0
     
     def close(self):
-        """Закрытие соединения с базой данных"""
+        """Закрытие соединений с базой данных с финальным checkpoint"""
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        with self._checkpoint_lock:
+            if self._checkpoint_conn is not None:
+                self._checkpoint_conn.close()
+                self._checkpoint_conn = None
         if hasattr(self, 'conn'):
+            try:
+                busy, frames, moved = self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                logger.info(f"Final WAL checkpoint: {moved}/{frames} frames, busy={busy}")
+            except sqlite3.Error as e:
+                logger.warning(f"Final WAL checkpoint failed: {e}")
             self.conn.close()
 
+def _resolve(future, ok, value):
+    """Передача результата записи в ожидающую корутину"""
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+class AsyncDatabase:
+    """Асинхронный фасад над хранилищем (Database или storage.MemoryStorage).
+    
+    Записи ставятся в очередь выделенного потока-писателя, чтения
+    выполняются параллельно на пуле потоков по числу соединений-читателей,
+    поэтому event loop не блокируется на запросах и commit'ах.
+    Записи, помеченные @grouped, копятся до group_commit_ms или max_rows
+    и коммитятся одной транзакцией; каждый вызов завершается после ее COMMIT.
+    """
+    
+    def __init__(self, database, readers=DB_READERS,
+                 group_commit_ms=DB_GROUP_COMMIT_MS, max_rows=DB_GROUP_COMMIT_MAX_ROWS):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        self._read_executor = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix='db-read')
+        self._window = max(0, group_commit_ms) / 1000
+        self._max_rows = max_rows
+        self._batch_queue = queue.Queue()
+        self._batch_thread = None
+        if max_rows > 1:
+            self._batch_thread = threading.Thread(
+                target=self._batch_loop, name='db-group-commit', daemon=True
+            )
+            self._batch_thread.start()
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполнение произвольной функции в потоке-писателе БД"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def run_read(self, func, *args, **kwargs):
+        """Выполнение читающей функции на пуле читателей"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, functools.partial(func, *args, **kwargs))
+    
+    async def run_grouped(self, func, *args, **kwargs):
+        """Запись через групповой коммит; результат приходит после COMMIT всей пачки"""
+        if self._batch_thread is None:
+            return await self.run(func, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch_queue.put((loop, future, func, args, kwargs))
+        return await future
+    
+    def _batch_loop(self):
+        """Поток группового коммита: собирает записи в пачки и коммитит их"""
+        while True:
+            job = self._batch_queue.get()
+            if job is None:
+                return
+            batch = [job]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_rows:
+                try:
+                    job = self._batch_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._flush(batch)
+                    return
+                batch.append(job)
+            self._flush(batch)
+    
+    def _flush(self, batch):
+        """Коммит пачки и передача результатов вызывающим"""
+        try:
+            results = self._db.run_batch([(func, args, kwargs) for _, _, func, args, kwargs in batch])
+        except Exception as e:
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            results = [(False, e)] * len(batch)
+        for (loop, future, *_), (ok, value) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(_resolve, future, ok, value)
+            except RuntimeError:
+                # Event loop уже закрыт: ждать результат некому
+                pass
+    
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        if getattr(attr, 'in_memory', False):
+            # Чтение из зеркала в памяти: без потоков, сразу в event loop
+            @functools.wraps(attr)
+            async def method(*args, **kwargs):
+                return attr(*args, **kwargs)
+            setattr(self, name, method)
+            return method
+        if getattr(attr, 'is_reader', False):
+            run = self.run_read
+        elif getattr(attr, 'is_grouped', False):
+            run = self.run_grouped
+        else:
+            run = self.run
+        
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await run(attr, *args, **kwargs)
+        
+        # Кэшируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, method)
+        return method
+    
+    def close(self):
+        """Остановка потоков БД и закрытие соединения"""
+        if self._batch_thread is not None:
+            self._batch_queue.put(None)
+            self._batch_thread.join()
+        self._executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self._db.close()
+
 # Глобальный экземпляр базы данных
-db = Database() 
\ No newline at end of file
+db = Database()
+
+# Асинхронный доступ к базе данных для обработчиков
+async_db = AsyncDatabase(db)
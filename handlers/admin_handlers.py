@@ -1,11 +1,15 @@
 import os
 import csv
+import html
 from datetime import datetime, timedelta
 from telegram import Update
 from telegram.constants import ParseMode, ChatType
 from telegram.ext import ContextTypes
 from config import ADMIN_IDS, logger, SCREENSHOTS_DIR, MEMES_DIR
-from database import db
+from database import async_db
+from backup import snapshot, SnapshotInProgress
+from maintenance import checkpoints
+from analytics import parse_mode, source_for
 from keyboards import (
     get_admin_reply_keyboard, get_content_reply_keyboard, get_promo_reply_keyboard,
     get_back_inline_keyboard, get_task_approval_keyboard, get_users_file_keyboard,
@@ -72,8 +76,7 @@ async def content_delete_meme_handler(update: Update, context: ContextTypes.DEFA
     await update.message.delete()
     
     # Получаем список мемов
-    db.cursor.execute("SELECT id, file_path FROM meme_templates")
-    memes = db.cursor.fetchall()
+    memes = await async_db.get_all_memes()
     
     if not memes:
         await update.message.reply_text("Нет мемов для удаления.", reply_markup=get_back_inline_keyboard())
@@ -96,8 +99,7 @@ async def content_list_chats_handler(update: Update, context: ContextTypes.DEFAU
     
     await update.message.delete()
     
-    db.cursor.execute("SELECT chat_username FROM allowed_chats ORDER BY RANDOM()")
-    chats = [row[0] for row in db.cursor.fetchall()]
+    chats = await async_db.get_all_chats()
     
     if not chats:
         await update.message.reply_text("Список чатов пуст.", reply_markup=get_back_inline_keyboard())
@@ -123,8 +125,7 @@ async def content_delete_chat_handler(update: Update, context: ContextTypes.DEFA
     await update.message.delete()
     
     # Получаем чаты в отсортированном порядке
-    db.cursor.execute("SELECT chat_username FROM allowed_chats ORDER BY chat_username")
-    chats = [row[0] for row in db.cursor.fetchall()]
+    chats = await async_db.get_all_chats()
     
     # Сохраняем упорядоченный список для удаления
     context.user_data['delete_chats_list'] = chats
@@ -157,8 +158,7 @@ async def content_list_texts_handler(update: Update, context: ContextTypes.DEFAU
     
     await update.message.delete()
     
-    db.cursor.execute("SELECT id, text FROM text_templates")
-    rows = db.cursor.fetchall()
+    rows = await async_db.get_all_texts()
     
     if not rows:
         await update.message.reply_text("Список текстов пуст.", reply_markup=get_back_inline_keyboard())
@@ -200,8 +200,7 @@ async def promo_delete_offer_handler(update: Update, context: ContextTypes.DEFAU
     
     await update.message.delete()
     
-    db.cursor.execute("SELECT offer_id, title, cost FROM promo_offers")
-    rows = db.cursor.fetchall()
+    rows = await async_db.get_promo_offers()
     
     if not rows:
         await update.message.reply_text("Нет офферов для удаления.", reply_markup=get_back_inline_keyboard())
@@ -222,8 +221,7 @@ async def promo_list_offers_handler(update: Update, context: ContextTypes.DEFAUL
     
     await update.message.delete()
     
-    db.cursor.execute("SELECT offer_id, title, cost FROM promo_offers")
-    rows = db.cursor.fetchall()
+    rows = await async_db.get_promo_offers()
     
     if not rows:
         await update.message.reply_text("Список офферов пуст.", reply_markup=get_back_inline_keyboard())
@@ -242,31 +240,35 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     today_start, week_start = get_date_range()
     
+    # По умолчанию считаем по снимку, "/stats live" - по рабочей базе
+    mode = parse_mode(context.args)
+    source, source_label = await source_for(mode)
+    
     # Всего пользователей
-    db.cursor.execute("SELECT COUNT(*) FROM users")
-    total = db.cursor.fetchone()[0]
+    total = await source.count_users()
     
     # Пришло сегодня
-    db.cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE joined_date >= ?",
-        (today_start.isoformat(),)
-    )
-    today_count = db.cursor.fetchone()[0]
+    today_count = await source.count_users_joined_since(today_start)
     
     # Пришло за неделю
-    db.cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE joined_date >= ?",
-        (week_start.isoformat(),)
-    )
-    week_count = db.cursor.fetchone()[0]
+    week_count = await source.count_users_joined_since(week_start)
     
-    text = get_stats_text(today_count, week_count, total)
+    text = get_stats_text(today_count, week_count, total) + f"\n\n{source_label}"
     await update.message.reply_text(
         text, 
         parse_mode=ParseMode.HTML, 
-        reply_markup=get_users_file_keyboard()
+        reply_markup=get_users_file_keyboard(mode)
     )
 
+def format_integrity(report):
+    """Строка отчета о проверке целостности для /db_status"""
+    if report is None:
+        return "⏳ еще не выполнялась"
+    checked = report['checked_at'].strftime('%d.%m %H:%M')
+    if report['ok']:
+        return f"✅ OK ({checked}, {report['duration']:.1f} с)"
+    return f"❌ ОШИБКА ({checked}): {html.escape(report['errors'][0])}"
+
 async def check_db_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Проверка состояния базы данных (только для админов)"""
     if not is_admin(update.effective_user.id):
@@ -276,42 +278,96 @@ async def check_db_status(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     try:
         # Проверяем размер файла БД
-        import os
-        db_size = os.path.getsize('bot_database.db')
+        db_size = os.path.getsize(async_db.path)
+        
+        # Пользователи считаются по снимку, если не указан режим live
+        source, source_label = await source_for(parse_mode(context.args))
         
         # Проверяем количество пользователей
-        db.cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = db.cursor.fetchone()[0]
+        user_count = await source.count_users()
         
         # Проверяем последних пользователей
-        db.cursor.execute("""
-            SELECT user_id, username, joined_date 
-            FROM users 
-            ORDER BY joined_date DESC 
-            LIMIT 3
-        """)
-        recent_users = db.cursor.fetchall()
+        recent_users = await source.get_recent_users(3)
+        
+        # Целостность проверяется фоновыми заданиями, здесь только кэш отчета
+        integrity = await async_db.get_integrity_report()
         
-        # Проверяем целостность БД
-        db.cursor.execute("PRAGMA integrity_check")
-        integrity_result = db.cursor.fetchone()
+        # Ожидание блокировки записи (BEGIN IMMEDIATE)
+        lock_stats = await async_db.get_lock_stats()
+        
+        # Размер WAL и работа планировщика checkpoint'ов
+        wal_stats = checkpoints.get_stats()
+        last_checkpoint = (
+            f"{wal_stats['last_mode']} {wal_stats['last_at'].strftime('%H:%M:%S')}, "
+            f"{wal_stats['last_duration'] * 1000:.1f} мс"
+            if wal_stats['last_at'] else "не было"
+        )
+        
+        # Самые затратные запросы по суммарному времени
+        top_queries, slow_queries = await async_db.get_query_stats(5)
         
         status_text = (
             f"📊 <b>СОСТОЯНИЕ БАЗЫ ДАННЫХ</b>\n\n"
             f"📁 Размер файла: {db_size:,} байт\n"
             f"👥 Пользователей: {user_count}\n"
-            f"🔍 Целостность: {'✅ OK' if integrity_result[0] == 'ok' else '❌ ОШИБКА'}\n\n"
+            f"🔍 Целостность (быстрая): {format_integrity(integrity['quick'])}\n"
+            f"🔍 Целостность (полная): {format_integrity(integrity['full'])}\n"
+            f"🔒 Транзакций: {lock_stats['transactions']}, повторов: {lock_stats['retries']}, "
+            f"отказов: {lock_stats['failures']}\n"
+            f"⏳ Ожидание блокировки: среднее {lock_stats['wait_avg'] * 1000:.1f} мс, "
+            f"макс {lock_stats['wait_max'] * 1000:.1f} мс\n"
+            f"📝 WAL: {wal_stats['wal_size']:,} байт (макс {wal_stats['wal_max']:,}), "
+            f"checkpoint'ов PASSIVE/FULL/RESTART/TRUNCATE: {wal_stats['passive']}/{wal_stats['full']}/"
+            f"{wal_stats['restart']}/{wal_stats['truncate']}, "
+            f"последний: {last_checkpoint}\n\n"
             f"📅 <b>Последние пользователи:</b>\n"
         )
         
         for user_id, username, joined_date in recent_users:
             status_text += f"   {user_id} (@{username or 'нет'}) - {joined_date}\n"
+        status_text += f"{source_label}\n"
+        
+        if top_queries:
+            status_text += f"\n🐢 <b>Тяжелые запросы</b> (медленных: {len(slow_queries)}):\n"
+            for stat in top_queries:
+                status_text += (
+                    f"   <code>{html.escape(stat['query'][:80])}</code>\n"
+                    f"   {stat['count']} раз, всего {stat['total'] * 1000:.0f} мс, "
+                    f"p50/p95/p99 {stat['p50'] * 1000:.1f}/{stat['p95'] * 1000:.1f}/{stat['p99'] * 1000:.1f} мс, "
+                    f"строк {stat['rows']}\n"
+                )
         
         await update.message.reply_text(status_text, parse_mode=ParseMode.HTML)
         
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка проверки БД: {e}")
 
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Снимок базы данных по запросу (только для админов)"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    await update.message.delete()
+    progress = await update.message.reply_text("💾 Создаю снимок базы данных...")
+    
+    try:
+        path, duration, size = await snapshot()
+    except SnapshotInProgress:
+        await progress.edit_text("⏳ Снимок уже создается, попробуйте позже.")
+        return
+    except Exception as e:
+        logger.error(f"Snapshot failed: {e}")
+        await progress.edit_text(f"❌ Ошибка создания снимка: {e}")
+        return
+    
+    await progress.edit_text(
+        f"✅ <b>Снимок готов</b>\n\n"
+        f"📁 Файл: <code>{os.path.basename(path)}</code>\n"
+        f"📦 Размер: {size:,} байт\n"
+        f"⏱ Время: {duration:.2f} с",
+        parse_mode=ParseMode.HTML
+    )
+
 async def send_users_file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик отправки файла пользователей"""
     query = update.callback_query
@@ -323,9 +379,12 @@ async def send_users_file_handler(update: Update, context: ContextTypes.DEFAULT_
     
     await query.answer()
     
+    # Режим источника передается в callback_data кнопки: get_users_file|live
+    mode = parse_mode(query.data.split('|')[1:])
+    source, _ = await source_for(mode)
+    
     # Получаем список пользователей
-    db.cursor.execute("SELECT user_id, username, first_name, last_name, ref_by, joined_date FROM users")
-    rows = db.cursor.fetchall()
+    rows = await source.export_users()
     
     # Готовим CSV
     export_dir = "exports"
@@ -368,7 +427,7 @@ async def handle_admin_broadcast_message(update: Update, context: ContextTypes.D
     sent, errors = 0, 0
     
     if mode == 'all':
-        users = db.get_all_users()
+        users = await async_db.get_all_users()
         for uid in users:
             try:
                 if photo:
@@ -402,7 +461,7 @@ async def handle_admin_broadcast_message(update: Update, context: ContextTypes.D
             return
         
         uname, body = parts
-        uid = db.get_user_by_username(uname.lstrip('@'))
+        uid = await async_db.get_user_by_username(uname.lstrip('@'))
         
         if not uid:
             await update.message.reply_text("Пользователь не найден.")
@@ -459,11 +518,10 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = context.user_data['task_user_id']
         
         # Обновляем статус задания
-        db.approve_task(task_id, user_id)
+        await async_db.approve_task(task_id, user_id)
         
         # Сохраняем купон
-        db.cursor.execute("INSERT INTO coupons (code, type) VALUES (?, ?)", (code, 'promo'))
-        db.conn.commit()
+        await async_db.add_coupon(code, 'promo')
         
         # Уведомляем пользователя
         await context.bot.send_message(
@@ -487,11 +545,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await file.download_to_drive(path)
         
         # Сохраняем в БД с пустым текстом
-        db.cursor.execute(
-            "INSERT INTO meme_templates (file_path, text) VALUES (?, ?)",
-            (path, "")
-        )
-        db.conn.commit()
+        await async_db.add_meme(path, "")
         
         await update.message.reply_text("✅ Мем добавлен.", reply_markup=get_back_inline_keyboard())
         context.user_data['content_stage'] = None
@@ -502,7 +556,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text = update.message.text.strip()
         if text.isdigit():
             meme_id = int(text)
-            if db.delete_meme(meme_id):
+            if await async_db.delete_meme(meme_id):
                 await update.message.reply_text("✅ Мем удалён из базы данных и файл удалён.", reply_markup=get_back_inline_keyboard())
             else:
                 await update.message.reply_text("❌ Мем с таким ID не найден.", reply_markup=get_back_inline_keyboard())
@@ -524,8 +578,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
         
-        db.cursor.execute("INSERT OR IGNORE INTO allowed_chats (chat_username) VALUES (?)", (chat,))
-        db.conn.commit()
+        await async_db.add_chat(chat)
         await update.message.reply_text(f"✅ Чат {chat} добавлен.", reply_markup=get_back_inline_keyboard())
         context.user_data['content_stage'] = None
         return
@@ -537,8 +590,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         if 0 <= idx < len(chats):
             removed = chats[idx]
-            db.cursor.execute("DELETE FROM allowed_chats WHERE chat_username = ?", (removed,))
-            db.conn.commit()
+            await async_db.delete_chat(removed)
             await update.message.reply_text(f"✅ Чат {removed} удалён.", reply_markup=get_back_inline_keyboard())
         else:
             await update.message.reply_text(
@@ -557,8 +609,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             title, cost_str = [s.strip() for s in text.split('—', 1)]
             if cost_str.isdigit():
                 cost = int(cost_str)
-                db.cursor.execute("INSERT INTO promo_offers (title, cost) VALUES (?, ?)", (title, cost))
-                db.conn.commit()
+                await async_db.add_promo_offer(title, cost)
                 await update.message.reply_text(
                     f"✅ Оффер '{title}' за {cost} преданных добавлен.", 
                     reply_markup=get_back_inline_keyboard()
@@ -579,8 +630,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Удаление промо-оффера по ID
     if context.user_data.get('promo_stage') == PROMO_STAGE_DELETE and update.message and update.message.text.isdigit():
         oid = int(update.message.text.strip())
-        db.cursor.execute("DELETE FROM promo_offers WHERE offer_id = ?", (oid,))
-        db.conn.commit()
+        await async_db.delete_promo_offer(oid)
         await update.message.reply_text(f"✅ Оффер {oid} удалён.", reply_markup=get_back_inline_keyboard())
         context.user_data['promo_stage'] = None
         return
@@ -590,8 +640,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text_id = update.message.text.strip()
         if text_id.isdigit():
             tid = int(text_id)
-            db.cursor.execute("DELETE FROM text_templates WHERE id = ?", (tid,))
-            db.conn.commit()
+            await async_db.delete_text(tid)
             await update.message.reply_text("✅ Текст удалён.", reply_markup=get_back_inline_keyboard())
             context.user_data['content_stage'] = None
         else:
@@ -604,8 +653,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Добавление текста
     if content_stage == CONTENT_STAGE_ADD_TEXT and update.message:
         text = getattr(update.message, "text_html", None) or update.message.text or ""
-        db.cursor.execute("INSERT INTO text_templates (text) VALUES (?)", (text,))
-        db.conn.commit()
+        await async_db.add_text(text)
         await update.message.reply_text("✅ Текст добавлен.", reply_markup=get_back_inline_keyboard())
         context.user_data['content_stage'] = None
         return
@@ -689,7 +737,8 @@ async def debug_subscription_command(update: Update, context: ContextTypes.DEFAU
         # Формируем отчет
         report = f"🔍 <b>Диагностика подписки</b>\n\n"
         report += f"👤 <b>Пользователь:</b> {user_id}\n"
-        report += f"📢 <b>Канал:</b> {debug_info['channel_id']}\n\n"
+        report += f"📢 <b>Канал:</b> {debug_info['channel_id']}\n"
+        report += f"🔌 <b>Предохранитель проверок:</b> {debug_info['circuit']}\n\n"
         
         if debug_info['error']:
             report += f"❌ <b>Ошибка:</b> {debug_info['error']}\n"
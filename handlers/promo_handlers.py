@@ -2,7 +2,7 @@ from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from config import ADMIN_IDS, logger
-from database import db
+from database import async_db
 from keyboards import (
     get_promo_choose_keyboard, get_promo_offers_keyboard, get_promo_confirm_keyboard,
     get_gift_keyboard, get_back_inline_keyboard
@@ -40,8 +40,7 @@ async def promo_choose_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.message.delete()
     
     # Получаем список офферов
-    db.cursor.execute("SELECT offer_id, title, cost FROM promo_offers")
-    rows = db.cursor.fetchall()
+    rows = await async_db.get_promo_offers()
     
     if not rows:
         await query.message.reply_text(
@@ -80,8 +79,7 @@ async def promo_offer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     _, oid = query.data.split('|', 1)
     
     # Получаем данные оффера
-    db.cursor.execute("SELECT title, cost FROM promo_offers WHERE offer_id = ?", (oid,))
-    row = db.cursor.fetchone()
+    row = await async_db.get_promo_offer(oid)
     
     if not row:
         await query.message.reply_text(
@@ -94,7 +92,7 @@ async def promo_offer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = query.from_user.id
     
     # Подсчитываем доступные преданные рефералы
-    user_stats = db.get_user_stats(user_id)
+    user_stats = await async_db.get_user_stats(user_id)
     if not user_stats:
         await query.message.reply_text("Ошибка получения данных пользователя.")
         return
@@ -142,51 +140,23 @@ async def promo_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     
     _, oid = query.data.split('|', 1)
+    user_id = query.from_user.id
     
-    # Получаем данные оффера
-    db.cursor.execute("SELECT title, cost FROM promo_offers WHERE offer_id = ?", (oid,))
-    row = db.cursor.fetchone()
+    # Проверка баланса, списание и заявка - одной транзакцией
+    result = await async_db.purchase_offer(user_id, oid)
     
-    if not row:
+    if not result:
         await query.message.reply_text(
             "Ошибка: оффер не найден.", 
             reply_markup=get_back_inline_keyboard()
         )
         return
     
-    title, cost = row
-    user_id = query.from_user.id
-    
-    # Пересчитываем доступные
-    user_stats = db.get_user_stats(user_id)
-    if not user_stats:
-        await query.message.reply_text("Ошибка получения данных пользователя.")
-        return
-    
-    total_loyal = user_stats['loyal_referrals']
-    used_loyal = user_stats['used_loyal']
-    available = max(0, total_loyal - used_loyal)  # Защита от отрицательных значений
+    task_id, title, cost = result
     
-    if available < cost:
+    if task_id is None:
         await query.answer("Недостаточно преданных рефералов.", show_alert=True)
         return
-    
-    # Списываем стоимость с преданных рефералов пользователя
-    db.cursor.execute(
-        "UPDATE users SET used_loyal = used_loyal + ? WHERE user_id = ?",
-        (cost, user_id)
-    )
-    db.conn.commit()
-    
-    # Создаем задание на промо
-    from datetime import datetime
-    now = datetime.now()
-    db.cursor.execute(
-        "INSERT INTO tasks (user_id, task_type, task_description, created_at) VALUES (?, 'promo', ?, ?)",
-        (user_id, f"offer:{oid}", now)
-    )
-    task_id = db.cursor.lastrowid
-    db.conn.commit()
 
     # Уведомляем всех админов о новой заявке на промо
     for admin_id in ADMIN_IDS:
@@ -244,7 +214,7 @@ async def receive_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.delete()
 
     # Проверяем, что не свой собственный код
-    user_stats = db.get_user_stats(user_id)
+    user_stats = await async_db.get_user_stats(user_id)
     if not user_stats:
         await context.bot.send_message(
             chat_id=user_id,
@@ -261,7 +231,7 @@ async def receive_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     # Ищем владельца кода
-    owner_id = db.get_user_by_promo_code(code)
+    owner_id = await async_db.get_user_by_promo_code(code)
     if not owner_id:
         await context.bot.send_message(
             user_id, 
@@ -270,8 +240,7 @@ async def receive_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     # Проверяем, что реферал еще не привязан
-    db.cursor.execute("SELECT ref_by FROM users WHERE user_id = ?", (user_id,))
-    ref_by = db.cursor.fetchone()[0]
+    ref_by = await async_db.get_ref_by(user_id)
     
     if ref_by is not None:
         await context.bot.send_message(
@@ -281,9 +250,7 @@ async def receive_promo_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     # Сохраняем реферера и увеличиваем счетчик
-    db.cursor.execute("UPDATE users SET ref_by = ? WHERE user_id = ?", (owner_id, user_id))
-    db.cursor.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?", (owner_id,))
-    db.conn.commit()
+    await async_db.set_referrer(user_id, owner_id)
 
     # Планируем проверку лояльности через 3 дня
     from handlers.user_handlers import credit_loyal_referral
@@ -5,13 +5,13 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from telegram.error import BadRequest
 from config import ADMIN_IDS, SCREENSHOTS_DIR, logger
-from database import db
+from database import async_db
 from keyboards import (
     get_participate_keyboard, get_back_inline_keyboard, get_task_control_keyboard,
     create_task_keyboard_with_chats
 )
 from utils import (
-    format_task_panel, format_task_text, make_chat_url
+    format_task_panel, format_task_text, make_chat_url, REPOST_TASK_TEXT
 )
 
 async def show_participate_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -47,7 +47,7 @@ async def handle_task_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         pass
 
     # Получаем случайный шаблон мема
-    meme_data = db.get_random_meme()
+    meme_data = await async_db.get_random_meme(query.from_user.id)
     if not meme_data:
         await query.message.reply_text("Шаблонов мемов пока нет.")
         return
@@ -55,7 +55,7 @@ async def handle_task_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     tpl_id, file_path = meme_data
 
     # Формируем панель с личным промокодом
-    user_stats = db.get_user_stats(query.from_user.id)
+    user_stats = await async_db.get_user_stats(query.from_user.id)
     if not user_stats:
         await query.message.reply_text("Ошибка получения данных пользователя.")
         return
@@ -63,7 +63,7 @@ async def handle_task_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     panel = format_task_panel(user_stats['promo_code'])
 
     # Регистрируем задачу в БД
-    task_id = db.create_task(query.from_user.id, 'meme', panel)
+    task_id = await async_db.create_task(query.from_user.id, 'meme', tpl_id)
 
     # Отправляем сам мем
     if os.path.exists(file_path):
@@ -78,7 +78,7 @@ async def handle_task_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     # Получаем случайные чаты
-    chats = db.get_random_chats(limit=5)
+    chats = await async_db.get_random_chats(limit=5)
     if not chats:
         await query.message.reply_text("Нет доступных чатов.")
         return
@@ -106,7 +106,7 @@ async def handle_task_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         pass
 
     # Получаем случайный шаблон текста
-    text_data = db.get_random_text()
+    text_data = await async_db.get_random_text(query.from_user.id)
     if not text_data:
         await query.message.reply_text("Шаблонов текста пока нет.")
         return
@@ -114,10 +114,10 @@ async def handle_task_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     tpl_id, txt = text_data
 
     # Регистрируем задачу в БД
-    task_id = db.create_task(query.from_user.id, 'text', txt)
+    task_id = await async_db.create_task(query.from_user.id, 'text', tpl_id)
 
     # Получаем промокод пользователя
-    user_stats = db.get_user_stats(query.from_user.id)
+    user_stats = await async_db.get_user_stats(query.from_user.id)
     if not user_stats:
         await query.message.reply_text("Ошибка получения данных пользователя.")
         return
@@ -132,7 +132,7 @@ async def handle_task_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     context.user_data['last_task_content_msg_id'] = content_msg.message_id
 
     # Получаем случайные чаты
-    chats = db.get_random_chats(limit=5)
+    chats = await async_db.get_random_chats(limit=5)
     if not chats:
         await query.message.reply_text("Нет доступных чатов.")
         return
@@ -164,7 +164,7 @@ async def handle_task_other_text(update: Update, context: ContextTypes.DEFAULT_T
                 pass
     
     # Получаем случайный шаблон текста
-    text_data = db.get_random_text()
+    text_data = await async_db.get_random_text(query.from_user.id)
     if not text_data:
         await query.message.reply_text("Шаблонов текста пока нет.")
         return
@@ -172,7 +172,7 @@ async def handle_task_other_text(update: Update, context: ContextTypes.DEFAULT_T
     tpl_id, txt = text_data
 
     # Получаем промокод пользователя
-    user_stats = db.get_user_stats(query.from_user.id)
+    user_stats = await async_db.get_user_stats(query.from_user.id)
     if not user_stats:
         await query.message.reply_text("Ошибка получения данных пользователя.")
         return
@@ -187,7 +187,7 @@ async def handle_task_other_text(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data['last_task_content_msg_id'] = content_msg.message_id
 
     # Получаем случайные чаты
-    chats = db.get_random_chats(limit=5)
+    chats = await async_db.get_random_chats(limit=5)
     if not chats:
         await query.message.reply_text("Нет доступных чатов.")
         return
@@ -219,7 +219,7 @@ async def handle_task_other_meme(update: Update, context: ContextTypes.DEFAULT_T
                 pass
 
     # Получаем случайный шаблон мема
-    meme_data = db.get_random_meme()
+    meme_data = await async_db.get_random_meme(query.from_user.id)
     if not meme_data:
         await query.message.reply_text("Шаблонов мемов пока нет.")
         return
@@ -227,7 +227,7 @@ async def handle_task_other_meme(update: Update, context: ContextTypes.DEFAULT_T
     tpl_id, file_path = meme_data
 
     # Формируем панель с личным промокодом
-    user_stats = db.get_user_stats(query.from_user.id)
+    user_stats = await async_db.get_user_stats(query.from_user.id)
     if not user_stats:
         await query.message.reply_text("Ошибка получения данных пользователя.")
         return
@@ -247,7 +247,7 @@ async def handle_task_other_meme(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     # Получаем случайные чаты
-    chats = db.get_random_chats(limit=5)
+    chats = await async_db.get_random_chats(limit=5)
     if not chats:
         await query.message.reply_text("Нет доступных чатов.")
         return
@@ -267,10 +267,10 @@ async def handle_task_repost(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.message.delete()
     
-    txt = "Пожалуйста, сделайте репост нашего канала @ambsharing в одном из чатов ниже:"
-    task_id = db.create_task(query.from_user.id, 'repost', txt)
+    txt = REPOST_TASK_TEXT
+    task_id = await async_db.create_task(query.from_user.id, 'repost')
     
-    chats = db.get_random_chats()
+    chats = await async_db.get_random_chats()
     if not chats:
         await query.message.reply_text("Нет доступных чатов.")
         return
@@ -299,7 +299,7 @@ async def handle_task_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     # Отменяем задание и уменьшаем счетчик
     user_id = query.from_user.id
-    db.cancel_task(user_id)
+    await async_db.cancel_task(user_id)
 
 async def handle_task_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик завершения задания"""
@@ -355,24 +355,18 @@ async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     # Находим последнее ожидающее задание
-    db.cursor.execute(
-        "SELECT task_id FROM tasks WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
-        (user.id,)
-    )
-    row = db.cursor.fetchone()
-    if not row:
+    task_id = await async_db.get_last_pending_task(user.id)
+    if not task_id:
         await update.message.reply_text("Нет активных заданий.")
         return
     
-    task_id = row[0]
-    
     # Сохраняем фото
     os.makedirs(SCREENSHOTS_DIR, exist_ok=True)
     path = os.path.join(SCREENSHOTS_DIR, f"{task_id}.jpg")
     await photo_file.download_to_drive(path)
     
     # Обновляем задание
-    db.update_screenshot_path(task_id, path)
+    await async_db.update_screenshot_path(task_id, path)
     
     # Подтверждаем получение пользователю
     await update.message.reply_text(
@@ -411,7 +405,7 @@ async def check_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.delete()
     
     # Получаем следующее ожидающее задание со скриншотом
-    row = db.get_pending_tasks()
+    row = await async_db.get_pending_tasks()
     if not row:
         from keyboards import ReplyKeyboardMarkup, KeyboardButton
         await context.bot.send_message(
@@ -424,8 +418,7 @@ async def check_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     task_id, task_user_id, screenshot_path, created_at = row
     
     # Получаем username
-    db.cursor.execute("SELECT username FROM users WHERE user_id = ?", (task_user_id,))
-    uname = db.cursor.fetchone()[0] or str(task_user_id)
+    uname = await async_db.get_username(task_user_id) or str(task_user_id)
     
     # Отправляем скриншот
     if os.path.exists(screenshot_path):
@@ -437,15 +430,21 @@ async def check_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data['last_task_photo_msg_id'] = photo_message.message_id
         context.user_data['last_task_photo_chat_id'] = update.effective_user.id
     
+    # Текст задания собирается из шаблона и промокода - то, что видел пользователь
+    description = await async_db.get_task_description(task_id)
+    
     text = (
         f"Новая заявка от @{uname}\n"
         f"ID: {task_id}\n"
         f"Дата подачи: {created_at}"
     )
+    if description:
+        text += f"\n\n📝 Задание:\n{description}"
     
     keyboard = get_task_approval_keyboard(task_id)
     await context.bot.send_message(
         chat_id=update.effective_user.id,
         text=text,
+        parse_mode=ParseMode.HTML,
         reply_markup=keyboard
     ) 
\ No newline at end of file
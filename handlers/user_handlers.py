@@ -2,7 +2,9 @@ from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from config import CHANNEL_ID, RULES_TEXT, WELCOME_IMAGE_PATH, REMINDER_IMAGE_PATH, logger
-from database import db
+from database import async_db
+from analytics import parse_mode, source_for
+from loyalty_verifier import LoyaltyVerifier, format_loyalty_counters, loyalty_check_lock
 from keyboards import (
     get_main_reply_keyboard, get_back_inline_keyboard, get_subscription_check_keyboard,
     get_rules_accept_keyboard, get_rules_final_accept_keyboard, get_main_inline_keyboard
@@ -10,7 +12,7 @@ from keyboards import (
 from utils import (
     is_user_subscribed, format_profile_text, get_welcome_caption, get_main_screen_text,
     get_subscription_text, get_reminder_text, parse_start_parameter, ensure_directories,
-    clear_subscription_cache, force_check_subscription
+    clear_subscription_cache, force_check_subscription, to_epoch
 )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -38,7 +40,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         ref_by = parse_start_parameter(update.message.text)
     
     # Получаем или создаем пользователя
-    promo_code = db.get_or_create_user(
+    promo_code = await async_db.get_or_create_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -95,7 +97,7 @@ async def check_subscription_handler(update: Update, context: ContextTypes.DEFAU
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик профиля пользователя"""
     user = update.effective_user
-    user_stats = db.get_user_stats(user.id)
+    user_stats = await async_db.get_user_stats(user.id)
     
     if not user_stats:
         await update.message.reply_text("Профиль не найден.")
@@ -207,13 +209,12 @@ async def credit_loyal_referral(context: ContextTypes.DEFAULT_TYPE) -> None:
     
     try:
         # Проверяем, существует ли реферал в базе данных
-        db.cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (referral_id,))
-        if not db.cursor.fetchone():
+        if not await async_db.user_exists(referral_id):
             logger.warning(f"Referral {referral_id} not found in database")
             return
         
         # Проверяем, не был ли уже начислен преданный реферал
-        if db.is_loyal_referral_credited(referrer_id, referral_id):
+        if await async_db.is_loyal_referral_credited(referrer_id, referral_id):
             logger.info(f"Loyal referral already credited for {referrer_id} <- {referral_id}")
             return
         
@@ -222,30 +223,9 @@ async def credit_loyal_referral(context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info(f"Referral {referral_id} subscription status: {is_subscribed}")
         
         if is_subscribed:
-            # Получаем текущие данные реферера
-            db.cursor.execute("""
-                SELECT loyal_referrals, used_loyal FROM users WHERE user_id = ?
-            """, (referrer_id,))
-            result = db.cursor.fetchone()
-            
-            if result:
-                current_loyal, used_loyal = result
-                current_loyal = current_loyal or 0
-                used_loyal = used_loyal or 0
-                
-                # Увеличиваем счетчик преданных рефералов
-                new_loyal_referrals = current_loyal + 1
-                
-                # Обновляем счетчик
-                db.cursor.execute(
-                    "UPDATE users SET loyal_referrals = ? WHERE user_id = ?",
-                    (new_loyal_referrals, referrer_id)
-                )
-                
-                # Отмечаем, что преданный реферал был начислен
-                db.mark_loyal_referral_credited(referrer_id, referral_id)
-                
-                logger.info(f"Credited loyal referral for {referrer_id}: {current_loyal} -> {new_loyal_referrals} (used: {used_loyal})")
+            # Отметка и увеличение счетчика идут одной транзакцией, дважды не начислится
+            if await async_db.credit_loyal_referral(referrer_id, referral_id):
+                logger.info(f"Credited loyal referral for {referrer_id} <- {referral_id}")
                 
                 await context.bot.send_message(
                     chat_id=referrer_id,
@@ -305,8 +285,22 @@ async def refresh_subscription(update: Update, context: ContextTypes.DEFAULT_TYP
             parse_mode=ParseMode.HTML
         )
 
+async def channel_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Учет вступлений и выходов из канала по обновлениям chat_member"""
+    change = update.chat_member
+    if change is None or change.chat.id != CHANNEL_ID:
+        return
+    
+    member = change.new_chat_member
+    try:
+        await async_db.record_channel_member(member.user.id, member.status, to_epoch(change.date))
+        # Следующая проверка подписки прочитает свежий статус из таблицы
+        clear_subscription_cache(member.user.id)
+    except Exception as e:
+        logger.error(f"Failed to record channel member update for {member.user.id}: {e}")
+
 async def check_loyalty_manual(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ручная проверка преданности рефералов (только для админов)"""
+    """Массовая проверка преданности рефералов (только для админов)"""
     from config import ADMIN_IDS
     
     if update.effective_user.id not in ADMIN_IDS:
@@ -315,114 +309,43 @@ async def check_loyalty_manual(update: Update, context: ContextTypes.DEFAULT_TYP
     
     await update.message.delete()
     
-    # Находим всех рефералов старше 3 дней
-    from datetime import datetime, timedelta
-    three_days_ago = datetime.now() - timedelta(days=3)
-    
-    db.cursor.execute("""
-        SELECT u.user_id, u.username, u.ref_by, u.joined_date
-        FROM users u
-        WHERE u.ref_by IS NOT NULL 
-        AND u.joined_date < ?
-        ORDER BY u.joined_date DESC
-    """, (three_days_ago.isoformat(),))
-    
-    old_referrals = db.cursor.fetchall()
-    
-    if not old_referrals:
-        await update.message.reply_text("📊 Нет рефералов старше 3 дней для проверки.")
+    if loyalty_check_lock.locked():
+        await update.message.reply_text("⏳ Проверка преданности уже идет.")
         return
     
-    await update.message.reply_text(f"🔍 Найдено {len(old_referrals)} рефералов старше 3 дней. Начинаю проверку...")
-    
-    processed = 0
-    credited = 0
-    already_credited = 0
-    
-    # Создаем словарь для подсчета реальных преданных рефералов
-    real_loyal_counts = {}
-    
-    for user_id, username, ref_by, joined_date in old_referrals:
-        try:
-            # Проверяем подписку
-            if await is_user_subscribed(context.bot, user_id):
-                # Увеличиваем счетчик реальных преданных рефералов
-                if ref_by not in real_loyal_counts:
-                    real_loyal_counts[ref_by] = 0
-                real_loyal_counts[ref_by] += 1
-                
-                # Отмечаем в таблице отслеживания
-                if not db.is_loyal_referral_credited(ref_by, user_id):
-                    db.mark_loyal_referral_credited(ref_by, user_id)
-                    credited += 1
-            
-            processed += 1
-            
-        except Exception as e:
-            logger.error(f"Error processing referral {user_id}: {e}")
-    
-    # Теперь обновляем счетчики с учетом потраченных
-    updated_users = 0
-    for ref_by, real_loyal_count in real_loyal_counts.items():
-        try:
-            # Получаем текущие данные пользователя
-            db.cursor.execute("""
-                SELECT loyal_referrals, used_loyal FROM users WHERE user_id = ?
-            """, (ref_by,))
-            result = db.cursor.fetchone()
-            
-            if result:
-                current_loyal, used_loyal = result
-                used_loyal = used_loyal or 0
-                
-                # Устанавливаем правильный баланс: реальные преданные - потраченные
-                new_loyal_referrals = max(0, real_loyal_count - used_loyal)
-                
-                # Обновляем только если значение изменилось
-                if new_loyal_referrals != current_loyal:
-                    db.cursor.execute("""
-                        UPDATE users SET loyal_referrals = ? WHERE user_id = ?
-                    """, (new_loyal_referrals, ref_by))
-                    updated_users += 1
-                    logger.info(f"Updated loyal referrals for {ref_by}: {current_loyal} -> {new_loyal_referrals} (real: {real_loyal_count}, used: {used_loyal})")
-                
-        except Exception as e:
-            logger.error(f"Error updating user {ref_by}: {e}")
-    
-    # Обнуляем счетчики для тех, у кого нет реальных преданных рефералов
-    db.cursor.execute("""
-        SELECT user_id, loyal_referrals, used_loyal 
-        FROM users 
-        WHERE loyal_referrals > 0 AND user_id NOT IN ({})
-    """.format(','.join('?' * len(real_loyal_counts))), list(real_loyal_counts.keys()) if real_loyal_counts else [0])
-    
-    users_to_reset = db.cursor.fetchall()
-    reset_users = 0
-    
-    for user_id, current_loyal, used_loyal in users_to_reset:
-        try:
-            used_loyal = used_loyal or 0
-            new_loyal_referrals = max(0, 0 - used_loyal)  # 0 реальных - потраченные
-            
-            if new_loyal_referrals != current_loyal:
-                db.cursor.execute("""
-                    UPDATE users SET loyal_referrals = ? WHERE user_id = ?
-                """, (new_loyal_referrals, user_id))
-                reset_users += 1
-                logger.info(f"Reset loyal referrals for {user_id}: {current_loyal} -> {new_loyal_referrals}")
-        except Exception as e:
-            logger.error(f"Error resetting user {user_id}: {e}")
-    
-    db.conn.commit()
-    
-    await update.message.reply_text(
-        f"✅ Проверка завершена!\n"
-        f"📊 Обработано рефералов: {processed}\n"
-        f"💖 Начислено новых преданных: {credited}\n"
-        f"🔄 Обновлено пользователей: {updated_users}\n"
-        f"🔄 Сброшено пользователей: {reset_users}\n"
-        f"📈 Реальных преданных рефералов: {sum(real_loyal_counts.values())}"
-    )
+    async with loyalty_check_lock:
+        # Список рефералов читаем из снимка ("/check_loyalty live" - из рабочей базы),
+        # начисления и контрольная точка идут в рабочую базу
+        source, source_label = await source_for(parse_mode(context.args))
+        status_message = await update.message.reply_text(f"🔍 Проверяю рефералов старше 3 дней...\n{source_label}")
+        
+        async def report(counters):
+            try:
+                await status_message.edit_text("🔍 Проверка идет...\n" + format_loyalty_counters(counters))
+            except Exception as e:
+                logger.warning(f"Failed to update loyalty check progress: {e}")
+        
+        # Незавершенная проверка (например, до перезапуска) продолжается с контрольной точки
+        verifier = LoyaltyVerifier(context.bot, source=source)
+        stats = await verifier.run(to_epoch() - 3 * 24 * 60 * 60, progress=report)
+        
+        # Сверка балансов: свертка только новых записей журнала с прошлой проверки
+        fold = await async_db.fold_loyalty_ledger()
+        
+        if stats['paused']:
+            title = "⏸ Проверка приостановлена: Telegram не отвечает. Повторите /check_loyalty позже, она продолжится с места остановки"
+        else:
+            title = f"✅ Проверка завершена{' (продолжена после перезапуска)' if stats['resumed'] else ''}!"
+        await status_message.edit_text(
+            f"{title}\n"
+            f"{format_loyalty_counters(stats)}\n"
+            f"🌐 Запросов к Telegram: {stats['api_calls']}, пауз по RetryAfter: {stats['retries']}\n"
+            f"⏱ Время: {stats['seconds']:.0f} с\n"
+            f"📒 Новых записей журнала: {fold['entries']}\n"
+            f"👥 Сверено пользователей: {fold['users']}\n"
+            f"🔧 Исправлено расхождений: {fold['repaired']}\n"
+            f"{source_label}"
+        )
 
 async def general_back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик общей кнопки 'Назад'"""
@@ -452,7 +375,7 @@ async def accept_rules_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         ref_by = parse_start_parameter(update.message.text)
     
     # Получаем или создаем пользователя
-    promo_code = db.get_or_create_user(
+    promo_code = await async_db.get_or_create_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Импорт пользователей из CSV-выгрузки бота или из базы старого AMBpromobot.py
+
+Использование: python import_users.py users.csv
+               python import_users.py old_bot_database.db
+
+Бот на время импорта нужно остановить: он держит пользователей в памяти и
+не увидит импортированных и переименованных до перезапуска.
+"""
+
+import csv
+import sqlite3
+import sys
+from database import db, USER_IMPORT_FIELDS
+
+def read_csv(path):
+    """Строки CSV с заголовком (как у выгрузки "Получить файл")"""
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+def read_legacy_database(path):
+    """Пользователи из SQLite-базы старого бота; отсутствующие колонки считаются пустыми"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        available = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+        columns = ", ".join(field if field in available else "NULL" for field in USER_IMPORT_FIELDS)
+        for row in conn.execute(f"SELECT {columns} FROM users"):
+            yield row
+    finally:
+        conn.close()
+
+def print_progress(stats):
+    """Прогресс импорта в консоль"""
+    print(
+        f"\r{stats['rows']:,} записей: {stats['inserted']:,} новых, {stats['updated']:,} обновлено, "
+        f"{stats['skipped']:,} пропущено, "
+        f"{stats['rows_per_sec']:,.0f} записей/с",
+        end="", flush=True
+    )
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__.strip())
+        sys.exit(1)
+
+    path = sys.argv[1]
+    print("Бот должен быть остановлен на время импорта, иначе он не увидит новых пользователей до перезапуска")
+    records = read_csv(path) if path.lower().endswith(".csv") else read_legacy_database(path)
+    stats = db.bulk_upsert_users(records, progress=print_progress)
+    print(f"\nГотово за {stats['seconds']:.2f} с")
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -123,10 +123,10 @@ def get_rules_final_accept_keyboard():
         InlineKeyboardButton("✅Прочитал", callback_data='final_accept_rules')
     ]])
 
-def get_users_file_keyboard():
-    """Клавиатура получения файла пользователей"""
+def get_users_file_keyboard(mode='snapshot'):
+    """Клавиатура получения файла пользователей из снимка или рабочей базы (mode)"""
     return InlineKeyboardMarkup([[
-        InlineKeyboardButton("Получить файл", callback_data='get_users_file')
+        InlineKeyboardButton("Получить файл", callback_data=f'get_users_file|{mode}')
     ]])
 
 # Reply клавиатуры
@@ -0,0 +1,198 @@
+import asyncio
+import time
+from telegram.error import RetryAfter
+from config import (
+    CHANNEL_MEMBER_FRESH_SECONDS, LOYALTY_CHECK_CONCURRENCY, LOYALTY_CHECK_RATE_PER_SECOND,
+    LOYALTY_CHECK_BATCH_SIZE, LOYALTY_CHECK_PROGRESS_SECONDS, logger
+)
+from database import async_db
+from utils import MEMBER_STATUSES, cached_subscription, fetch_member_status, to_epoch
+
+class RateLimiter:
+    """Равномерный темп запросов к API; RetryAfter ставит на паузу всех ожидающих"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    async def acquire(self):
+        """Ожидание своей очереди на запрос"""
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пауза могла начаться, пока ждали слот
+            if self._paused_until <= time.monotonic():
+                return
+
+    def pause(self, seconds):
+        """Пауза всех запросов на seconds секунд"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+# Ответ _fetch_status для реферала, отложенного из-за разомкнутого предохранителя
+_DEFERRED = object()
+
+class LoyaltyVerifier:
+    """Массовая проверка преданных рефералов.
+
+    Рефералы читаются страницами по user_id из source (рабочая база или снимок
+    для аналитики), начисления и контрольная точка пишутся в database.
+    Статусы запрашиваются параллельно: не больше concurrency одновременно и
+    rate в секунду, с общей паузой по RetryAfter. Свежие статусы из
+    channel_members и кэша подписки берутся без запроса к API, а запросы идут
+    через общий предохранитель проверки подписки: если он разомкнут, проверка
+    приостанавливается на первом непроверенном реферале и остается
+    незавершенной до следующего запуска. Результаты страницы сохраняются одной
+    транзакцией вместе с контрольной точкой, поэтому после перезапуска проверка
+    продолжается с последней пачки.
+    """
+
+    def __init__(self, bot, database=async_db, source=None, concurrency=LOYALTY_CHECK_CONCURRENCY,
+                 rate=LOYALTY_CHECK_RATE_PER_SECOND, batch_size=LOYALTY_CHECK_BATCH_SIZE,
+                 progress_seconds=LOYALTY_CHECK_PROGRESS_SECONDS, max_retries=5):
+        self.bot = bot
+        self.database = database
+        self.source = source if source is not None else database
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(rate)
+        self.batch_size = batch_size
+        self.progress_seconds = progress_seconds
+        self.max_retries = max_retries
+        self.api_calls = 0
+        self.retries = 0
+        self.paused = False
+
+    async def run(self, cutoff_ts, progress=None):
+        """Проверка рефералов, пришедших до cutoff_ts; progress(counters) вызывается по ходу"""
+        started = time.monotonic()
+        check_id, cutoff_ts, last_user_id, counters = await self.database.start_loyalty_check(cutoff_ts)
+        resumed = last_user_id > 0
+        if resumed:
+            logger.info(f"Resuming loyalty check {check_id} after user {last_user_id}")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reported = time.monotonic()
+
+        while True:
+            page = await self.source.get_referrals_to_verify(cutoff_ts, last_user_id, self.batch_size)
+            if not page:
+                break
+            results = await asyncio.gather(*(self._verify(semaphore, user_id, cutoff_ts) for user_id, _ in page))
+            # При разомкнутом предохранителе страница сохраняется только до первого отложенного реферала
+            done = next((i for i, result in enumerate(results) if result is None), len(results))
+
+            members, credits = [], []
+            for (user_id, ref_by), (status, observed, long_enough) in zip(page[:done], results[:done]):
+                counters['processed'] += 1
+                if status is None:
+                    counters['failed'] += 1
+                    continue
+                if observed:
+                    members.append((user_id, status))
+                if status in MEMBER_STATUSES:
+                    counters['subscribed'] += 1
+                    if long_enough:
+                        credits.append((ref_by, user_id))
+                    else:
+                        counters['too_recent'] += 1
+            if done:
+                last_user_id = page[done - 1][0]
+                counters['credited'] += await self.database.save_loyalty_check_batch(
+                    check_id, last_user_id, members, credits, counters
+                )
+            if self.paused:
+                break
+
+            if progress is not None and time.monotonic() - reported >= self.progress_seconds:
+                reported = time.monotonic()
+                await progress(dict(counters))
+
+        if not self.paused:
+            await self.database.finish_loyalty_check(check_id)
+        stats = dict(
+            counters, check_id=check_id, resumed=resumed, paused=self.paused, api_calls=self.api_calls,
+            retries=self.retries, seconds=time.monotonic() - started
+        )
+        if self.paused:
+            logger.warning(f"Loyalty check {check_id} paused after user {last_user_id}, membership circuit is open: {stats}")
+        else:
+            logger.info(f"Loyalty check {check_id} finished: {stats}")
+        return stats
+
+    async def _verify(self, semaphore, user_id, cutoff_ts):
+        """(status, получен ли из API, подписан ли с cutoff_ts или раньше); status None при ошибке.
+
+        None вместо кортежа - реферал отложен, потому что предохранитель разомкнут.
+        """
+        member = await self.database.get_channel_member(user_id)
+        observed = member is None or to_epoch() - member[3] > CHANNEL_MEMBER_FRESH_SECONDS
+        cached = cached_subscription(user_id) if observed else None
+        if cached is not None:
+            # Свежий результат проверки подписки; без запроса к API статус не сохраняем
+            observed = False
+            status = 'member' if cached else (member[0] if member and member[0] not in MEMBER_STATUSES else 'left')
+        elif observed:
+            async with semaphore:
+                status = await self._fetch_status(user_id)
+            if status is _DEFERRED:
+                return None
+            if status is None:
+                return None, False, False
+        else:
+            status = member[0]
+        joined_ts = channel_joined_ts(member, status)
+        return status, observed, joined_ts is None or joined_ts <= cutoff_ts
+
+    async def _fetch_status(self, user_id):
+        """Статус в канале через предохранитель проверки подписки с повтором после RetryAfter"""
+        for _ in range(self.max_retries + 1):
+            # После размыкания оставшиеся запросы не ждут своей очереди в ограничителе
+            if self.paused:
+                return _DEFERRED
+            await self.limiter.acquire()
+            try:
+                status = await fetch_member_status(self.bot, user_id)
+            except RetryAfter as e:
+                self.api_calls += 1
+                self.retries += 1
+                logger.warning(f"Flood control during loyalty check, pausing for {e.retry_after} s")
+                self.limiter.pause(e.retry_after)
+                continue
+            except Exception as e:
+                self.api_calls += 1
+                logger.error(f"Loyalty check failed for user {user_id}: {e}")
+                return None
+            if status is None:
+                # Предохранитель разомкнут: проверка приостанавливается без сдвига контрольной точки
+                self.paused = True
+                return _DEFERRED
+            self.api_calls += 1
+            return status
+        return None
+
+def channel_joined_ts(member, status):
+    """Время вступления в канал с учетом нового статуса (так же его сохранит record_channel_member)"""
+    if status not in MEMBER_STATUSES or member is None:
+        return None
+    if member[0] in MEMBER_STATUSES:
+        return member[1]
+    # Раньше был не подписан: вступил только что
+    return to_epoch()
+
+def format_loyalty_counters(counters):
+    """Счетчики проверки для сообщения админу"""
+    return (
+        f"📊 Обработано рефералов: {counters['processed']}\n"
+        f"✅ Подписаны: {counters['subscribed']}\n"
+        f"💖 Начислено новых преданных: {counters['credited']}\n"
+        f"🕒 Подписались меньше 3 дней назад: {counters['too_recent']}\n"
+        f"⚠️ Ошибок проверки: {counters['failed']}"
+    )
+
+# Одна массовая проверка за раз
+loyalty_check_lock = asyncio.Lock()
@@ -4,6 +4,8 @@ AMB Promo Bot - Главный файл
 Модульная архитектура для Telegram бота
 """
 
+import asyncio
+import datetime
 import logging
 from telegram import Update
 from telegram.constants import ParseMode
@@ -11,6 +13,7 @@ from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     filters,
     ConversationHandler,
@@ -18,13 +21,20 @@ from telegram.ext import (
 )
 
 # Импорты конфигурации
-from config import TOKEN, ADMIN_IDS, ENTER_CODE, logger
+from config import (
+    TOKEN, ADMIN_IDS, ENTER_CODE, TASK_ARCHIVE_INTERVAL_HOURS, BACKUP_INTERVAL_HOURS,
+    DB_QUICK_CHECK_INTERVAL_MINUTES, DB_FULL_CHECK_HOUR,
+    DB_CHECKPOINT_INTERVAL_SECONDS, DB_CHECKPOINT_TRUNCATE_HOUR, ANALYTICS_REFRESH_MINUTES, logger
+)
 
 # Импорты базы данных
-from database import db
+from database import db, async_db
+from backup import snapshot, SnapshotInProgress
+from maintenance import checkpoint_tick, checkpoint_truncate
+from analytics import async_snapshot
 
 # Импорты утилит
-from utils import ensure_directories, reset_broadcast_state
+from utils import ensure_directories, reset_broadcast_state, set_membership_store
 
 # Импорты клавиатур
 from keyboards import get_back_inline_keyboard
@@ -34,7 +44,7 @@ from handlers.user_handlers import (
     start, check_subscription_handler, profile, rules_handler, 
     support_handler, main_button_handler, send_main_reply_keyboard, get_my_id,
     accept_rules_handler, refresh_subscription, show_rules_handler, general_back_handler,
-    check_loyalty_manual
+    check_loyalty_manual, channel_member_handler
 )
 
 from handlers.admin_handlers import (
@@ -44,7 +54,7 @@ from handlers.admin_handlers import (
     promo_delete_offer_handler, promo_list_offers_handler, stats_command, 
     send_users_file_handler, broadcast_panel, handle_admin_broadcast_message,
     handle_admin_input, clear_chat, debug_subscription_command, clear_cache_command,
-    check_db_status
+    check_db_status, backup_command
 )
 
 from handlers.task_handlers import (
@@ -67,8 +77,7 @@ async def handle_task_approval(update: Update, context: ContextTypes.DEFAULT_TYP
     task_id = int(task_id)
     
     # Получаем данные задания
-    db.cursor.execute("SELECT user_id, task_type FROM tasks WHERE task_id = ?", (task_id,))
-    row = db.cursor.fetchone()
+    row = await async_db.get_task(task_id)
     if not row:
         await query.message.edit_text("Задание не найдено.")
         return
@@ -88,7 +97,7 @@ async def handle_task_approval(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         
         # Обычное одобрение для других заданий
-        db.approve_task(task_id, user_id)
+        await async_db.approve_task(task_id, user_id)
         await context.bot.send_message(
             chat_id=user_id,
             text=(
@@ -100,7 +109,7 @@ async def handle_task_approval(update: Update, context: ContextTypes.DEFAULT_TYP
             parse_mode=ParseMode.MARKDOWN
         )
     else:  # decline
-        db.decline_task(task_id, user_id)
+        await async_db.decline_task(task_id, user_id)
         await context.bot.send_message(
             chat_id=user_id,
             text=(
@@ -121,13 +130,66 @@ async def handle_task_approval(update: Update, context: ContextTypes.DEFAULT_TYP
             pass
     await query.message.delete()
 
+async def archive_tasks_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Плановый перенос решенных заданий в архив"""
+    try:
+        await async_db.archive_tasks()
+    except Exception as e:
+        logger.error(f"Task archiving failed: {e}")
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Плановый снимок базы данных"""
+    try:
+        await snapshot()
+    except SnapshotInProgress:
+        pass
+    except Exception as e:
+        logger.error(f"Scheduled snapshot failed: {e}")
+
+async def integrity_check_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Плановая проверка целостности; job.data=True - полная проверка"""
+    try:
+        # Отдельное соединение в отдельном потоке: не занимает ни event loop, ни пул читателей
+        await asyncio.to_thread(db.check_integrity, bool(context.job.data))
+    except Exception as e:
+        logger.error(f"Integrity check failed to run: {e}")
+
+async def checkpoint_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """PASSIVE-checkpoint WAL в момент простоя базы"""
+    try:
+        await checkpoint_tick()
+    except Exception as e:
+        logger.error(f"WAL checkpoint failed: {e}")
+
+async def truncate_checkpoint_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """TRUNCATE-checkpoint WAL в тихие часы"""
+    try:
+        await checkpoint_truncate()
+    except Exception as e:
+        logger.error(f"WAL truncate checkpoint failed: {e}")
+
+async def analytics_refresh_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Плановое обновление снимка для админской аналитики"""
+    try:
+        await async_snapshot.refresh()
+    except Exception as e:
+        logger.error(f"Analytics snapshot refresh failed: {e}")
+
+async def on_shutdown(application) -> None:
+    """Корректное завершение работы с базой данных"""
+    async_snapshot.close()
+    async_db.close()
+
 def main() -> None:
     """Главная функция запуска бота"""
     # Создаем необходимые директории
     ensure_directories()
     
+    # Проверки подписки сначала смотрят в таблицу участников канала
+    set_membership_store(async_db)
+    
     # Создаем приложение
-    application = ApplicationBuilder().token(TOKEN).build()
+    application = ApplicationBuilder().token(TOKEN).post_shutdown(on_shutdown).build()
     
     # ===== РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ КОМАНД =====
     application.add_handler(CommandHandler('start', start))
@@ -139,6 +201,11 @@ def main() -> None:
     application.add_handler(CommandHandler('refresh', refresh_subscription))
     application.add_handler(CommandHandler('check_loyalty', check_loyalty_manual))
     application.add_handler(CommandHandler('db_status', check_db_status))
+    application.add_handler(CommandHandler('stats', stats_command, filters=filters.User(ADMIN_IDS)))
+    application.add_handler(CommandHandler('backup', backup_command))
+    
+    # Вступления и выходы из канала (бот - администратор CHANNEL_ID)
+    application.add_handler(ChatMemberHandler(channel_member_handler, ChatMemberHandler.CHAT_MEMBER))
     
     # ===== РЕГИСТРАЦИЯ CALLBACK ОБРАБОТЧИКОВ =====
     
@@ -147,7 +214,7 @@ def main() -> None:
         CallbackQueryHandler(check_subscription_handler, pattern='^check_subscription$')
     )
     application.add_handler(
-        CallbackQueryHandler(send_users_file_handler, pattern='^get_users_file$')
+        CallbackQueryHandler(send_users_file_handler, pattern='^get_users_file')
     )
     
     # Промо callback обработчики
@@ -353,8 +420,46 @@ def main() -> None:
         )
     )
     
+    # ===== ПЛАНОВЫЕ ЗАДАЧИ =====
+    application.job_queue.run_repeating(
+        archive_tasks_job,
+        interval=TASK_ARCHIVE_INTERVAL_HOURS * 60 * 60,
+        first=10 * 60
+    )
+    application.job_queue.run_repeating(
+        backup_job,
+        interval=BACKUP_INTERVAL_HOURS * 60 * 60,
+        first=30 * 60
+    )
+    application.job_queue.run_repeating(
+        analytics_refresh_job,
+        interval=ANALYTICS_REFRESH_MINUTES * 60,
+        first=5 * 60
+    )
+    application.job_queue.run_repeating(
+        checkpoint_job,
+        interval=DB_CHECKPOINT_INTERVAL_SECONDS,
+        first=DB_CHECKPOINT_INTERVAL_SECONDS
+    )
+    application.job_queue.run_daily(
+        truncate_checkpoint_job,
+        time=datetime.time(hour=DB_CHECKPOINT_TRUNCATE_HOUR, tzinfo=datetime.timezone.utc)
+    )
+    application.job_queue.run_repeating(
+        integrity_check_job,
+        interval=DB_QUICK_CHECK_INTERVAL_MINUTES * 60,
+        first=60,
+        data=False
+    )
+    application.job_queue.run_daily(
+        integrity_check_job,
+        time=datetime.time(hour=DB_FULL_CHECK_HOUR, tzinfo=datetime.timezone.utc),
+        data=True
+    )
+    
     logger.info("Бот запущен!")
-    application.run_polling()
+    # chat_member не приходит без явного запроса в allowed_updates
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from config import DB_CHECKPOINT_IDLE_SECONDS, DB_WAL_MAX_BYTES, logger
+from database import db, CHECKPOINT_MODES
+
+class CheckpointManager:
+    """Плановые checkpoint'ы WAL вне пользовательских commit'ов.
+
+    tick() вызывается периодически и делает PASSIVE, когда база простаивает
+    или WAL перерос порог (например, во время рассылки). PASSIVE не ждет
+    ни писателей, ни читателей. TRUNCATE запускается в тихие часы и
+    обрезает WAL-файл до нуля.
+    """
+
+    def __init__(self, database=db, idle_seconds=DB_CHECKPOINT_IDLE_SECONDS, max_wal_bytes=DB_WAL_MAX_BYTES):
+        self.database = database
+        self.idle_seconds = idle_seconds
+        self.max_wal_bytes = max_wal_bytes
+        self._lock = threading.Lock()
+        # Счетчики по режимам: 'passive', 'full', 'restart', 'truncate'
+        self.stats = dict.fromkeys((mode.lower() for mode in CHECKPOINT_MODES), 0)
+        self.stats.update({
+            'busy': 0, 'frames': 0, 'last_mode': None, 'last_at': None, 'last_duration': 0.0, 'wal_max': 0,
+        })
+
+    def is_idle(self):
+        """Не было записей последние idle_seconds"""
+        return time.monotonic() - self.database.last_write >= self.idle_seconds
+
+    def run(self, mode='PASSIVE'):
+        """Checkpoint в указанном режиме с учетом в метриках; (busy, кадров в WAL, перенесено)"""
+        with self._lock:
+            started = time.monotonic()
+            busy, frames, moved = self.database.checkpoint(mode)
+            duration = time.monotonic() - started
+            stats = self.stats
+            stats[mode.lower()] += 1
+            stats['busy'] += busy
+            stats['frames'] += max(moved, 0)
+            stats['last_mode'] = mode
+            stats['last_at'] = datetime.now()
+            stats['last_duration'] = duration
+        logger.debug(f"WAL checkpoint {mode}: {moved}/{frames} frames in {duration * 1000:.1f} ms, busy={busy}")
+        return busy, frames, moved
+
+    def tick(self):
+        """Периодическая проверка: PASSIVE при простое или большом WAL, иначе ничего"""
+        wal = self.database.wal_size()
+        self.stats['wal_max'] = max(self.stats['wal_max'], wal)
+        if not wal:
+            return None
+        if wal >= self.max_wal_bytes:
+            logger.info(f"WAL grew to {wal:,} bytes, checkpointing without waiting for idle")
+        elif not self.is_idle():
+            return None
+        return self.run('PASSIVE')
+
+    def get_stats(self):
+        """Метрики checkpoint'ов и текущий размер WAL"""
+        stats = dict(self.stats)
+        stats['wal_size'] = self.database.wal_size()
+        return stats
+
+async def checkpoint_tick():
+    """tick() в отдельном потоке"""
+    return await asyncio.to_thread(checkpoints.tick)
+
+async def checkpoint_truncate():
+    """TRUNCATE-checkpoint в отдельном потоке"""
+    return await asyncio.to_thread(checkpoints.run, 'TRUNCATE')
+
+# Глобальный менеджер checkpoint'ов основной базы
+checkpoints = CheckpointManager()
@@ -0,0 +1,563 @@
+import re
+import sqlite3
+import time
+from config import DB_AUTO_VACUUM_MIGRATE_MAX_MB, MIGRATION_BATCH_SIZE, logger
+from promo_codes import allocate_codes, ensure_sequence
+
+# Индексы под горячие запросы из database.HOT_QUERIES: (имя, определение).
+# Индексы по текстовым датам заменены индексами EPOCH_INDEXES в миграции 17
+HOT_INDEXES = [
+    ("idx_tasks_user_status_created", "tasks(user_id, status, created_at)"),
+    ("idx_tasks_pending_review",
+     "tasks(created_at) WHERE status='pending' AND screenshot_path IS NOT NULL"),
+    ("idx_users_joined_date", "users(joined_date)"),
+    ("idx_users_referrals_joined", "users(joined_date) WHERE ref_by IS NOT NULL"),
+    ("idx_users_username", "users(username)"),
+]
+
+# Индексы по целым epoch-колонкам вместо индексов по текстовым датам
+EPOCH_INDEXES = [
+    ("idx_tasks_user_status_created_ts", "tasks(user_id, status, created_ts)"),
+    ("idx_tasks_pending_review_ts",
+     "tasks(created_ts) WHERE status='pending' AND screenshot_path IS NOT NULL"),
+    ("idx_users_joined_ts", "users(joined_ts)"),
+    ("idx_users_referrals_joined_ts", "users(joined_ts) WHERE ref_by IS NOT NULL"),
+]
+REPLACED_DATE_INDEXES = [
+    "idx_tasks_user_status_created", "idx_tasks_pending_review",
+    "idx_users_joined_date", "idx_users_referrals_joined",
+]
+
+def backfill(step):
+    """Помечает миграцию, которая сама управляет транзакциями: заполнение данных пачками
+    с продолжением после рестарта или операции вроде VACUUM, невозможные внутри транзакции"""
+    step.is_backfill = True
+    return step
+
+def _table_columns(cur, table):
+    """Список колонок таблицы"""
+    cur.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cur.fetchall()]
+
+def _create_base_schema(cur):
+    """Создание таблиц"""
+    # Создание таблицы пользователей
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            ref_by INTEGER
+        )
+    ''')
+
+    # Создание таблицы заданий
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            task_description TEXT,
+            status TEXT DEFAULT 'pending',
+            task_type TEXT,
+            screenshot_path TEXT,
+            created_at TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Создание таблицы купонов
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS coupons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT,
+            type TEXT,
+            used INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Создание таблицы шаблонов мемов
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS meme_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT,
+            text TEXT
+        )
+    ''')
+
+    # Создание таблицы текстовых шаблонов
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS text_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT
+        )
+    ''')
+
+    # Создание таблицы разрешенных чатов
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS allowed_chats (
+            chat_username TEXT PRIMARY KEY
+        )
+    ''')
+
+    # Создание таблицы промо-предложений
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS promo_offers (
+            offer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            description TEXT,
+            cost INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Создание таблицы для отслеживания преданных рефералов
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS loyal_referrals_tracking (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referral_id INTEGER,
+            credited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(referrer_id, referral_id),
+            FOREIGN KEY(referrer_id) REFERENCES users(user_id),
+            FOREIGN KEY(referral_id) REFERENCES users(user_id)
+        )
+    ''')
+
+def _add_user_columns(cur):
+    """Добавление колонок, которых нет в старых базах"""
+    cols = _table_columns(cur, 'users')
+
+    columns = [
+        ("promo_code", "TEXT"),
+        ("referrals_count", "INTEGER DEFAULT 0"),
+        ("joined_date", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+        ("used_loyal", "INTEGER DEFAULT 0"),
+        ("loyal_referrals", "INTEGER DEFAULT 0"),
+        ("pending_tasks", "INTEGER DEFAULT 0"),
+        ("completed_tasks", "INTEGER DEFAULT 0")
+    ]
+
+    for column, definition in columns:
+        if column not in cols:
+            if 'CURRENT_TIMESTAMP' in definition:
+                # SQLite не добавляет колонку с непостоянным DEFAULT в непустую таблицу.
+                # Заполняем местным временем, как datetime.now() в коде бота
+                cur.execute(f"ALTER TABLE users ADD COLUMN {column} TIMESTAMP")
+                cur.execute(f"UPDATE users SET {column} = datetime('now', 'localtime')")
+            else:
+                cur.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+            logger.info(f"Added column {column} to users table")
+
+def _reconcile_legacy_tables(cur):
+    """Приведение allowed_chats и promo_offers к схеме, с которой работает код"""
+    # Ранние версии database.py создавали allowed_chats(id, chat_id, chat_title)
+    if 'chat_username' not in _table_columns(cur, 'allowed_chats'):
+        cur.execute("ALTER TABLE allowed_chats RENAME TO allowed_chats_legacy")
+        cur.execute("CREATE TABLE allowed_chats (chat_username TEXT PRIMARY KEY)")
+        logger.warning("allowed_chats had a legacy schema, old rows kept in allowed_chats_legacy")
+
+    # ...и promo_offers с колонкой id вместо offer_id
+    if 'offer_id' not in _table_columns(cur, 'promo_offers'):
+        cur.execute("ALTER TABLE promo_offers RENAME COLUMN id TO offer_id")
+        logger.info("Renamed promo_offers.id to offer_id")
+
+def _create_promo_code_index(cur):
+    """Уникальный индекс на promo_code"""
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_users_promo_code
+          ON users(promo_code)
+    """)
+
+def _create_hot_indexes(cur):
+    """Индексы для горячих запросов заданий и пользователей"""
+    for name, definition in HOT_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    cur.execute("PRAGMA optimize")
+
+@backfill
+def _backfill_promo_codes(conn):
+    """Выдача промокодов пользователям без них через общий аллокатор"""
+    cur = conn.cursor()
+    ensure_sequence(cur)
+    conn.commit()
+    filled = 0
+    while True:
+        rows = conn.execute(
+            "SELECT user_id FROM users WHERE promo_code IS NULL LIMIT ?",
+            (MIGRATION_BATCH_SIZE,)
+        ).fetchall()
+        if not rows:
+            break
+
+        codes = allocate_codes(cur, len(rows))
+        batch = [(code, uid) for code, (uid,) in zip(codes, rows)]
+        try:
+            conn.executemany("UPDATE users SET promo_code = ? WHERE user_id = ?", batch)
+            filled += len(batch)
+        except sqlite3.IntegrityError:
+            # Код совпал со старым случайным: строки до коллизии уже обновлены,
+            # остальные получат новые номера на следующей итерации
+            pass
+        conn.commit()
+
+    if filled:
+        logger.info(f"Backfilled promo codes for {filled} users")
+
+def _create_promo_code_sequence(cur):
+    """Счетчик для аллокатора промокодов"""
+    ensure_sequence(cur)
+
+def _add_total_tasks(cur):
+    """Счетчик всех заданий пользователя вместо COUNT по истории tasks"""
+    if 'total_tasks' not in _table_columns(cur, 'users'):
+        cur.execute("ALTER TABLE users ADD COLUMN total_tasks INTEGER DEFAULT 0")
+
+def _reconcile_total_tasks(cur):
+    """Разовая сверка total_tasks с таблицей tasks (COUNT идет по индексу user_id)"""
+    cur.execute("""
+        UPDATE users SET total_tasks = (
+            SELECT COUNT(*) FROM tasks t WHERE t.user_id = users.user_id
+        )
+    """)
+
+def _add_task_template_columns(cur):
+    """Ссылка на шаблон и промокод вместо полного текста задания"""
+    cols = _table_columns(cur, 'tasks')
+    for column, definition in [
+        ("template_id", "INTEGER"),
+        ("template_kind", "TEXT"),
+        ("promo_code", "TEXT"),
+    ]:
+        if column not in cols:
+            cur.execute(f"ALTER TABLE tasks ADD COLUMN {column} {definition}")
+
+_PANEL_PROMO = re.compile(r'<code>([0-9A-Z]+)</code>')
+
+@backfill
+def _compact_task_descriptions(conn):
+    """Замена сохраненных текстов заданий ссылками на шаблоны"""
+    def description_bytes():
+        return conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(CAST(task_description AS BLOB))), 0) FROM tasks"
+        ).fetchone()[0]
+
+    before = description_bytes()
+    texts = {text: tpl_id for tpl_id, text in conn.execute("SELECT id, text FROM text_templates")}
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT t.task_id, t.task_type, t.task_description, u.promo_code
+            FROM tasks t LEFT JOIN users u ON u.user_id = t.user_id
+            WHERE t.task_id > ? AND t.template_kind IS NULL
+              AND t.task_type IN ('meme', 'text', 'repost')
+            ORDER BY t.task_id LIMIT ?
+        """, (last_id, MIGRATION_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for task_id, task_type, description, user_promo in rows:
+            if task_type == 'meme':
+                # В панели мема уже есть промокод, сам мем в задании не сохранялся
+                found = _PANEL_PROMO.search(description or '')
+                updates.append((None, 'meme', found.group(1) if found else user_promo, task_id))
+            elif task_type == 'text' and description in texts:
+                updates.append((texts[description], 'text', user_promo, task_id))
+            elif task_type == 'repost':
+                updates.append((None, 'repost', user_promo, task_id))
+            # Текст от удаленного шаблона оставляем как есть
+
+        conn.executemany("""
+            UPDATE tasks SET template_id = ?, template_kind = ?, promo_code = ?, task_description = NULL
+            WHERE task_id = ?
+        """, updates)
+        conn.commit()
+        last_id = rows[-1][0]
+
+    reclaimed = before - description_bytes()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    logger.info(
+        f"Compacted task descriptions: {reclaimed} bytes reclaimed, "
+        f"{free_pages * page_size} bytes free in the database file"
+    )
+
+# Колонки tasks на момент создания архива (миграция 12)
+_ARCHIVED_TASK_COLUMNS = (
+    "task_id, user_id, task_description, status, task_type, screenshot_path, created_at, "
+    "template_id, template_kind, promo_code, decided_at"
+)
+# Колонки tasks в порядке, общем для tasks, tasks_archive и представления tasks_all
+TASK_COLUMNS = _ARCHIVED_TASK_COLUMNS + ", created_ts"
+
+def _create_tasks_archive(cur):
+    """Холодное хранилище решенных заданий и представление над всей историей"""
+    if 'decided_at' not in _table_columns(cur, 'tasks'):
+        cur.execute("ALTER TABLE tasks ADD COLUMN decided_at TIMESTAMP")
+    # Для уже решенных заданий время решения неизвестно - берем время создания
+    cur.execute("""
+        UPDATE tasks SET decided_at = created_at
+        WHERE status IN ('approved', 'declined') AND decided_at IS NULL
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_decided
+          ON tasks(decided_at) WHERE status IN ('approved', 'declined')
+    """)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS tasks_archive (
+            task_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            task_description TEXT,
+            status TEXT,
+            task_type TEXT,
+            screenshot_path TEXT,
+            created_at TIMESTAMP,
+            template_id INTEGER,
+            template_kind TEXT,
+            promo_code TEXT,
+            decided_at TIMESTAMP
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_user ON tasks_archive(user_id)")
+    cur.execute(f"""
+        CREATE VIEW IF NOT EXISTS tasks_all AS
+        SELECT {_ARCHIVED_TASK_COLUMNS} FROM tasks
+        UNION ALL
+        SELECT {_ARCHIVED_TASK_COLUMNS} FROM tasks_archive
+    """)
+
+def enable_incremental_vacuum(conn):
+    """auto_vacuum=INCREMENTAL, чтобы освобожденные архиватором страницы возвращались ОС; True если режим сменился"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    # Режим меняется только полным VACUUM, а VACUUM не работает внутри транзакции
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    logger.info("Database rebuilt with auto_vacuum=INCREMENTAL")
+    return True
+
+@backfill
+def _enable_incremental_vacuum(conn):
+    """auto_vacuum=INCREMENTAL для небольших баз; большие не перестраиваются при запуске"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    # Полный VACUUM переписывает файл целиком: на большой базе это долгая блокировка и двойной объем на диске
+    size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+    if size > DB_AUTO_VACUUM_MIGRATE_MAX_MB * 1024 * 1024:
+        logger.warning(
+            f"Database is {size / 1024 / 1024:.0f} MB, skipping the auto_vacuum=INCREMENTAL rebuild at startup; "
+            f"run vacuum_db.py with the bot stopped to reclaim archived pages"
+        )
+        return
+    enable_incremental_vacuum(conn)
+
+def _create_loyalty_ledger(cur):
+    """Журнал начислений и списаний преданных рефералов со снимком балансов"""
+    # earned/spent - изменения users.loyal_referrals и users.used_loyal соответственно
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS loyalty_ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            earned INTEGER NOT NULL DEFAULT 0,
+            spent INTEGER NOT NULL DEFAULT 0,
+            reason TEXT NOT NULL,
+            ref_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_loyalty_ledger_user ON loyalty_ledger(user_id)")
+    # Свертка журнала до last_entry_id: по ней сверяются балансы в users
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS loyalty_balances (
+            user_id INTEGER PRIMARY KEY,
+            earned INTEGER NOT NULL DEFAULT 0,
+            spent INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS loyalty_fold (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_entry_id INTEGER NOT NULL
+        )
+    ''')
+    # Текущие счетчики становятся начальными записями журнала
+    cur.execute('''
+        INSERT INTO loyalty_ledger (user_id, earned, spent, reason)
+        SELECT user_id, COALESCE(loyal_referrals, 0), COALESCE(used_loyal, 0), 'opening'
+        FROM users
+        WHERE COALESCE(loyal_referrals, 0) != 0 OR COALESCE(used_loyal, 0) != 0
+    ''')
+    cur.execute('''
+        INSERT OR REPLACE INTO loyalty_balances (user_id, earned, spent)
+        SELECT user_id, SUM(earned), SUM(spent) FROM loyalty_ledger GROUP BY user_id
+    ''')
+    cur.execute('''
+        INSERT OR REPLACE INTO loyalty_fold (id, last_entry_id)
+        SELECT 1, COALESCE(MAX(entry_id), 0) FROM loyalty_ledger
+    ''')
+
+# Местная текстовая дата (isoformat или str(datetime)) -> секунды Unix, как utils.to_epoch.
+# joined_date и created_at бот пишет через datetime.now(), то есть в местном времени, поэтому
+# нужен модификатор 'utc'. Без него читаются только колонки с DEFAULT CURRENT_TIMESTAMP (уже UTC)
+_LOCAL_TO_EPOCH = "CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+def _add_epoch_columns(cur):
+    """Целые epoch-колонки рядом с текстовыми датами"""
+    for table, column in [("users", "joined_ts"), ("tasks", "created_ts"), ("tasks_archive", "created_ts")]:
+        if column not in _table_columns(cur, table):
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+    cur.execute("DROP VIEW IF EXISTS tasks_all")
+    cur.execute(f"""
+        CREATE VIEW tasks_all AS
+        SELECT {TASK_COLUMNS} FROM tasks
+        UNION ALL
+        SELECT {TASK_COLUMNS} FROM tasks_archive
+    """)
+
+@backfill
+def _backfill_epoch_columns(conn):
+    """Перевод текстовых дат в epoch пачками по rowid"""
+    for table, source, target in [
+        ("users", "joined_date", "joined_ts"),
+        ("tasks", "created_at", "created_ts"),
+        ("tasks_archive", "created_at", "created_ts"),
+    ]:
+        converted = 0
+        last_rowid = 0
+        while True:
+            row = conn.execute(
+                f"SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last_rowid, MIGRATION_BATCH_SIZE)
+            ).fetchone()
+            if row[0] is None:
+                break
+            cursor = conn.execute(f"""
+                UPDATE {table} SET {target} = {_LOCAL_TO_EPOCH.format(column=source)}
+                WHERE rowid > ? AND rowid <= ? AND {target} IS NULL AND {source} IS NOT NULL
+            """, (last_rowid, row[0]))
+            converted += cursor.rowcount
+            conn.commit()
+            last_rowid = row[0]
+        if converted:
+            logger.info(f"Converted {converted} {table}.{source} values to {target}")
+
+def _create_epoch_indexes(cur):
+    """Индексы по epoch-колонкам вместо индексов по текстовым датам"""
+    for name in REPLACED_DATE_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, definition in EPOCH_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    cur.execute("PRAGMA optimize")
+
+def _create_channel_members(cur):
+    """Участники канала по обновлениям chat_member: статус и время вступления/выхода"""
+    # joined_ts/left_ts - момент последнего вступления/выхода (NULL - неизвестен),
+    # updated_ts - когда статус последний раз подтверждался событием или запросом к API
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS channel_members (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            joined_ts INTEGER,
+            left_ts INTEGER,
+            updated_ts INTEGER NOT NULL
+        )
+    ''')
+
+def _create_loyalty_checks(cur):
+    """Контрольные точки массовой проверки преданных рефералов"""
+    # Рефералы обходятся по возрастанию user_id, last_user_id - последний сохраненный
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS loyalty_checks (
+            check_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'running',
+            cutoff_ts INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0,
+            subscribed INTEGER NOT NULL DEFAULT 0,
+            credited INTEGER NOT NULL DEFAULT 0,
+            too_recent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            started_ts INTEGER NOT NULL,
+            finished_ts INTEGER
+        )
+    ''')
+
+# Упорядоченный список миграций: (версия, описание, функция).
+# Новые миграции добавляются только в конец со следующим номером версии.
+MIGRATIONS = [
+    (1, "base schema", _create_base_schema),
+    (2, "users columns", _add_user_columns),
+    (3, "allowed_chats and promo_offers schema", _reconcile_legacy_tables),
+    (4, "unique promo_code index", _create_promo_code_index),
+    (5, "hot query indexes", _create_hot_indexes),
+    (6, "promo codes backfill", _backfill_promo_codes),
+    (7, "promo code sequence", _create_promo_code_sequence),
+    (8, "users.total_tasks column", _add_total_tasks),
+    (9, "total_tasks reconciliation", _reconcile_total_tasks),
+    (10, "tasks template reference columns", _add_task_template_columns),
+    (11, "compact task descriptions", _compact_task_descriptions),
+    (12, "tasks archive", _create_tasks_archive),
+    (13, "incremental auto_vacuum", _enable_incremental_vacuum),
+    (14, "loyalty ledger", _create_loyalty_ledger),
+    (15, "epoch timestamp columns", _add_epoch_columns),
+    (16, "epoch timestamp backfill", _backfill_epoch_columns),
+    (17, "epoch timestamp indexes", _create_epoch_indexes),
+    (18, "channel members", _create_channel_members),
+    (19, "loyalty check checkpoints", _create_loyalty_checks),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    """Текущая версия схемы; 0 для новой или старой базы без schema_version"""
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        return 0
+    return row[0] or 0
+
+def migrate(conn):
+    """Применение недостающих миграций.
+
+    Для актуальной схемы стоит один SELECT. Каждая схемная миграция идет в своей
+    транзакции вместе с записью в schema_version; backfill-миграции коммитят
+    пачками и после прерывания продолжают с оставшихся строк.
+    """
+    version = current_version(conn)
+    if version >= LATEST_VERSION:
+        return version
+
+    for step_version, name, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+
+        started = time.monotonic()
+        try:
+            if getattr(step, 'is_backfill', False):
+                step(conn)
+                conn.execute("BEGIN")
+            else:
+                conn.execute("BEGIN")
+                step(conn.cursor())
+            conn.execute(
+                "INSERT INTO schema_version (version, name) VALUES (?, ?)",
+                (step_version, name)
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Migration {step_version} ({name}) failed: {e}")
+            raise
+
+        logger.info(f"Applied migration {step_version} ({name}) in {time.monotonic() - started:.2f}s")
+
+    return LATEST_VERSION
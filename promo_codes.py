@@ -0,0 +1,72 @@
+import hashlib
+import string
+from config import PROMO_CODE_KEY
+
+ALPHABET = string.digits + string.ascii_uppercase
+CODE_LENGTH = 6
+CODE_SPACE = len(ALPHABET) ** CODE_LENGTH  # 36^6, влезает в 32 бита
+FEISTEL_ROUNDS = 4
+
+_KEY = PROMO_CODE_KEY.encode()[:64]
+
+class PromoCodesExhausted(Exception):
+    """Все 36^6 промокодов уже выданы"""
+
+def _round(half, round_no):
+    """Раундовая функция сети Фейстеля: 16 бит -> 16 бит"""
+    digest = hashlib.blake2b(
+        bytes((round_no,)) + half.to_bytes(2, 'big'),
+        key=_KEY, digest_size=2
+    ).digest()
+    return int.from_bytes(digest, 'big')
+
+def _feistel(value):
+    """Биекция на 32-битных числах"""
+    left, right = value >> 16, value & 0xFFFF
+    for round_no in range(FEISTEL_ROUNDS):
+        left, right = right, left ^ _round(right, round_no)
+    return (left << 16) | right
+
+def permute(seq):
+    """Биекция [0, 36^6) -> [0, 36^6): сеть Фейстеля с cycle-walking"""
+    if not 0 <= seq < CODE_SPACE:
+        raise PromoCodesExhausted(f"Sequence {seq} is outside the promo code space")
+    value = _feistel(seq)
+    while value >= CODE_SPACE:
+        value = _feistel(value)
+    return value
+
+def encode(value):
+    """Число -> 6 символов base36"""
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, digit = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+def code_for(seq):
+    """Промокод для порядкового номера; разные номера дают разные коды"""
+    return encode(permute(seq))
+
+def ensure_sequence(cur):
+    """Создание счетчика выданных промокодов"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS promo_code_seq (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_value INTEGER NOT NULL
+        )
+    ''')
+    cur.execute("INSERT OR IGNORE INTO promo_code_seq (id, next_value) VALUES (1, 0)")
+
+def allocate_codes(cur, count=1):
+    """Выдача count новых промокодов без проверочных SELECT.
+
+    Счетчик двигается в текущей транзакции. Коллизия возможна только со старыми
+    случайными кодами; ее ловит уникальный индекс, и вызывающий берет следующий код.
+    """
+    cur.execute(
+        "UPDATE promo_code_seq SET next_value = next_value + ? WHERE id = 1 RETURNING next_value",
+        (count,)
+    )
+    end = cur.fetchone()[0]
+    return [code_for(seq) for seq in range(end - count, end)]
@@ -0,0 +1,224 @@
+import functools
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from config import DB_SLOW_QUERY_MS, DB_QUERY_STATS_MAX, logger
+
+# Границы корзин гистограммы в секундах: от 50 мкс, каждая следующая вдвое больше
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(20))
+
+_SPACES = re.compile(r"\s+")
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """Текст запроса без литералов и лишних пробелов: ключ статистики"""
+    sql = _SPACES.sub(" ", sql).strip()
+    sql = _STRINGS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    return _PARAM_LISTS.sub("?, ...", sql)
+
+class QueryStat:
+    """Счетчики одного нормализованного запроса"""
+    __slots__ = ('count', 'total', 'max', 'rows', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def percentile(self, q):
+        """Верхняя граница корзины, в которую попадает q-й процентиль (секунды)"""
+        rank = q * self.count
+        seen = 0
+        for bound, hits in zip(BUCKETS, self.histogram):
+            seen += hits
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class QueryStats:
+    """Статистика выполнения SQL: число, время, p50/p95/p99, строки и журнал медленных"""
+
+    def __init__(self, slow_ms=DB_SLOW_QUERY_MS, max_queries=DB_QUERY_STATS_MAX, slow_log_size=50):
+        self.slow_threshold = slow_ms / 1000
+        self._max_queries = max_queries
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.slow_log = deque(maxlen=slow_log_size)
+
+    def record(self, sql, elapsed, rows):
+        """Учет одного выполнения запроса"""
+        key = normalize(sql)
+        index = 0
+        while index < len(BUCKETS) and elapsed > BUCKETS[index]:
+            index += 1
+        with self._lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                if len(self._stats) >= self._max_queries:
+                    return
+                stat = self._stats[key] = QueryStat()
+            stat.count += 1
+            stat.total += elapsed
+            stat.max = max(stat.max, elapsed)
+            stat.rows += rows
+            stat.histogram[index] += 1
+
+    def record_slow(self, sql, elapsed, plan):
+        """Медленный запрос: в лог и в последние записи для /db_status"""
+        self.slow_log.append((time.time(), normalize(sql), elapsed, plan))
+        logger.warning(
+            f"Slow query {elapsed * 1000:.1f} ms: {normalize(sql)}\n"
+            f"Query plan: {plan or 'n/a'}"
+        )
+
+    def top(self, limit=5):
+        """Запросы с наибольшим суммарным временем"""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+            return [
+                {
+                    'query': query,
+                    'count': stat.count,
+                    'total': stat.total,
+                    'avg': stat.total / stat.count,
+                    'p50': stat.percentile(0.50),
+                    'p95': stat.percentile(0.95),
+                    'p99': stat.percentile(0.99),
+                    'max': stat.max,
+                    'rows': stat.rows,
+                }
+                for query, stat in items
+            ]
+
+    def reset(self):
+        """Сброс статистики"""
+        with self._lock:
+            self._stats.clear()
+        self.slow_log.clear()
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет выполнение запроса вместе с выборкой его строк.
+
+    Замер закрывается, когда строки выбраны до конца (или их нет вовсе), при
+    следующем execute, close() или сборке брошенного курсора, поэтому время
+    fetchall() тоже попадает в статистику запроса.
+    """
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._start(sql, parameters, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._start(sql, None, started)
+
+    def _start(self, sql, parameters, started):
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = time.perf_counter() - started
+        self._rows = max(self.rowcount, 0)
+        # Запрос без строк результата (DML, BEGIN, COMMIT) завершен сразу
+        if self.description is None:
+            self._finish()
+
+    def _fetched(self, started, rows, done):
+        if self._sql is not None:
+            self._elapsed += time.perf_counter() - started
+            self._rows += rows
+            if done:
+                self._finish()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = size if size is not None else self.arraysize
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        self._fetched(started, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Брошенный курсор (conn.execute(...).fetchone()) тоже попадает в статистику
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    def _finish(self):
+        sql, self._sql = self._sql, None
+        stats = getattr(self.connection, 'stats', None)
+        if sql is None or stats is None:
+            return
+        stats.record(sql, self._elapsed, self._rows)
+        if self._elapsed >= stats.slow_threshold:
+            stats.record_slow(sql, self._elapsed, self._explain(sql))
+
+    def _explain(self, sql):
+        """EXPLAIN QUERY PLAN медленного запроса на том же соединении"""
+        if self._parameters is None:
+            return None
+        cur = sqlite3.Cursor(self.connection)
+        try:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, self._parameters)
+            return "; ".join(row[-1] for row in cur.fetchall())
+        except sqlite3.Error:
+            return None
+        finally:
+            cur.close()
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, у которого курсоры по умолчанию пишут статистику в self.stats"""
+
+    stats = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute создает курсор в C мимо self.cursor(), поэтому идем через него явно
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
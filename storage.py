@@ -0,0 +1,650 @@
+import itertools
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Protocol, Tuple, runtime_checkable
+from config import TASK_ARCHIVE_DAYS, TASK_ARCHIVE_BATCH_SIZE, logger
+from content_pool import ContentPool
+from promo_codes import code_for
+from user_mirror import UserMirror
+from utils import MEMBER_STATUSES, render_task_description, to_epoch
+
+# Маркеры маршрутизации вызовов в AsyncDatabase
+
+def reader(method):
+    """Помечает метод хранилища как только читающий (выполняется на пуле читателей)"""
+    method.is_reader = True
+    return method
+
+def in_memory(method):
+    """Помечает метод хранилища как работающий только с памятью (без потоков и SQLite)"""
+    method.in_memory = True
+    return method
+
+def grouped(method):
+    """Помечает запись хранилища как допускающую групповой коммит вместе с соседними"""
+    method.is_grouped = True
+    return method
+
+def next_channel_member(row, status, changed_ts, now):
+    """Новая строка участника канала (status, joined_ts, left_ts, updated_ts) или None для запоздавшего события.
+
+    row - текущая строка или None. changed_ts - момент смены статуса из обновления
+    chat_member; без него это результат запроса к API, и смена статуса датируется
+    моментом наблюдения now. Общее правило для Database и MemoryStorage.
+    """
+    if row and changed_ts is not None and changed_ts < max(row[1] or 0, row[2] or 0):
+        return None
+    is_member = status in MEMBER_STATUSES
+    joined_ts, left_ts = (row[1], row[2]) if row else (None, None)
+    if row is None or is_member != (row[0] in MEMBER_STATUSES):
+        # Для нового пользователя без события момент вступления/выхода неизвестен
+        moment = changed_ts if changed_ts is not None else (now if row else None)
+        if is_member:
+            joined_ts = moment
+        else:
+            left_ts = moment
+    return status, joined_ts, left_ts, max(now, changed_ts or 0)
+
+@runtime_checkable
+class Storage(Protocol):
+    """Операции хранилища, которыми пользуются обработчики.
+
+    Реализации: database.Database (SQLite) и MemoryStorage (память, для тестов
+    и нагрузочных прогонов). Обработчики ходят к ним через AsyncDatabase.
+    """
+
+    # Пользователи
+    def get_or_create_user(self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None,
+                           last_name: Optional[str] = None, ref_by: Optional[int] = None) -> str: ...
+    def get_user_stats(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+    def user_exists(self, user_id: int) -> bool: ...
+    def get_username(self, user_id: int) -> Optional[str]: ...
+    def get_ref_by(self, user_id: int) -> Optional[int]: ...
+    def set_referrer(self, user_id: int, referrer_id: int) -> None: ...
+    def get_user_by_username(self, username: str) -> Optional[int]: ...
+    def get_user_by_promo_code(self, promo_code: str) -> Optional[int]: ...
+    def get_all_users(self) -> List[int]: ...
+    def count_users(self) -> int: ...
+    def count_users_joined_since(self, since_ts: int) -> int: ...
+    def get_recent_users(self, limit: int = 3) -> List[Tuple[int, Optional[str], str]]: ...
+    def export_users(self) -> List[Tuple]: ...
+
+    # Задания
+    def create_task(self, user_id: int, task_type: str, template_id: Optional[int] = None) -> int: ...
+    def approve_task(self, task_id: int, user_id: int) -> None: ...
+    def decline_task(self, task_id: int, user_id: int) -> None: ...
+    def cancel_task(self, user_id: int) -> bool: ...
+    def update_screenshot_path(self, task_id: int, screenshot_path: str) -> None: ...
+    def get_task(self, task_id: int) -> Optional[Tuple[int, str]]: ...
+    def get_task_description(self, task_id: int) -> Optional[str]: ...
+    def get_last_pending_task(self, user_id: int) -> Optional[int]: ...
+    def get_pending_tasks(self) -> Optional[Tuple[int, int, str, Any]]: ...
+    def create_promo_task(self, user_id: int, offer_id: int) -> int: ...
+
+    # Контент
+    def get_random_meme(self, user_id: Optional[int] = None) -> Optional[Tuple[int, str]]: ...
+    def get_all_memes(self) -> List[Tuple[int, str]]: ...
+    def add_meme(self, file_path: str, text: str = "") -> None: ...
+    def delete_meme(self, meme_id: int) -> bool: ...
+    def get_random_text(self, user_id: Optional[int] = None) -> Optional[Tuple[int, str]]: ...
+    def get_all_texts(self) -> List[Tuple[int, str]]: ...
+    def add_text(self, text: str) -> None: ...
+    def delete_text(self, text_id: int) -> None: ...
+    def get_random_chats(self, limit: int = 5) -> List[str]: ...
+    def get_all_chats(self) -> List[str]: ...
+    def add_chat(self, chat_username: str) -> None: ...
+    def delete_chat(self, chat_username: str) -> None: ...
+
+    # Промо-офферы и купоны
+    def get_promo_offers(self) -> List[Tuple[int, str, int]]: ...
+    def get_promo_offer(self, offer_id: int) -> Optional[Tuple[str, int]]: ...
+    def add_promo_offer(self, title: str, cost: int) -> None: ...
+    def delete_promo_offer(self, offer_id: int) -> None: ...
+    def purchase_offer(self, user_id: int, offer_id: int) -> Optional[Tuple[Optional[int], str, int]]: ...
+    def add_coupon(self, code: str, coupon_type: str) -> None: ...
+
+    # Лояльность
+    def get_loyal_balance(self, user_id: int) -> Optional[Tuple[int, int]]: ...
+    def is_loyal_referral_credited(self, referrer_id: int, referral_id: int) -> bool: ...
+    def credit_loyal_referral(self, referrer_id: int, referral_id: int) -> bool: ...
+    def add_used_loyal(self, user_id: int, amount: int) -> bool: ...
+    def set_loyal_referrals(self, user_id: int, value: int) -> None: ...
+    def fold_loyalty_ledger(self) -> Dict[str, int]: ...
+    def get_referrals_to_verify(self, before_ts: int, after_user_id: int = 0,
+                                limit: int = 200) -> List[Tuple[int, int]]: ...
+    def start_loyalty_check(self, cutoff_ts: int) -> Tuple[int, int, int, Dict[str, int]]: ...
+    def save_loyalty_check_batch(self, check_id: int, last_user_id: int, members: List[Tuple[int, str]],
+                                 credits: List[Tuple[int, int]], counters: Dict[str, int]) -> int: ...
+    def finish_loyalty_check(self, check_id: int) -> None: ...
+
+    # Участники канала
+    def get_channel_member(self, user_id: int) -> Optional[Tuple[str, Optional[int], Optional[int], int]]: ...
+    def record_channel_member(self, user_id: int, status: str, changed_ts: Optional[int] = None) -> bool: ...
+
+    # Обслуживание и диагностика (админские команды и плановые задания)
+    def archive_tasks(self, older_than_days: int = TASK_ARCHIVE_DAYS, batch_size: int = TASK_ARCHIVE_BATCH_SIZE) -> int: ...
+    def get_lock_stats(self) -> Dict[str, Any]: ...
+    def get_query_stats(self, limit: int = 5) -> Tuple[List[Dict[str, Any]], List[Tuple]]: ...
+    def get_integrity_report(self) -> Dict[str, Optional[Dict[str, Any]]]: ...
+
+    def close(self) -> None: ...
+
+class MemoryStorage:
+    """Хранилище целиком в памяти с тем же поведением, что и Database.
+
+    Все методы помечены @in_memory, поэтому AsyncDatabase вызывает их прямо в
+    event loop. Данные живут до конца процесса.
+    """
+
+    path = ":memory:"
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.users = UserMirror()
+        self._profiles = {}
+        self._promo_seq = itertools.count()
+        self._tasks = {}
+        self._archived = {}
+        self._task_ids = itertools.count(1)
+        self._memes = {}
+        self._texts = {}
+        self._chats = set()
+        self._content_ids = itertools.count(1)
+        self._offers = {}
+        self._offer_ids = itertools.count(1)
+        self._coupons = []
+        self._credited = set()
+        self._ledger = []
+        self._folded = 0
+        self.channel_members = {}
+        self._loyalty_checks = {}
+        self._loyalty_check_ids = itertools.count(1)
+        self.memes = ContentPool(lambda: sorted(self._memes.items()))
+        self.texts = ContentPool(lambda: sorted(self._texts.items()))
+        self.chats = ContentPool(lambda: [(chat, chat) for chat in sorted(self._chats)])
+
+    # ——— Пользователи ———
+
+    @in_memory
+    def get_or_create_user(self, user_id, username=None, first_name=None, last_name=None, ref_by=None):
+        """Получение или создание пользователя"""
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is None:
+                promo_code = code_for(next(self._promo_seq))
+                now = datetime.now()
+                self.users.add(user_id, username=username, promo_code=promo_code, ref_by=ref_by)
+                self._profiles[user_id] = (first_name, last_name, now.isoformat(), to_epoch(now))
+                logger.info(f"Created new user: {user_id} (@{username or 'нет'})")
+                return promo_code
+            if ref_by is not None and user.ref_by is None:
+                self.users.update(user_id, ref_by=ref_by)
+            return user.promo_code
+
+    @in_memory
+    def get_user_stats(self, user_id):
+        """Получение статистики пользователя"""
+        user = self.users.get(user_id)
+        return user.as_stats() if user else None
+
+    @in_memory
+    def user_exists(self, user_id):
+        """Проверка существования пользователя"""
+        return user_id in self.users
+
+    @in_memory
+    def get_username(self, user_id):
+        """Получение username пользователя"""
+        user = self.users.get(user_id)
+        return user.username if user else None
+
+    @in_memory
+    def get_ref_by(self, user_id):
+        """Получение реферера пользователя"""
+        user = self.users.get(user_id)
+        return user.ref_by if user else None
+
+    @in_memory
+    def set_referrer(self, user_id, referrer_id):
+        """Привязка реферера и увеличение его счетчика рефералов"""
+        with self._lock:
+            self.users.update(user_id, ref_by=referrer_id)
+            self.users.increment(referrer_id, 'referrals_count')
+
+    @in_memory
+    def get_user_by_username(self, username):
+        """Получение пользователя по username"""
+        return self.users.by_username(username)
+
+    @in_memory
+    def get_user_by_promo_code(self, promo_code):
+        """Получение пользователя по промокоду"""
+        return self.users.by_promo_code(promo_code)
+
+    @in_memory
+    def get_all_users(self):
+        """Получение всех пользователей"""
+        return self.users.user_ids()
+
+    @in_memory
+    def count_users(self):
+        """Общее количество пользователей"""
+        return len(self.users)
+
+    @in_memory
+    def count_users_joined_since(self, since_ts):
+        """Количество пользователей, пришедших начиная с момента (секунды Unix)"""
+        return sum(1 for profile in self._profiles.values() if profile[3] >= since_ts)
+
+    @in_memory
+    def get_recent_users(self, limit=3):
+        """Последние зарегистрированные пользователи"""
+        latest = sorted(self._profiles.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [(user_id, self.users.get(user_id).username, profile[2]) for user_id, profile in latest]
+
+    @in_memory
+    def export_users(self):
+        """Выгрузка пользователей для CSV"""
+        return [
+            (user_id, self.users.get(user_id).username, first_name, last_name,
+             self.users.get(user_id).ref_by, joined_date)
+            for user_id, (first_name, last_name, joined_date, _) in self._profiles.items()
+        ]
+
+    # ——— Задания ———
+
+    def _new_task(self, user_id, task_type, **fields):
+        now = datetime.now()
+        task_id = next(self._task_ids)
+        task = dict(
+            user_id=user_id, task_type=task_type, status='pending', screenshot_path=None,
+            template_id=None, template_kind=None, promo_code=None, task_description=None,
+            created_at=now, created_ts=to_epoch(now), decided_at=None
+        )
+        task.update(fields)
+        self._tasks[task_id] = task
+        self.users.increment(user_id, 'total_tasks')
+        return task_id
+
+    @in_memory
+    def create_task(self, user_id, task_type, template_id=None):
+        """Создание нового задания (хранится ссылка на шаблон и промокод, а не текст)"""
+        with self._lock:
+            user = self.users.get(user_id)
+            task_id = self._new_task(
+                user_id, task_type, template_id=template_id, template_kind=task_type,
+                promo_code=user.promo_code if user else None
+            )
+            self.users.increment(user_id, 'pending_tasks')
+            return task_id
+
+    @in_memory
+    def create_promo_task(self, user_id, offer_id):
+        """Создание заявки на промо"""
+        with self._lock:
+            return self._new_task(user_id, 'promo', task_description=f"offer:{offer_id}")
+
+    @in_memory
+    def approve_task(self, task_id, user_id):
+        """Одобрение задания"""
+        with self._lock:
+            # Как UPDATE в SQLite: неизвестное задание не меняется, счетчики пользователя меняются
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task.update(status='approved', decided_at=datetime.now())
+            self.users.increment(user_id, 'pending_tasks', -1)
+            self.users.increment(user_id, 'completed_tasks')
+
+    @in_memory
+    def decline_task(self, task_id, user_id):
+        """Отклонение задания"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task.update(status='declined', decided_at=datetime.now())
+            self.users.increment(user_id, 'pending_tasks', -1)
+
+    @in_memory
+    def cancel_task(self, user_id):
+        """Отмена последнего задания пользователя"""
+        with self._lock:
+            task_id = self.get_last_pending_task(user_id)
+            if task_id is None:
+                return False
+            del self._tasks[task_id]
+            self.users.increment(user_id, 'pending_tasks', -1, 0)
+            self.users.increment(user_id, 'total_tasks', -1)
+            return True
+
+    @in_memory
+    def update_screenshot_path(self, task_id, screenshot_path):
+        """Сохранение пути к скриншоту задания"""
+        with self._lock:
+            if task_id in self._tasks:
+                self._tasks[task_id]['screenshot_path'] = screenshot_path
+
+    @in_memory
+    def get_task(self, task_id):
+        """Получение (user_id, task_type) задания"""
+        task = self._tasks.get(task_id)
+        return (task['user_id'], task['task_type']) if task else None
+
+    @in_memory
+    def get_task_description(self, task_id):
+        """Текст задания, собранный из шаблона и промокода"""
+        task = self._tasks.get(task_id) or self._archived.get(task_id)
+        if task is None:
+            return None
+        text = self._texts.get(task['template_id']) if task['template_kind'] == 'text' else None
+        return render_task_description(task['template_kind'], task['promo_code'], text, task['task_description'])
+
+    @in_memory
+    def get_last_pending_task(self, user_id):
+        """Получение ID последнего ожидающего задания пользователя"""
+        pending = [
+            (task['created_ts'], task_id) for task_id, task in self._tasks.items()
+            if task['user_id'] == user_id and task['status'] == 'pending'
+        ]
+        return max(pending)[1] if pending else None
+
+    @in_memory
+    def get_pending_tasks(self):
+        """Получение ожидающих заданий"""
+        ready = [
+            (task['created_ts'], task_id) for task_id, task in self._tasks.items()
+            if task['status'] == 'pending' and task['screenshot_path'] is not None
+        ]
+        if not ready:
+            return None
+        task_id = min(ready)[1]
+        task = self._tasks[task_id]
+        return task_id, task['user_id'], task['screenshot_path'], task['created_at']
+
+    # ——— Контент ———
+
+    @in_memory
+    def get_random_meme(self, user_id=None):
+        """Получение случайного мема (без повторов для user_id, пока мемы не закончатся)"""
+        if user_id is not None:
+            return self.memes.next_for_user(user_id)
+        return self.memes.random()
+
+    @in_memory
+    def get_all_memes(self):
+        """Получение всех мемов"""
+        return sorted(self._memes.items())
+
+    @in_memory
+    def add_meme(self, file_path, text=""):
+        """Добавление шаблона мема"""
+        with self._lock:
+            self._memes[next(self._content_ids)] = file_path
+        self.memes.invalidate()
+
+    @in_memory
+    def delete_meme(self, meme_id):
+        """Удаление мема по ID"""
+        with self._lock:
+            file_path = self._memes.pop(meme_id, None)
+        if file_path is None:
+            return False
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить файл {file_path}: {e}")
+        self.memes.invalidate()
+        return True
+
+    @in_memory
+    def get_random_text(self, user_id=None):
+        """Получение случайного текста (без повторов для user_id, пока тексты не закончатся)"""
+        if user_id is not None:
+            return self.texts.next_for_user(user_id)
+        return self.texts.random()
+
+    @in_memory
+    def get_all_texts(self):
+        """Получение всех текстовых шаблонов"""
+        return sorted(self._texts.items())
+
+    @in_memory
+    def add_text(self, text):
+        """Добавление текстового шаблона"""
+        with self._lock:
+            self._texts[next(self._content_ids)] = text
+        self.texts.invalidate()
+
+    @in_memory
+    def delete_text(self, text_id):
+        """Удаление текстового шаблона"""
+        with self._lock:
+            text = self._texts.pop(text_id, None)
+            # Задания со ссылкой на шаблон сохраняют его текст у себя
+            for task in self._tasks.values():
+                if task['template_kind'] == 'text' and task['template_id'] == text_id:
+                    task.update(task_description=text, template_id=None, template_kind=None)
+        self.texts.invalidate()
+
+    @in_memory
+    def get_random_chats(self, limit=5):
+        """Получение случайных чатов"""
+        return [chat for chat, _ in self.chats.sample(limit)]
+
+    @in_memory
+    def get_all_chats(self):
+        """Получение всех чатов, отсортированных по имени"""
+        return sorted(self._chats)
+
+    @in_memory
+    def add_chat(self, chat_username):
+        """Добавление разрешенного чата"""
+        with self._lock:
+            self._chats.add(chat_username)
+        self.chats.invalidate()
+
+    @in_memory
+    def delete_chat(self, chat_username):
+        """Удаление разрешенного чата"""
+        with self._lock:
+            self._chats.discard(chat_username)
+        self.chats.invalidate()
+
+    # ——— Промо-офферы и купоны ———
+
+    @in_memory
+    def get_promo_offers(self):
+        """Получение списка промо-офферов"""
+        return [(offer_id, title, cost) for offer_id, (title, cost) in self._offers.items()]
+
+    @in_memory
+    def get_promo_offer(self, offer_id):
+        """Получение (title, cost) промо-оффера"""
+        return self._offers.get(int(offer_id))
+
+    @in_memory
+    def add_promo_offer(self, title, cost):
+        """Добавление промо-оффера"""
+        with self._lock:
+            self._offers[next(self._offer_ids)] = (title, cost)
+
+    @in_memory
+    def delete_promo_offer(self, offer_id):
+        """Удаление промо-оффера"""
+        with self._lock:
+            self._offers.pop(int(offer_id), None)
+
+    @in_memory
+    def purchase_offer(self, user_id, offer_id):
+        """Покупка промо-оффера: (task_id, title, cost), None или (None, title, cost)"""
+        with self._lock:
+            offer = self._offers.get(int(offer_id))
+            if offer is None:
+                return None
+            title, cost = offer
+            task_id = self.create_promo_task(user_id, offer_id)
+            # Как и в SQLite, заявка откатывается, если баланса не хватило
+            if not self._post_loyalty(user_id, spent=cost, reason='purchase', ref_id=task_id):
+                del self._tasks[task_id]
+                self.users.increment(user_id, 'total_tasks', -1)
+                return None, title, cost
+            return task_id, title, cost
+
+    @in_memory
+    def add_coupon(self, code, coupon_type):
+        """Сохранение выданного купона"""
+        with self._lock:
+            self._coupons.append((code, coupon_type))
+
+    # ——— Лояльность ———
+
+    def _post_loyalty(self, user_id, earned=0, spent=0, reason='adjust', ref_id=None):
+        """Запись в журнал и изменение баланса; списание только при достаточном балансе"""
+        user = self.users.get(user_id)
+        if user is None or (spent > 0 and user.loyal_referrals - user.used_loyal + earned < spent):
+            return False
+        self._ledger.append((user_id, earned, spent, reason, ref_id))
+        self.users.update(
+            user_id, loyal_referrals=user.loyal_referrals + earned, used_loyal=user.used_loyal + spent
+        )
+        return True
+
+    @in_memory
+    def get_loyal_balance(self, user_id):
+        """Получение (loyal_referrals, used_loyal) пользователя"""
+        user = self.users.get(user_id)
+        return (user.loyal_referrals, user.used_loyal) if user else None
+
+    @in_memory
+    def is_loyal_referral_credited(self, referrer_id, referral_id):
+        """Проверяет, был ли уже начислен преданный реферал"""
+        return (referrer_id, referral_id) in self._credited
+
+    @in_memory
+    def credit_loyal_referral(self, referrer_id, referral_id):
+        """Начисление преданного реферала ровно один раз; True если начислен сейчас"""
+        with self._lock:
+            if referrer_id not in self.users or (referrer_id, referral_id) in self._credited:
+                return False
+            self._credited.add((referrer_id, referral_id))
+            return self._post_loyalty(referrer_id, earned=1, reason='referral', ref_id=referral_id)
+
+    @in_memory
+    def add_used_loyal(self, user_id, amount):
+        """Списание преданных рефералов; False если баланса не хватает"""
+        if not amount:
+            return True
+        with self._lock:
+            return self._post_loyalty(user_id, spent=amount, reason='spend')
+
+    @in_memory
+    def set_loyal_referrals(self, user_id, value):
+        """Установка счетчика преданных рефералов корректирующей записью журнала"""
+        with self._lock:
+            user = self.users.get(user_id)
+            if user and value != user.loyal_referrals:
+                self._post_loyalty(user_id, earned=value - user.loyal_referrals, reason='adjust')
+
+    @in_memory
+    def fold_loyalty_ledger(self):
+        """Сверка журнала: балансы в памяти меняются вместе с журналом, расхождений не бывает"""
+        with self._lock:
+            entries = self._ledger[self._folded:]
+            self._folded = len(self._ledger)
+        return {'entries': len(entries), 'users': len({entry[0] for entry in entries}), 'repaired': 0}
+
+    @in_memory
+    def get_referrals_to_verify(self, before_ts, after_user_id=0, limit=200):
+        """Следующая страница (user_id, ref_by) еще не засчитанных рефералов, пришедших до before_ts"""
+        rows = []
+        for user_id in sorted(self._profiles):
+            user = self.users.get(user_id)
+            if (user_id > after_user_id and user.ref_by is not None and self._profiles[user_id][3] < before_ts
+                    and (user.ref_by, user_id) not in self._credited):
+                rows.append((user_id, user.ref_by))
+                if len(rows) == limit:
+                    break
+        return rows
+
+    @in_memory
+    def start_loyalty_check(self, cutoff_ts):
+        """Незавершенная проверка или новая с порогом cutoff_ts: (check_id, cutoff_ts, last_user_id, счетчики)"""
+        with self._lock:
+            for check_id, check in sorted(self._loyalty_checks.items(), reverse=True):
+                if check['status'] == 'running':
+                    return check_id, check['cutoff_ts'], check['last_user_id'], dict(check['counters'])
+            check_id = next(self._loyalty_check_ids)
+            self._loyalty_checks[check_id] = {
+                'status': 'running', 'cutoff_ts': cutoff_ts, 'last_user_id': 0,
+                'counters': dict.fromkeys(('processed', 'subscribed', 'credited', 'too_recent', 'failed'), 0),
+            }
+            return check_id, cutoff_ts, 0, dict(self._loyalty_checks[check_id]['counters'])
+
+    @in_memory
+    def save_loyalty_check_batch(self, check_id, last_user_id, members, credits, counters):
+        """Результаты пачки проверки и контрольная точка; число новых начислений"""
+        with self._lock:
+            for user_id, status in members:
+                self.record_channel_member(user_id, status)
+            credited = sum(self.credit_loyal_referral(referrer_id, referral_id) for referrer_id, referral_id in credits)
+            check = self._loyalty_checks[check_id]
+            check['last_user_id'] = last_user_id
+            check['counters'] = dict(counters, credited=counters['credited'] + credited)
+            return credited
+
+    @in_memory
+    def finish_loyalty_check(self, check_id):
+        """Отметка о завершении проверки"""
+        with self._lock:
+            self._loyalty_checks[check_id]['status'] = 'done'
+
+    # ——— Участники канала ———
+
+    @in_memory
+    def get_channel_member(self, user_id):
+        """(status, joined_ts, left_ts, updated_ts) участника канала или None"""
+        return self.channel_members.get(user_id)
+
+    @in_memory
+    def record_channel_member(self, user_id, status, changed_ts=None):
+        """Сохранение статуса участника канала (правила те же, что в Database)"""
+        with self._lock:
+            member = next_channel_member(self.channel_members.get(user_id), status, changed_ts, to_epoch())
+            if member is None:
+                return False
+            self.channel_members[user_id] = member
+            return True
+
+    # ——— Обслуживание и диагностика ———
+
+    @in_memory
+    def archive_tasks(self, older_than_days=TASK_ARCHIVE_DAYS, batch_size=TASK_ARCHIVE_BATCH_SIZE):
+        """Перенос давно решенных заданий в архив"""
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+        with self._lock:
+            ids = [
+                task_id for task_id, task in self._tasks.items()
+                if task['status'] in ('approved', 'declined') and task['decided_at'] < cutoff
+            ]
+            for task_id in ids:
+                self._archived[task_id] = self._tasks.pop(task_id)
+        return len(ids)
+
+    @in_memory
+    def get_lock_stats(self):
+        """Статистика ожидания блокировки записи (в памяти ожиданий нет)"""
+        return {'transactions': 0, 'retries': 0, 'failures': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'wait_avg': 0.0}
+
+    @in_memory
+    def get_query_stats(self, limit=5):
+        """Самые затратные запросы и последние медленные (SQL в памяти не выполняется)"""
+        return [], []
+
+    @in_memory
+    def get_integrity_report(self):
+        """Последние результаты проверки целостности (для памяти не выполняются)"""
+        return {'quick': None, 'full': None}
+
+    def close(self):
+        """Хранилищу в памяти закрывать нечего"""
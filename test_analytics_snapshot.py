@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Проверка снимка для аналитики: запросы идут в копию, а не в рабочую базу
+"""
+
+from analytics import AnalyticsSnapshot, parse_mode
+from database import Database
+from utils import to_epoch
+
+def test_snapshot_serves_admin_queries_until_refreshed(tmp_path):
+    """Снимок отвечает теми же методами, что и база, и видит новые данные только после refresh()"""
+    database = Database(str(tmp_path / "live.db"), readers=1)
+    database.get_or_create_user(1, "first")
+    snapshot = AnalyticsSnapshot(database, str(tmp_path / "analytics.db"))
+    assert snapshot.age() is None
+    snapshot.ensure_fresh()
+
+    database.get_or_create_user(2, "second", ref_by=1)
+    assert snapshot.count_users() == 1
+    assert [row[0] for row in snapshot.export_users()] == [1]
+
+    snapshot.ensure_fresh(max_age=0)
+    assert snapshot.count_users() == database.count_users() == 2
+    assert snapshot.count_users_joined_since(0) == 2
+    assert snapshot.get_referrals_to_verify(to_epoch() + 60) == [(2, 1)]
+    snapshot.close()
+    database.close()
+
+def test_parse_mode_defaults_to_snapshot():
+    assert parse_mode(None) == parse_mode([]) == parse_mode(["whatever"]) == 'snapshot'
+    assert parse_mode(["LIVE"]) == 'live' and parse_mode(["fresh"]) == 'fresh'
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Проверка асинхронного фасада: записи в потоке-писателе, чтения на пуле, event loop не блокируется
+"""
+
+import asyncio
+import threading
+import time
+from database import AsyncDatabase, Database
+from storage import in_memory, reader
+
+class ProbeDatabase(Database):
+    """База с методами, которые сообщают, в каком потоке их выполнили"""
+
+    @reader
+    def probe_read(self):
+        return threading.current_thread().name
+
+    def probe_write(self):
+        return threading.current_thread().name
+
+    @in_memory
+    def probe_memory(self):
+        return threading.current_thread().name
+
+def test_calls_are_routed_by_method_marker(tmp_path):
+    """@reader идет на пул читателей, запись - в поток-писатель, @in_memory - прямо в event loop"""
+    async_database = AsyncDatabase(ProbeDatabase(str(tmp_path / "probe.db"), readers=2), readers=2, max_rows=0)
+
+    async def scenario():
+        return await async_database.probe_read(), await async_database.probe_write(), await async_database.probe_memory()
+
+    read_thread, write_thread, memory_thread = asyncio.run(scenario())
+    assert read_thread.startswith("db-read")
+    assert write_thread.startswith("db_")
+    assert memory_thread == threading.main_thread().name
+    async_database.close()
+
+def test_slow_write_blocks_neither_event_loop_nor_reads(tmp_path):
+    """Пока поток-писатель занят, event loop крутится, а чтения выполняются на пуле"""
+    database = Database(str(tmp_path / "slow.db"), readers=2)
+    database.get_or_create_user(1, "user")
+    task_id = database.create_task(1, "meme")
+    async_database = AsyncDatabase(database, readers=2, max_rows=0)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.create_task(ticker())
+        write = asyncio.ensure_future(async_database.run(time.sleep, 0.3))
+        started = time.monotonic()
+        task = await async_database.get_task(task_id)
+        read_seconds = time.monotonic() - started
+        await write
+        ticking.cancel()
+        return ticks, task, read_seconds
+
+    ticks, task, read_seconds = asyncio.run(scenario())
+    assert task == (1, "meme")
+    assert read_seconds < 0.2
+    assert ticks >= 10
+    async_database.close()
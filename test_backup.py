@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Проверка онлайн-бэкапа: записи во время бэкапа не ждут его окончания и попадают в снимок
+"""
+
+import gzip
+import os
+import sqlite3
+import threading
+import time
+import pytest
+import backup
+from backup import create_snapshot, list_snapshots
+from database import Database
+
+def test_snapshot_does_not_block_writes(tmp_path):
+    """Запись между шагами бэкапа проходит сразу, снимок цел, ротация оставляет keep файлов"""
+    database = Database(str(tmp_path / "live.db"), readers=1)
+    for user_id in range(1, 1001):
+        database.get_or_create_user(user_id, f"user{user_id}")
+    backups = str(tmp_path / "backups")
+    create_snapshot(database, directory=backups, keep=2)
+    create_snapshot(database, directory=backups, keep=2)
+
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(
+        snapshot=create_snapshot(database, directory=backups, keep=2, pages=1, pause_ms=10)
+    ))
+    worker.start()
+    while worker.is_alive() and not any(name.endswith(".db.tmp") for name in os.listdir(backups)):
+        time.sleep(0.001)
+
+    started = time.monotonic()
+    database.get_or_create_user(5000, "late")
+    write_time = time.monotonic() - started
+    backup_running = worker.is_alive()
+    worker.join()
+
+    assert backup_running and write_time < 0.5
+    assert len(list_snapshots(backups)) == 2
+
+    restored = tmp_path / "restored.db"
+    with gzip.open(result['snapshot'][0], 'rb') as src:
+        restored.write_bytes(src.read())
+    conn = sqlite3.connect(str(restored))
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 1001
+    conn.close()
+    database.close()
+
+def test_failed_snapshot_leaves_no_temp_files(tmp_path, monkeypatch):
+    """Ошибка копирования или сжатия не оставляет временных файлов в каталоге бэкапов"""
+    database = Database(str(tmp_path / "live.db"), readers=1)
+    database.get_or_create_user(1, "user1")
+    backups = str(tmp_path / "backups")
+
+    def broken_backup(target, **kwargs):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, "backup_to", broken_backup)
+        with pytest.raises(sqlite3.OperationalError):
+            create_snapshot(database, directory=backups)
+    assert os.listdir(backups) == []
+
+    def broken_copy(src, dst):
+        dst.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(backup.shutil, "copyfileobj", broken_copy)
+    with pytest.raises(OSError):
+        create_snapshot(database, directory=backups)
+    assert os.listdir(backups) == []
+    database.close()
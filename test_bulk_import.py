@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Проверка массового импорта пользователей через INSERT ... ON CONFLICT пачками
+"""
+
+from database import Database
+
+def test_bulk_upsert_inserts_updates_and_keeps_codes_unique(tmp_path):
+    """Новые получают свободные промокоды, существующие обновляются без смены кода и реферера"""
+    path = str(tmp_path / "import.db")
+    database = Database(path, readers=1)
+    owner_code = database.get_or_create_user(1, "owner", ref_by=None)
+    database.get_or_create_user(2, "friend", ref_by=1)
+
+    records = [
+        (2, "friend_renamed", None, None, 5, None, None),
+        {'user_id': '3', 'username': 'legacy', 'ref_by': '1', 'joined_date': '2024-01-02 10:00:00',
+         'promo_code': 'OLD123'},
+        # Код уже занят владельцем - выдается новый
+        {'user_id': 4, 'username': 'clash', 'promo_code': owner_code},
+    ] + [(uid, f"bulk{uid}") for uid in range(5, 105)] + [(104, "bulk104_last")]
+    progress = []
+    stats = database.bulk_upsert_users(records, chunk_size=40, progress=progress.append)
+
+    assert (stats['rows'], stats['inserted'], stats['updated'], stats['chunks']) == (104, 102, 1, 3)
+    assert len(progress) == 3 and stats['rows_per_sec'] > 0
+
+    assert database.get_user_by_promo_code('OLD123') == 3
+    assert database.get_user_by_promo_code(owner_code) == 1
+    assert database.get_ref_by(2) == 1
+    assert database.get_username(2) == "friend_renamed"
+    assert database.get_user_by_username("bulk104_last") == 104
+    database.close()
+
+    # Зеркало после импорта совпадает с тем, что лежит в базе
+    restarted = Database(path, readers=1)
+    codes = [restarted.get_user_stats(uid)['promo_code'] for uid in range(1, 105)]
+    assert None not in codes and len(set(codes)) == len(codes)
+    assert restarted.count_users_joined_since(0) == 104
+    restarted.close()
+
+def test_bulk_upsert_rename_updates_username_index(tmp_path):
+    """Переименование при импорте переносит поиск по username на новое имя"""
+    database = Database(str(tmp_path / "rename.db"), readers=1)
+    database.get_or_create_user(1, "alice")
+    database.bulk_upsert_users([(1, "alice2")])
+
+    assert database.get_username(1) == "alice2"
+    assert database.get_user_by_username("alice2") == 1
+    assert database.get_user_by_username("alice") is None
+    database.close()
+
+def test_bulk_upsert_skips_malformed_records_and_reads_dates_like_migration(tmp_path):
+    """Битые записи пропускаются со счетчиком, даты переводятся в epoch по тому же правилу, что и backfill"""
+    database = Database(str(tmp_path / "malformed.db"), readers=1)
+    records = [
+        (1, "good", None, None, None, "2024-01-02 10:00:00"),
+        ("not-a-number", "bad_id"),
+        (2, "bad_date", None, None, None, "02.01.2024"),
+        (3, "bad_ref", None, None, "owner"),
+        (None, "no_id"),
+        (4, "offset", None, None, None, "2024-01-02T10:00:00+00:00"),
+    ]
+    stats = database.bulk_upsert_users(records)
+
+    assert (stats['rows'], stats['inserted'], stats['skipped']) == (6, 2, 4)
+    assert database.get_user_by_username("good") == 1
+    # Как у миграции epoch-колонок: текстовая дата в базе - местное время
+    rows = database.conn.execute(
+        "SELECT user_id, joined_ts, CAST(strftime('%s', joined_date, 'utc') AS INTEGER) FROM users ORDER BY user_id"
+    ).fetchall()
+    assert [row[1] for row in rows] == [row[2] for row in rows]
+    assert rows[1][1] == 1704189600
+    database.close()
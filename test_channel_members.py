@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Проверка таблицы участников канала и проверки подписки через нее
+"""
+
+import asyncio
+import utils
+from database import AsyncDatabase, Database
+from storage import MemoryStorage
+from test_subscription_cache import FakeBot
+
+def test_events_track_join_and_leave_times(tmp_path):
+    """События chat_member задают время вступления/выхода, запоздавшие события игнорируются"""
+    path = str(tmp_path / "members.db")
+    database = Database(path, readers=1)
+    assert database.record_channel_member(1, 'member', changed_ts=1000)
+    assert database.record_channel_member(1, 'left', changed_ts=2000)
+    assert not database.record_channel_member(1, 'member', changed_ts=1500)
+    status, joined_ts, left_ts, _ = database.get_channel_member(1)
+    assert (status, joined_ts, left_ts) == ('left', 1000, 2000)
+
+    # Результат запроса к API без события: время вступления неизвестно
+    database.record_channel_member(2, 'member')
+    assert database.get_channel_member(2)[1] is None
+    database.close()
+
+    reopened = Database(path, readers=1)
+    assert reopened.get_channel_member(1)[:3] == ('left', 1000, 2000)
+    reopened.close()
+
+def test_subscription_check_uses_fresh_table_and_records_api_results(monkeypatch):
+    """Свежий статус из таблицы отвечает без API, устаревший уходит в API и обновляет таблицу"""
+    utils.clear_subscription_cache()
+    storage = MemoryStorage()
+    monkeypatch.setattr(utils, "_membership_store", AsyncDatabase(storage, max_rows=0))
+    bot = FakeBot(status='member', delay=0)
+
+    storage.record_channel_member(5, 'left', changed_ts=utils.to_epoch())
+    assert not asyncio.run(utils.is_user_subscribed(bot, 5))
+    assert bot.calls == 0
+
+    storage.channel_members[6] = ('left', None, 1, 1)
+    assert asyncio.run(utils.is_user_subscribed(bot, 6))
+    assert bot.calls == 1
+    assert storage.get_channel_member(6)[0] == 'member'
+    utils.clear_subscription_cache()
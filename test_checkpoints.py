@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Проверка планировщика checkpoint'ов WAL
+"""
+
+from database import Database
+from maintenance import CheckpointManager
+
+def test_checkpoints_wait_for_idle_and_truncate_wal(tmp_path):
+    """PASSIVE только при простое или большом WAL, TRUNCATE обнуляет WAL-файл"""
+    database = Database(str(tmp_path / "wal.db"), readers=1)
+    manager = CheckpointManager(database, idle_seconds=60, max_wal_bytes=1 << 30)
+    database.get_or_create_user(1, "writer")
+    assert database.wal_size() > 0
+
+    # Запись была только что: ждем простоя
+    assert manager.tick() is None
+    manager.idle_seconds = 0
+    busy, frames, moved = manager.tick()
+    assert busy == 0 and moved == frames > 0
+
+    # Большой WAL чекпоинтится и без простоя
+    manager.idle_seconds, manager.max_wal_bytes = 60, 1
+    database.get_or_create_user(2, "writer2")
+    assert manager.tick() is not None
+
+    manager.run('FULL')
+    manager.run('TRUNCATE')
+    stats = manager.get_stats()
+    assert stats['wal_size'] == 0
+    assert (stats['passive'], stats['full'], stats['restart'], stats['truncate']) == (2, 1, 0, 1)
+    database.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Проверка предохранителя проверок подписки и деградированного режима
+"""
+
+import asyncio
+from telegram.error import NetworkError
+import circuit_breaker
+import utils
+from circuit_breaker import CircuitBreaker
+
+def test_breaker_opens_on_failure_rate_and_probes_once(monkeypatch):
+    """Размыкание по доле ошибок, один пробный вызов в half_open и замыкание после успеха"""
+    now = [100.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker('test', window=10, min_calls=4, failure_rate=0.5, open_seconds=30)
+
+    for ok in (True, False, True):
+        assert breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == breaker.CLOSED
+    breaker.record(False)
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+    now[0] += 31
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == breaker.OPEN
+
+    now[0] += 31
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == breaker.CLOSED and breaker.stats['opened'] == 2
+
+def test_open_breaker_serves_last_known_status_without_api(monkeypatch):
+    """Пока предохранитель разомкнут, ответы идут из устаревшего кэша без запросов к API"""
+    utils.clear_subscription_cache()
+    monkeypatch.setattr(utils, "membership_breaker", CircuitBreaker('membership', min_calls=3, open_seconds=60))
+    monkeypatch.setattr(utils, "_membership_store", None)
+    monkeypatch.setattr(utils, "SUBSCRIPTION_DEGRADED_ALLOW_UNKNOWN", True)
+
+    class FlakyBot:
+        def __init__(self):
+            self.calls = 0
+            self.healthy = True
+
+        async def get_chat_member(self, chat_id, user_id):
+            self.calls += 1
+            if not self.healthy:
+                raise NetworkError("Bad Gateway")
+            return type("Member", (), {"status": 'left'})()
+
+    bot = FlakyBot()
+    assert not asyncio.run(utils.is_user_subscribed(bot, 1))
+    # Запись устарела, но остается последним известным статусом
+    key = utils._cache_key(1)
+    utils._subscription_cache[key] = (False, 0)
+
+    bot.healthy = False
+    for user_id in (2, 3, 4):
+        asyncio.run(utils.force_check_subscription(bot, user_id))
+    assert utils.membership_breaker.state == CircuitBreaker.OPEN
+    calls = bot.calls
+
+    assert not asyncio.run(utils.is_user_subscribed(bot, 1))
+    assert not asyncio.run(utils.force_check_subscription(bot, 1))
+    assert asyncio.run(utils.is_user_subscribed(bot, 99))
+    assert bot.calls == calls
+    utils.clear_subscription_cache()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Проверка пула соединений: один писатель, читатели только на чтение и не ждут открытую запись
+"""
+
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from database import Database
+
+def test_readers_are_read_only(tmp_path):
+    """Соединения-читатели открыты в режиме ro: запись через них невозможна"""
+    database = Database(str(tmp_path / "pool.db"), readers=2)
+    with database._read() as cur:
+        with pytest.raises(sqlite3.OperationalError):
+            cur.execute("INSERT INTO users (user_id) VALUES (1)")
+    database.close()
+
+def test_readers_see_committed_snapshot_during_open_write(tmp_path):
+    """Во время незакоммиченной записи читатели видят прошлый снимок, а не ждут писателя"""
+    database = Database(str(tmp_path / "pool.db"), readers=2)
+    database.get_or_create_user(1, "first")
+
+    def count():
+        with database._read() as cur:
+            cur.execute("SELECT COUNT(*) FROM users")
+            return cur.fetchone()[0]
+
+    with database.transaction() as cur:
+        cur.execute("INSERT INTO users (user_id, username) VALUES (2, 'second')")
+        assert count() == 1
+    assert count() == 2
+    database.close()
+
+def test_pool_serves_more_threads_than_connections(tmp_path):
+    """Потоков больше, чем читателей: запросы ждут свободное соединение и возвращают его в пул"""
+    database = Database(str(tmp_path / "pool.db"), readers=2)
+    database.get_or_create_user(1, "user")
+    task_id = database.create_task(1, "meme")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: database.get_task(task_id), range(32)))
+    assert results == [(1, "meme")] * 32
+    assert database._readers.qsize() == 2
+    database.close()
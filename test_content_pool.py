@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Проверка пула контента: выбор без повторов и сброс после изменений
+"""
+
+from content_pool import ContentPool
+
+def test_no_repeats_until_pool_exhausted():
+    """Пользователь не видит повторов, пока не переберет весь пул"""
+    pool = ContentPool(lambda: [(i, f"meme_{i}.jpg") for i in range(1, 6)])
+    
+    first_round = [pool.next_for_user(42)[0] for _ in range(5)]
+    assert sorted(first_round) == [1, 2, 3, 4, 5]
+    
+    second_round = [pool.next_for_user(42)[0] for _ in range(5)]
+    assert sorted(second_round) == [1, 2, 3, 4, 5]
+
+def test_invalidate_drops_deleted_items():
+    """После invalidate() удаленные элементы больше не выдаются"""
+    rows = [(1, "a"), (2, "b"), (3, "c")]
+    pool = ContentPool(lambda: list(rows))
+    pool.next_for_user(1)
+    
+    rows.remove((2, "b"))
+    pool.invalidate()
+    
+    picked = {pool.next_for_user(1)[0] for _ in range(6)}
+    assert picked == {1, 3}
+    assert len(pool.sample(10)) == 2
+
+def test_empty_pool():
+    """Пустой пул возвращает None"""
+    pool = ContentPool(lambda: [])
+    assert pool.random() is None
+    assert pool.next_for_user(1) is None
+    assert pool.sample(5) == []
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Проверка группового коммита: пачка записей уходит одним COMMIT, ошибка одной записи не трогает остальные
+"""
+
+import asyncio
+from database import Database, AsyncDatabase
+
+def test_grouped_writes_share_one_commit(tmp_path):
+    """Одновременные задания коммитятся вместе, упавшая запись откатывается отдельно"""
+    database = Database(str(tmp_path / "group.db"), readers=1)
+    database.get_or_create_user(1, "user")
+    statements = []
+    database.conn.set_trace_callback(statements.append)
+    async_db = AsyncDatabase(database, readers=1, group_commit_ms=50, max_rows=100)
+
+    def broken_write():
+        database.conn.execute("INSERT INTO tasks (user_id, task_type) VALUES (1, 'lost')")
+        raise ValueError("boom")
+
+    async def burst():
+        return await asyncio.gather(
+            *[async_db.create_task(1, "meme", i) for i in range(10)],
+            async_db.run_grouped(broken_write),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(burst())
+    async_db.close()
+
+    assert isinstance(results[-1], ValueError)
+    assert len(set(results[:-1])) == 10
+    assert sum(1 for sql in statements if sql == "COMMIT") == 1
+
+    check = Database(str(tmp_path / "group.db"), readers=1)
+    stats = check.get_user_stats(1)
+    assert stats['pending_tasks'] == 10
+    assert check.conn.execute("SELECT COUNT(*) FROM tasks WHERE task_type = 'lost'").fetchone()[0] == 0
+    check.close()
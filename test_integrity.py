@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Проверка фоновой проверки целостности: отчеты кэшируются и не выполняются параллельно
+"""
+
+from database import Database
+
+def test_integrity_reports_are_cached(tmp_path):
+    """Быстрая и полная проверки сохраняют отчеты, которые отдает /db_status"""
+    database = Database(str(tmp_path / "integrity.db"), readers=1)
+    assert database.get_integrity_report() == {'quick': None, 'full': None}
+
+    quick = database.check_integrity()
+    full = database.check_integrity(full=True)
+    assert quick['ok'] and not quick['full']
+    assert full['ok'] and full['full'] and full['errors'] == []
+    assert database.get_integrity_report() == {'quick': quick, 'full': full}
+
+    # Пока идет одна проверка, вторая не запускается
+    with database._integrity_lock:
+        assert database.check_integrity(full=True) is None
+    database.close()
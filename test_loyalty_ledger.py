@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Проверка журнала лояльности: условные списания и инкрементальная сверка балансов
+"""
+
+import threading
+from database import Database
+
+def test_concurrent_purchases_never_overspend(tmp_path):
+    """Параллельные покупки списывают не больше доступного баланса"""
+    database = Database(str(tmp_path / "ledger.db"), readers=1)
+    database.get_or_create_user(1, "buyer")
+    for referral_id in range(2, 7):
+        database.get_or_create_user(referral_id, f"friend{referral_id}", ref_by=1)
+        assert database.credit_loyal_referral(1, referral_id)
+    database.add_promo_offer("Стикер", 2)
+    offer_id = database.get_promo_offers()[0][0]
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(database.purchase_offer(1, offer_id)))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(1 for task_id, _, _ in results if task_id) == 2
+    assert database.get_loyal_balance(1) == (5, 4)
+    database.close()
+
+def test_fold_reads_only_new_entries_and_repairs_drift(tmp_path):
+    """Сверка сворачивает записи после контрольной точки и чинит users по журналу"""
+    path = str(tmp_path / "fold.db")
+    database = Database(path, readers=1)
+    database.get_or_create_user(1, "owner")
+    database.get_or_create_user(2, "friend", ref_by=1)
+    database.credit_loyal_referral(1, 2)
+    database.set_loyal_referrals(1, 3)
+
+    assert database.fold_loyalty_ledger() == {'entries': 2, 'users': 1, 'repaired': 0}
+    assert database.fold_loyalty_ledger()['entries'] == 0
+
+    # Запись в обход журнала расходится с ним и исправляется при следующей свертке
+    database.conn.execute("UPDATE users SET loyal_referrals = 10 WHERE user_id = 1")
+    database.conn.commit()
+    database.add_used_loyal(1, 1)
+    assert database.fold_loyalty_ledger() == {'entries': 1, 'users': 1, 'repaired': 1}
+    assert database.get_loyal_balance(1) == (3, 1)
+    database.close()
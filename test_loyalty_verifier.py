@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Проверка массовой проверки преданных рефералов: пачки, RetryAfter и продолжение после сбоя
+"""
+
+import asyncio
+import pytest
+from telegram.error import RetryAfter
+import utils
+from analytics import AnalyticsSnapshot, AsyncAnalytics
+from circuit_breaker import CircuitBreaker
+from database import AsyncDatabase, Database
+from loyalty_verifier import LoyaltyVerifier
+from storage import MemoryStorage
+from utils import to_epoch
+
+class ChannelBot:
+    """Бот со статусами по user_id; первый запрос каждого из flooded получает RetryAfter"""
+
+    def __init__(self, statuses, flooded=()):
+        self.statuses = statuses
+        self.flooded = set(flooded)
+        self.calls = []
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls.append(user_id)
+        if user_id in self.flooded:
+            self.flooded.discard(user_id)
+            raise RetryAfter(0)
+        return type("Member", (), {"status": self.statuses[user_id]})()
+
+@pytest.fixture(autouse=True)
+def membership_checks(monkeypatch):
+    """Свой предохранитель и пустой кэш подписки на каждый тест"""
+    utils.clear_subscription_cache()
+    monkeypatch.setattr(utils, "membership_breaker", CircuitBreaker('membership', min_calls=3, open_seconds=60))
+    monkeypatch.setattr(utils, "_membership_store", None)
+    yield
+    utils.clear_subscription_cache()
+
+def populate(storage, referrals):
+    storage.get_or_create_user(1, "owner")
+    for user_id in referrals:
+        storage.get_or_create_user(user_id, f"friend{user_id}", ref_by=1)
+
+def test_verifier_credits_in_batches_and_honors_retry_after(tmp_path):
+    """Подписанные засчитываются, RetryAfter повторяется, статусы и контрольная точка сохраняются"""
+    database = Database(str(tmp_path / "verify.db"), readers=1)
+    populate(database, range(2, 9))
+    async_database = AsyncDatabase(database, max_rows=0)
+    statuses = {user_id: 'member' if user_id % 2 == 0 else 'left' for user_id in range(2, 9)}
+    bot = ChannelBot(statuses, flooded={4})
+
+    verifier = LoyaltyVerifier(bot, async_database, concurrency=3, rate=1000, batch_size=3)
+    stats = asyncio.run(verifier.run(to_epoch() + 10))
+
+    assert (stats['processed'], stats['subscribed'], stats['credited'], stats['failed']) == (7, 4, 4, 0)
+    assert stats['retries'] == 1 and stats['api_calls'] == 8
+    assert database.get_loyal_balance(1) == (4, 0)
+    assert database.get_channel_member(3)[0] == 'left'
+    # Засчитанные рефералы больше не попадают в проверку
+    assert [row[0] for row in database.get_referrals_to_verify(to_epoch() + 10)] == [3, 5, 7]
+    row = database.conn.execute("SELECT status, last_user_id, credited FROM loyalty_checks").fetchone()
+    assert row == ('done', 8, 4)
+    async_database.close()
+
+def test_verifier_reads_referrals_from_snapshot_and_credits_live_database(tmp_path):
+    """Список рефералов берется из снимка, начисления и контрольная точка - в рабочей базе"""
+    database = Database(str(tmp_path / "live.db"), readers=1)
+    populate(database, [2, 3])
+    snapshot = AnalyticsSnapshot(database, str(tmp_path / "analytics.db"))
+    snapshot.refresh()
+    # Пришел после снимка: в эту проверку не попадает
+    database.get_or_create_user(4, "friend4", ref_by=1)
+    async_database = AsyncDatabase(database, max_rows=0)
+    bot = ChannelBot({user_id: 'member' for user_id in range(2, 5)})
+
+    verifier = LoyaltyVerifier(bot, async_database, source=AsyncAnalytics(snapshot), rate=1000)
+    stats = asyncio.run(verifier.run(to_epoch() + 10))
+    assert bot.calls == [2, 3]
+    assert stats['credited'] == 2
+    assert database.get_loyal_balance(1) == (2, 0)
+    assert [row[0] for row in database.get_referrals_to_verify(to_epoch() + 10)] == [4]
+    snapshot.close()
+    async_database.close()
+
+def test_verifier_resumes_from_checkpoint_and_skips_recent_joins():
+    """После сбоя проверка продолжается с сохраненной пачки; недавно вступившие не засчитываются"""
+    storage = MemoryStorage()
+    populate(storage, range(2, 8))
+    # Регистрация пользователей датирована текущей секундой, поэтому порог сдвинут вперед
+    cutoff = to_epoch() + 10
+    storage.record_channel_member(7, 'member', changed_ts=cutoff + 50)
+    async_storage = AsyncDatabase(storage, max_rows=0)
+    bot = ChannelBot({user_id: 'member' for user_id in range(2, 8)})
+
+    async def crash(counters):
+        raise RuntimeError("bot restarted")
+
+    first = LoyaltyVerifier(bot, async_storage, batch_size=2, rate=1000, progress_seconds=0)
+    with pytest.raises(RuntimeError):
+        asyncio.run(first.run(cutoff, progress=crash))
+    assert bot.calls == [2, 3]
+
+    second = LoyaltyVerifier(bot, async_storage, batch_size=2, rate=1000)
+    # Продолжение идет с порогом из контрольной точки, а не с новым
+    stats = asyncio.run(second.run(0))
+    assert stats['resumed']
+    assert bot.calls == [2, 3, 4, 5, 6]
+    assert (stats['processed'], stats['credited'], stats['too_recent']) == (6, 5, 1)
+    async_storage.close()
+
+def test_verifier_uses_membership_breaker_and_cache(monkeypatch):
+    """Свежий кэш подписки заменяет запрос; при разомкнутом предохранителе проверка приостанавливается"""
+    storage = MemoryStorage()
+    populate(storage, range(2, 6))
+    async_storage = AsyncDatabase(storage, max_rows=0)
+    bot = ChannelBot({user_id: 'member' for user_id in range(2, 6)})
+    utils._store_subscription(utils._cache_key(2), True)
+    for _ in range(3):
+        utils.membership_breaker.record(False)
+    assert utils.membership_breaker.state == CircuitBreaker.OPEN
+
+    cutoff = to_epoch() + 10
+    stats = asyncio.run(LoyaltyVerifier(bot, async_storage, rate=1000).run(cutoff))
+    assert bot.calls == []
+    assert stats['paused']
+    assert (stats['processed'], stats['credited'], stats['failed']) == (1, 1, 0)
+    # Контрольная точка стоит на последнем проверенном реферале, проверка не завершена
+    check_id, _, last_user_id, _ = storage.start_loyalty_check(cutoff)
+    assert (check_id, last_user_id) == (stats['check_id'], 2)
+
+    # API снова доступно: проверка продолжается с отложенных рефералов
+    monkeypatch.setattr(utils, "membership_breaker", CircuitBreaker('membership', min_calls=3, open_seconds=60))
+    stats = asyncio.run(LoyaltyVerifier(bot, async_storage, rate=1000).run(cutoff))
+    assert stats['resumed'] and not stats['paused']
+    assert bot.calls == [3, 4, 5]
+    assert (stats['processed'], stats['credited']) == (4, 4)
+    assert storage.get_referrals_to_verify(cutoff) == []
+    async_storage.close()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Проверка миграций схемы: версии, backfill и epoch-колонки
+"""
+
+import sqlite3
+import time
+import migrations
+from migrations import migrate, current_version, LATEST_VERSION
+
+
+def test_migrate_legacy_database_and_resume_backfill(tmp_path, monkeypatch):
+    conn = sqlite3.connect(str(tmp_path / "legacy.db"))
+    # База старой версии: без schema_version и без новых колонок
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, "
+                 "first_name TEXT, last_name TEXT, ref_by INTEGER)")
+    conn.execute("CREATE TABLE allowed_chats (id INTEGER PRIMARY KEY, chat_id INTEGER, chat_title TEXT)")
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(i,) for i in range(1, 251)])
+    conn.commit()
+
+    monkeypatch.setattr(migrations, "MIGRATION_BATCH_SIZE", 100)
+    assert migrate(conn) == LATEST_VERSION
+    assert conn.execute("SELECT COUNT(*) FROM users WHERE promo_code IS NULL").fetchone()[0] == 0
+    assert "chat_username" in migrations._table_columns(conn.cursor(), "allowed_chats")
+
+    # Прерванный backfill продолжается с оставшихся строк
+    conn.execute("UPDATE users SET promo_code = NULL WHERE user_id > 200")
+    conn.execute("DELETE FROM schema_version WHERE version >= 6")
+    conn.commit()
+    migrate(conn)
+    assert conn.execute("SELECT COUNT(*) FROM users WHERE promo_code IS NULL").fetchone()[0] == 0
+
+    # Для актуальной схемы нужен только один SELECT
+    statements = []
+    conn.set_trace_callback(statements.append)
+    assert migrate(conn) == current_version(conn) == LATEST_VERSION
+    assert len(statements) == 2
+
+
+def test_promo_code_allocator_is_collision_free():
+    from promo_codes import code_for, permute, CODE_SPACE
+    codes = {code_for(seq) for seq in range(20000)}
+    assert len(codes) == 20000
+    assert all(len(code) == 6 and code.isalnum() and code.upper() == code for code in codes)
+    assert permute(CODE_SPACE - 1) < CODE_SPACE
+
+
+def test_backfill_skips_legacy_code_collisions(tmp_path):
+    from promo_codes import code_for
+    conn = sqlite3.connect(str(tmp_path / "collide.db"))
+    migrate(conn)
+    # Старый случайный код совпадает с первым кодом аллокатора
+    conn.execute("INSERT INTO users (user_id, promo_code) VALUES (1, ?)", (code_for(0),))
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(i,) for i in range(2, 12)])
+    conn.commit()
+
+    migrations._backfill_promo_codes(conn)
+    codes = [row[0] for row in conn.execute("SELECT promo_code FROM users")]
+    assert None not in codes
+    assert len(set(codes)) == len(codes)
+
+
+def test_compaction_keeps_rendered_task_text(tmp_path):
+    from utils import format_task_panel, format_task_text, REPOST_TASK_TEXT
+    conn = sqlite3.connect(str(tmp_path / "compact.db"))
+    migrate(conn)
+    conn.execute("INSERT INTO users (user_id, promo_code) VALUES (1, 'ABC123')")
+    conn.execute("INSERT INTO text_templates (id, text) VALUES (7, 'Заходи в бот')")
+    conn.executemany(
+        "INSERT INTO tasks (user_id, task_type, task_description) VALUES (1, ?, ?)",
+        [('meme', format_task_panel('ABC123')), ('text', 'Заходи в бот'),
+         ('repost', REPOST_TASK_TEXT), ('text', 'Удаленный шаблон'), ('promo', 'offer:3')]
+    )
+    conn.execute("DELETE FROM schema_version WHERE version >= 11")
+    conn.commit()
+    migrate(conn)
+
+    rows = conn.execute("""
+        SELECT t.template_kind, t.promo_code, tt.text, t.task_description
+        FROM tasks t LEFT JOIN text_templates tt ON tt.id = t.template_id
+        ORDER BY t.task_id
+    """).fetchall()
+    from utils import render_task_description
+    assert [render_task_description(*row) for row in rows] == [
+        format_task_panel('ABC123'), format_task_text('Заходи в бот', 'ABC123'),
+        REPOST_TASK_TEXT, 'Удаленный шаблон', 'offer:3'
+    ]
+    assert [row[3] for row in rows[:3]] == [None, None, None]
+
+
+def test_epoch_backfill_handles_mixed_date_formats(tmp_path):
+    from datetime import datetime
+    from utils import to_epoch, day_bucket, week_bucket
+    conn = sqlite3.connect(str(tmp_path / "epoch.db"))
+    migrate(conn)
+    joined = datetime(2024, 3, 6, 12, 30, 15)
+    # isoformat(), str(datetime) с микросекундами и без разделителя 'T'
+    conn.executemany("INSERT INTO users (user_id, joined_date) VALUES (?, ?)", [
+        (1, joined.isoformat()), (2, str(joined.replace(microsecond=500))), (3, None),
+    ])
+    conn.execute("INSERT INTO tasks (user_id, created_at) VALUES (1, ?)", (str(joined),))
+    conn.commit()
+
+    conn.execute("DELETE FROM schema_version WHERE version >= 16")
+    conn.commit()
+    migrate(conn)
+    rows = dict(conn.execute("SELECT user_id, joined_ts FROM users"))
+    # Текстовые даты бот пишет через datetime.now(): epoch совпадает с to_epoch того же момента
+    expected = to_epoch(joined)
+    assert rows == {1: expected, 2: expected, 3: None}
+    assert conn.execute("SELECT created_ts FROM tasks_all").fetchone()[0] == expected
+
+    # Среда 6 марта: сутки с полуночи, неделя с понедельника 4 марта
+    assert day_bucket(to_epoch(joined)) == to_epoch(datetime(2024, 3, 6))
+    assert week_bucket(to_epoch(joined)) == to_epoch(datetime(2024, 3, 4))
+    plan = " ".join(row[3] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM users WHERE joined_ts >= ?", (0,)
+    ))
+    assert "idx_users_joined_ts" in plan
+
+
+def test_epoch_backfill_reads_local_time_under_any_timezone(tmp_path, monkeypatch):
+    """Даты из datetime.now() переводятся так же, как to_epoch, и при TZ сервера, отличном от UTC"""
+    from datetime import datetime
+    from utils import to_epoch
+    monkeypatch.setenv("TZ", "Europe/Moscow")
+    time.tzset()
+    try:
+        conn = sqlite3.connect(str(tmp_path / "tz.db"))
+        # Старая база без joined_date: колонку заполняет миграция
+        conn.execute(
+            "CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, ref_by INTEGER)"
+        )
+        conn.execute("INSERT INTO users (user_id) VALUES (1)")
+        conn.commit()
+        migrate(conn)
+        joined_ts = conn.execute("SELECT joined_ts FROM users WHERE user_id = 1").fetchone()[0]
+        assert abs(joined_ts - time.time()) < 60
+
+        now = datetime.now().replace(microsecond=0)
+        conn.execute("INSERT INTO users (user_id, joined_date) VALUES (2, ?)", (now.isoformat(),))
+        conn.execute("INSERT INTO tasks (user_id, created_at) VALUES (2, ?)", (now,))
+        conn.commit()
+        conn.execute("DELETE FROM schema_version WHERE version >= 16")
+        conn.commit()
+        migrate(conn)
+        assert conn.execute("SELECT joined_ts FROM users WHERE user_id = 2").fetchone()[0] == to_epoch(now)
+        assert conn.execute("SELECT created_ts FROM tasks").fetchone()[0] == to_epoch(now)
+        conn.close()
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_total_tasks_backfilled_from_task_history(tmp_path):
+    """Старая база без users.total_tasks: счетчик заполняется числом заданий пользователя"""
+    conn = sqlite3.connect(str(tmp_path / "legacy_tasks.db"))
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, "
+                 "first_name TEXT, last_name TEXT, ref_by INTEGER)")
+    conn.execute("CREATE TABLE tasks (task_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, "
+                 "task_description TEXT, status TEXT DEFAULT 'pending', task_type TEXT, "
+                 "screenshot_path TEXT, created_at TIMESTAMP)")
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(1,), (2,), (3,)])
+    conn.executemany("INSERT INTO tasks (user_id, task_type, status) VALUES (?, 'meme', ?)", [
+        (1, 'pending'), (1, 'approved'), (1, 'declined'), (2, 'approved'),
+    ])
+    conn.commit()
+
+    migrate(conn)
+    assert dict(conn.execute("SELECT user_id, total_tasks FROM users")) == {1: 3, 2: 1, 3: 0}
+    conn.close()
+
+
+def test_total_tasks_reconciliation_fixes_drifted_counts(tmp_path):
+    """Сверка исправляет расходящиеся счетчики и учитывает только задания самого пользователя"""
+    conn = sqlite3.connect(str(tmp_path / "drift.db"))
+    migrate(conn)
+    conn.executemany("INSERT INTO users (user_id, total_tasks) VALUES (?, ?)", [(1, 10), (2, 0), (3, 5)])
+    conn.executemany("INSERT INTO tasks (user_id, task_type) VALUES (?, 'meme')", [(1,), (2,), (2,)])
+    conn.commit()
+
+    migrations._reconcile_total_tasks(conn.cursor())
+    conn.commit()
+    assert dict(conn.execute("SELECT user_id, total_tasks FROM users")) == {1: 1, 2: 2, 3: 0}
+    conn.close()
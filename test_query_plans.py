@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Проверка планов выполнения горячих запросов: ни один не должен сканировать таблицу целиком
+"""
+
+import re
+from database import Database, HOT_QUERIES
+
+# "SCAN tasks" — полный проход по таблице; "SCAN tasks USING INDEX ..." — обход индекса
+FULL_SCAN = re.compile(r'^SCAN \S+$')
+
+def test_hot_queries_use_indexes(tmp_path):
+    """Все запросы из HOT_QUERIES должны использовать индексы"""
+    database = Database(str(tmp_path / "plans.db"))
+    try:
+        for name, sql in HOT_QUERIES.items():
+            params = (None,) * sql.count('?')
+            plan = [row[3] for row in database.conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            scans = [step for step in plan if FULL_SCAN.match(step)]
+            assert not scans, f"{name}: полный скан таблицы {scans}"
+    finally:
+        database.close()
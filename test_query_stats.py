@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Проверка статистики запросов: нормализация, процентили и журнал медленных запросов
+"""
+
+from database import Database
+from query_stats import normalize
+
+def test_normalize_groups_queries_by_shape():
+    """Литералы и списки параметров не плодят отдельные записи статистики"""
+    assert normalize("SELECT * FROM users  WHERE user_id IN (?, ?, ?)") == normalize(
+        "SELECT * FROM users\n WHERE user_id IN (?,?)"
+    )
+    assert normalize("SELECT 1 FROM tasks WHERE status = 'pending'") == "SELECT ? FROM tasks WHERE status = ?"
+
+def test_database_records_latency_rows_and_slow_plans(tmp_path):
+    """Каждый запрос попадает в статистику, медленные - в журнал с планом"""
+    database = Database(str(tmp_path / "stats.db"), readers=1)
+    database.query_stats.reset()
+    database.query_stats.slow_threshold = 0
+    for user_id in range(1, 4):
+        database.get_or_create_user(user_id, f"user{user_id}")
+    database.get_recent_users(3)
+
+    top, slow = database.get_query_stats(50)
+    recent = next(stat for stat in top if stat['query'].startswith("SELECT user_id, username, joined_date"))
+    assert recent['count'] == 1 and recent['rows'] == 3
+    assert recent['p50'] <= recent['p95'] <= recent['p99']
+    assert any("users" in (plan or "") for _, query, _, plan in slow if query == recent['query'])
+    database.close()
+
+def test_connection_execute_and_dropped_cursors_are_recorded(tmp_path):
+    """conn.execute(), PRAGMA/BEGIN/COMMIT и курсоры без close() тоже попадают в статистику"""
+    database = Database(str(tmp_path / "execute.db"), readers=1)
+    database.query_stats.reset()
+    database.get_or_create_user(1, "user1")
+    database.get_or_create_user(2, "user2")
+    database.credit_loyal_referral(1, 2)
+
+    database.conn.execute("PRAGMA user_version")
+    assert database.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 2
+    cur = database.conn.cursor()
+    cur.execute("SELECT user_id FROM users ORDER BY user_id")
+    assert [row[0] for row in cur] == [1, 2]
+
+    counts = {stat['query']: stat for stat in database.query_stats.top(100)}
+    assert counts["PRAGMA user_version"]['count'] == 1
+    assert counts["SELECT COUNT(*) FROM users"]['rows'] == 1
+    assert counts["SELECT user_id FROM users ORDER BY user_id"]['rows'] == 2
+    assert "BEGIN IMMEDIATE" in counts
+    database.close()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Проверка протокола хранилища: одни и те же тесты для SQLite и памяти
+"""
+
+import asyncio
+import pytest
+from database import AsyncDatabase, Database
+from storage import MemoryStorage, Storage
+from utils import to_epoch
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def storage(request, tmp_path):
+    """Database и MemoryStorage по очереди"""
+    if request.param == 'sqlite':
+        backend = Database(str(tmp_path / "storage.db"), readers=1)
+    else:
+        backend = MemoryStorage()
+    yield backend
+    backend.close()
+
+def add_users(storage):
+    """Владелец 1 и его реферал 2"""
+    storage.get_or_create_user(1, "owner")
+    storage.get_or_create_user(2, "friend", ref_by=1)
+    storage.set_referrer(2, 1)
+
+def test_implements_protocol(storage):
+    """Реализация удовлетворяет протоколу"""
+    assert isinstance(storage, Storage)
+
+def test_users(storage):
+    """Пользователи, рефералы и поиск"""
+    add_users(storage)
+    assert storage.count_users() == 2
+    assert storage.get_user_by_username("friend") == 2
+    assert storage.get_ref_by(2) == 1
+    assert storage.get_user_stats(1)['referrals_count'] == 1
+    assert storage.get_referrals_to_verify(2 ** 40) == [(2, 1)]
+
+def test_task_lifecycle(storage):
+    """Задание по тексту: скриншот, очередь, одобрение и описание"""
+    add_users(storage)
+    storage.add_text("Текст задания")
+    text_id = storage.get_all_texts()[0][0]
+    task_id = storage.create_task(2, 'text', text_id)
+    storage.update_screenshot_path(task_id, "shot.jpg")
+    assert storage.get_pending_tasks()[:3] == (task_id, 2, "shot.jpg")
+
+    storage.approve_task(task_id, 2)
+    storage.delete_text(text_id)
+    assert storage.get_task(task_id) == (2, 'text')
+    assert "Текст задания" in storage.get_task_description(task_id)
+    stats = storage.get_user_stats(2)
+    assert (stats['pending_tasks'], stats['completed_tasks'], stats['total_tasks']) == (0, 1, 1)
+    assert storage.cancel_task(2) is False
+
+def test_unknown_task_ids(storage):
+    """Неизвестное задание не меняется и не дает ошибки, счетчики пользователя меняются как в SQL"""
+    add_users(storage)
+    storage.approve_task(999, 2)
+    storage.decline_task(998, 2)
+    storage.update_screenshot_path(997, "shot.jpg")
+    assert storage.get_task(999) is None
+    assert storage.get_task_description(999) is None
+    stats = storage.get_user_stats(2)
+    assert (stats['pending_tasks'], stats['completed_tasks']) == (-2, 1)
+
+def test_archive_tasks(storage):
+    """Архивируются только решенные задания; описание остается доступным"""
+    add_users(storage)
+    approved = storage.create_task(2, 'meme')
+    declined = storage.create_task(2, 'meme')
+    pending = storage.create_task(2, 'meme')
+    storage.approve_task(approved, 2)
+    storage.decline_task(declined, 2)
+
+    assert storage.archive_tasks(older_than_days=30) == 0
+    assert storage.archive_tasks(older_than_days=-1) == 2
+    assert storage.get_task(approved) is None
+    assert storage.get_task(pending) == (2, 'meme')
+    assert storage.get_task_description(approved) == storage.get_task_description(pending)
+
+def test_offers_and_purchase(storage):
+    """Покупка предложения списывает преданных рефералов, без баланса отказ"""
+    add_users(storage)
+    storage.set_loyal_referrals(1, 3)
+    storage.add_promo_offer("Стикер", 2)
+    offer_id = storage.get_promo_offers()[0][0]
+    bought = storage.purchase_offer(1, str(offer_id))
+    assert bought[0] is not None and bought[1:] == ("Стикер", 2)
+    assert storage.purchase_offer(1, offer_id) == (None, "Стикер", 2)
+    assert storage.get_loyal_balance(1) == (3, 2)
+
+def test_loyalty_ledger(storage):
+    """Начисление один раз, списание не уходит в минус, свертка журнала"""
+    add_users(storage)
+    assert storage.credit_loyal_referral(1, 2) is True
+    assert storage.credit_loyal_referral(1, 2) is False
+    assert storage.credit_loyal_referral(404, 2) is False
+    assert storage.is_loyal_referral_credited(1, 2)
+    assert storage.add_used_loyal(1, 2) is False
+    assert storage.add_used_loyal(1, 1) is True
+    assert storage.get_loyal_balance(1) == (1, 1)
+
+    assert storage.fold_loyalty_ledger() == {'entries': 2, 'users': 1, 'repaired': 0}
+    assert storage.fold_loyalty_ledger()['entries'] == 0
+
+def test_channel_members(storage):
+    """Статусы канала: запоздавшие события игнорируются, время вступления и выхода сохраняется"""
+    assert storage.record_channel_member(1, 'member', changed_ts=100)
+    assert storage.record_channel_member(1, 'left', changed_ts=200)
+    assert not storage.record_channel_member(1, 'member', changed_ts=150)
+    status, joined_ts, left_ts, _ = storage.get_channel_member(1)
+    assert (status, joined_ts, left_ts) == ('left', 100, 200)
+
+    # Результат запроса к API для нового пользователя: момент вступления неизвестен
+    assert storage.record_channel_member(2, 'member')
+    assert storage.get_channel_member(2)[:3] == ('member', None, None)
+    assert storage.get_channel_member(3) is None
+
+def test_loyalty_check_batches(storage):
+    """Проверка идет пачками и продолжается с контрольной точки"""
+    add_users(storage)
+    storage.get_or_create_user(3, "third", ref_by=1)
+    storage.set_referrer(3, 1)
+    cutoff = to_epoch() + 60
+
+    check_id, _, last_user_id, counters = storage.start_loyalty_check(cutoff)
+    assert last_user_id == 0
+    assert storage.get_referrals_to_verify(cutoff, 0, 1) == [(2, 1)]
+    counters = dict(counters, processed=1, subscribed=1)
+    assert storage.save_loyalty_check_batch(check_id, 2, [(2, 'member')], [(1, 2)], counters) == 1
+    assert storage.get_channel_member(2)[0] == 'member'
+
+    resumed = storage.start_loyalty_check(cutoff + 100)
+    assert resumed[:3] == (check_id, cutoff, 2)
+    assert resumed[3]['credited'] == 1
+    assert storage.get_referrals_to_verify(cutoff, 0) == [(3, 1)]
+    storage.finish_loyalty_check(check_id)
+    assert storage.start_loyalty_check(cutoff)[0] != check_id
+
+def test_diagnostics(storage):
+    """Диагностика для админских команд отдает одинаковую структуру"""
+    add_users(storage)
+    lock_stats = storage.get_lock_stats()
+    assert {'transactions', 'retries', 'failures', 'wait_total', 'wait_max', 'wait_avg'} <= set(lock_stats)
+    top, slow = storage.get_query_stats()
+    assert isinstance(top, list) and isinstance(slow, list)
+    assert set(storage.get_integrity_report()) == {'quick', 'full'}
+
+def test_async_facade_over_memory_storage():
+    """AsyncDatabase работает поверх хранилища в памяти без SQLite"""
+    async_storage = AsyncDatabase(MemoryStorage(), max_rows=0)
+
+    async def scenario():
+        promo_code = await async_storage.get_or_create_user(7, "seven")
+        await async_storage.create_task(7, 'meme')
+        return promo_code, await async_storage.get_user_by_promo_code(promo_code), await async_storage.get_last_pending_task(7)
+
+    promo_code, user_id, task_id = asyncio.run(scenario())
+    assert user_id == 7
+    assert task_id == 1
+    async_storage.close()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Проверка кэша подписки: TTL, общий запрос в полете и принудительная проверка
+"""
+
+import asyncio
+import utils
+
+class FakeBot:
+    """Бот, считающий вызовы get_chat_member"""
+
+    def __init__(self, status='member', delay=0.01):
+        self.status = status
+        self.delay = delay
+        self.calls = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.status is None:
+            raise RuntimeError("Bad Request: chat not found")
+        return type("Member", (), {"status": self.status})()
+
+def test_concurrent_checks_share_one_request_and_hit_cache():
+    """Параллельные проверки одного пользователя делают один запрос, следующие берутся из кэша"""
+    utils.clear_subscription_cache()
+    bot = FakeBot()
+
+    async def scenario():
+        first = await asyncio.gather(*(utils.is_user_subscribed(bot, 1) for _ in range(20)))
+        second = await utils.is_user_subscribed(bot, 1)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert all(first) and second
+    assert bot.calls == 1
+
+def test_negative_ttl_expires_and_force_refreshes(monkeypatch):
+    """Отсутствие подписки живет короче, force_check_subscription обновляет кэш"""
+    utils.clear_subscription_cache()
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now[0])
+    bot = FakeBot(status='left', delay=0)
+
+    assert not asyncio.run(utils.is_user_subscribed(bot, 2))
+    bot.status = 'member'
+    assert not asyncio.run(utils.is_user_subscribed(bot, 2))
+    assert bot.calls == 1
+
+    assert asyncio.run(utils.force_check_subscription(bot, 2))
+    assert bot.calls == 2
+    now[0] += utils._cache_timeout[False] + 1
+    assert asyncio.run(utils.is_user_subscribed(bot, 2))
+    assert bot.calls == 2
+
+    now[0] += utils._cache_timeout[True] + 1
+    assert asyncio.run(utils.is_user_subscribed(bot, 2))
+    assert bot.calls == 3
+
+def test_errors_are_not_cached_and_cache_is_bounded(monkeypatch):
+    """Ошибка Telegram не попадает в кэш, размер кэша ограничен"""
+    utils.clear_subscription_cache()
+    bot = FakeBot(status=None, delay=0)
+    assert not asyncio.run(utils.is_user_subscribed(bot, 3))
+    assert "3_" + str(utils.CHANNEL_ID) not in utils._subscription_cache
+
+    monkeypatch.setattr(utils, "SUBSCRIPTION_CACHE_MAX", 5)
+    bot.status = 'member'
+    for user_id in range(10, 20):
+        asyncio.run(utils.is_user_subscribed(bot, user_id))
+    assert len(utils._subscription_cache) == 5
+    assert utils._cache_key(19) in utils._subscription_cache
+    utils.clear_subscription_cache()
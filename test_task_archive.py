@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Проверка архивации заданий: решенные уходят в tasks_archive, история остается видна
+"""
+
+import sqlite3
+import migrations
+from database import Database
+
+def test_decided_tasks_move_to_archive(tmp_path):
+    """Старые решенные задания переносятся пачками, ожидающие остаются на месте"""
+    database = Database(str(tmp_path / "archive.db"), readers=1)
+    database.get_or_create_user(1, "user")
+    decided = [database.create_task(1, "repost") for _ in range(5)]
+    for task_id in decided:
+        database.approve_task(task_id, 1)
+    pending = database.create_task(1, "repost")
+
+    assert database.archive_tasks(older_than_days=1) == 0
+    assert database.archive_tasks(older_than_days=-1, batch_size=2) == 5
+
+    live = database.conn.execute("SELECT task_id FROM tasks").fetchall()
+    assert live == [(pending,)]
+    assert database.conn.execute("SELECT COUNT(*) FROM tasks_all").fetchone()[0] == 6
+    assert database.get_task_description(decided[0])
+    assert database.get_user_stats(1)['total_tasks'] == 6
+    assert database.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    database.close()
+
+def test_large_database_is_not_vacuumed_at_startup(tmp_path, monkeypatch):
+    """Большая база не перестраивается при миграции; режим включает разовый enable_incremental_vacuum"""
+    monkeypatch.setattr(migrations, "DB_AUTO_VACUUM_MIGRATE_MAX_MB", 0)
+    conn = sqlite3.connect(str(tmp_path / "large.db"))
+    migrations.migrate(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    assert migrations.enable_incremental_vacuum(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert not migrations.enable_incremental_vacuum(conn)
+    conn.close()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Проверка менеджера транзакций: ожидание чужой блокировки с повтором и атомарные покупки
+"""
+
+import sqlite3
+import threading
+from database import Database
+
+def test_transaction_retries_while_another_process_writes(tmp_path):
+    """Пока другое соединение держит запись, транзакция повторяет BEGIN IMMEDIATE и проходит"""
+    path = str(tmp_path / "shared.db")
+    database = Database(path, readers=1)
+    database.get_or_create_user(1, "buyer")
+    database.set_loyal_referrals(1, 3)
+    database.add_promo_offer("Самокат", 2)
+    offer_id = database.get_promo_offers()[0][0]
+    # Без встроенного ожидания SQLite занятость сразу видна менеджеру транзакций
+    database.conn.execute("PRAGMA busy_timeout=0")
+
+    other = sqlite3.connect(path, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.2, other.commit).start()
+
+    task_id, title, cost = database.purchase_offer(1, offer_id)
+    assert task_id and (title, cost) == ("Самокат", 2)
+    stats = database.get_lock_stats()
+    assert stats['retries'] > 0 and stats['wait_max'] >= 0.1
+
+    # Второй покупке уже не хватает баланса, и ничего не списывается
+    assert database.purchase_offer(1, offer_id)[0] is None
+    assert database.get_loyal_balance(1) == (3, 2)
+
+    # Преданный реферал засчитывается только один раз
+    database.get_or_create_user(2, "friend", ref_by=1)
+    assert database.credit_loyal_referral(1, 2)
+    assert not database.credit_loyal_referral(1, 2)
+    assert database.get_loyal_balance(1) == (4, 2)
+    other.close()
+    database.close()
+
+def test_plain_writes_retry_while_another_process_writes(tmp_path):
+    """Одиночные записи через _write() тоже ждут чужую блокировку, а не падают с database is locked"""
+    path = str(tmp_path / "shared.db")
+    database = Database(path, readers=1)
+    database.get_or_create_user(1, "owner")
+    database.conn.execute("PRAGMA busy_timeout=0")
+
+    other = sqlite3.connect(path, check_same_thread=False)
+    for write in (
+        lambda: database.get_or_create_user(2, "friend"),
+        lambda: database.set_referrer(2, 1),
+        lambda: database.add_coupon("CODE", "promo"),
+    ):
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.1, other.commit).start()
+        write()
+
+    assert database.get_ref_by(2) == 1
+    assert database.get_user_stats(1)['referrals_count'] == 1
+    assert database.conn.execute("SELECT code FROM coupons").fetchall() == [("CODE",)]
+    assert database.get_lock_stats()['retries'] >= 3
+    other.close()
+    database.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Проверка зеркала пользователей: записи доходят до памяти только после COMMIT и совпадают с SQLite
+"""
+
+from database import Database
+
+def test_mirror_matches_database_after_writes(tmp_path):
+    """Профиль из памяти совпадает с тем, что лежит в базе, в том числе после рестарта"""
+    path = str(tmp_path / "mirror.db")
+    database = Database(path, readers=1)
+    owner_code = database.get_or_create_user(1, "owner")
+    database.get_or_create_user(2, "friend")
+
+    database.set_referrer(2, database.get_user_by_promo_code(owner_code))
+    task_id = database.create_task(2, "meme", 1)
+    database.approve_task(task_id, 2)
+    database.create_task(2, "text", 1)
+    database.cancel_task(2)
+    database.add_used_loyal(1, 0)
+
+    # Ошибка внутри группового коммита не должна попасть в зеркало
+    database.run_batch([(lambda: (database.create_task(2, "meme", 1), 1 / 0), (), {})])
+
+    live = {uid: database.get_user_stats(uid) for uid in (1, 2)}
+    assert live[1]['referrals_count'] == 1
+    assert live[2]['completed_tasks'] == 1
+    assert live[2]['pending_tasks'] == 0
+    assert live[2]['total_tasks'] == 1
+    assert database.get_ref_by(2) == 1
+    assert database.get_user_by_username("friend") == 2
+    database.close()
+
+    restarted = Database(path, readers=1)
+    assert {uid: restarted.get_user_stats(uid) for uid in (1, 2)} == live
+    restarted.close()
+
+def test_get_or_create_user_mirrors_users_written_by_another_process(tmp_path):
+    """Пользователь, добавленный другим процессом, попадает в зеркало при первом обращении"""
+    path = str(tmp_path / "shared.db")
+    bot = Database(path, readers=1)
+    other = Database(path, readers=1)
+    promo_code = other.get_or_create_user(42, "outsider")
+
+    assert bot.get_user_stats(42) is None
+    assert bot.get_or_create_user(42, "outsider") == promo_code
+    assert bot.get_user_stats(42)['promo_code'] == promo_code
+    assert bot.get_user_by_username("outsider") == 42
+    other.close()
+    bot.close()
@@ -0,0 +1,124 @@
+import threading
+
+class UserRecord:
+    """Горячие поля одного пользователя"""
+    __slots__ = (
+        'user_id', 'username', 'promo_code', 'ref_by', 'referrals_count',
+        'loyal_referrals', 'used_loyal', 'pending_tasks', 'completed_tasks', 'total_tasks'
+    )
+
+    def __init__(self, user_id, username=None, promo_code=None, ref_by=None, referrals_count=0,
+                 loyal_referrals=0, used_loyal=0, pending_tasks=0, completed_tasks=0, total_tasks=0):
+        self.user_id = user_id
+        self.username = username
+        self.promo_code = promo_code
+        self.ref_by = ref_by
+        self.referrals_count = referrals_count or 0
+        self.loyal_referrals = loyal_referrals or 0
+        self.used_loyal = used_loyal or 0
+        self.pending_tasks = pending_tasks or 0
+        self.completed_tasks = completed_tasks or 0
+        self.total_tasks = total_tasks or 0
+
+    def as_stats(self):
+        """Статистика пользователя в виде словаря для профиля"""
+        return {
+            'promo_code': self.promo_code,
+            'referrals_count': self.referrals_count,
+            'loyal_referrals': self.loyal_referrals,
+            'used_loyal': self.used_loyal,
+            'pending_tasks': self.pending_tasks,
+            'completed_tasks': self.completed_tasks,
+            'total_tasks': self.total_tasks
+        }
+
+class UserMirror:
+    """Зеркало таблицы users в памяти с индексами по user_id, promo_code и username.
+
+    Database обновляет его после COMMIT каждой записи (write-through), поэтому
+    чтения профиля и поиск по промокоду/username не ходят в SQLite.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_promo_code = {}
+        self._by_username = {}
+
+    def load(self, rows):
+        """Заполнение зеркала строками (user_id, username, promo_code, ref_by, ...) в порядке UserRecord"""
+        with self._lock:
+            self._by_id.clear()
+            self._by_promo_code.clear()
+            self._by_username.clear()
+            for row in rows:
+                self._index(UserRecord(*row))
+
+    def load_one(self, row):
+        """Добавление одной строки в порядке UserRecord (пользователь, записанный другим процессом)"""
+        with self._lock:
+            self._index(UserRecord(*row))
+
+    def _index(self, record):
+        self._by_id[record.user_id] = record
+        if record.promo_code is not None:
+            self._by_promo_code[record.promo_code] = record.user_id
+        # Как и SELECT ... WHERE username = ?, при совпадении берем первого
+        if record.username is not None:
+            self._by_username.setdefault(record.username, record.user_id)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._by_id
+
+    def get(self, user_id):
+        """Запись пользователя или None"""
+        return self._by_id.get(user_id)
+
+    def user_ids(self):
+        """Список всех user_id"""
+        return list(self._by_id)
+
+    def by_promo_code(self, promo_code):
+        """user_id владельца промокода"""
+        return self._by_promo_code.get(promo_code)
+
+    def by_username(self, username):
+        """user_id по username"""
+        return self._by_username.get(username)
+
+    def add(self, user_id, **fields):
+        """Новый пользователь"""
+        with self._lock:
+            self._index(UserRecord(user_id, **fields))
+
+    def update(self, user_id, **fields):
+        """Установка полей существующего пользователя"""
+        with self._lock:
+            record = self._by_id.get(user_id)
+            if record is None:
+                return
+            old_username = record.username
+            for field, value in fields.items():
+                setattr(record, field, value)
+            if 'promo_code' in fields:
+                self._by_promo_code[record.promo_code] = user_id
+            if 'username' in fields and record.username != old_username:
+                # Старый ключ убираем, только если он указывает на этого пользователя
+                if old_username is not None and self._by_username.get(old_username) == user_id:
+                    del self._by_username[old_username]
+                if record.username is not None:
+                    self._by_username.setdefault(record.username, user_id)
+
+    def increment(self, user_id, field, delta=1, floor=None):
+        """Изменение счетчика; floor повторяет условие вида "AND field > 0" в UPDATE"""
+        with self._lock:
+            record = self._by_id.get(user_id)
+            if record is None:
+                return
+            value = getattr(record, field)
+            if floor is not None and value <= floor:
+                return
+            setattr(record, field, value + delta)
@@ -1,10 +1,38 @@
+import asyncio
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from config import CHANNEL_ID, logger
+from telegram.error import NetworkError, RetryAfter, TelegramError
+from circuit_breaker import CircuitBreaker
+from config import (
+    CHANNEL_ID, SUBSCRIPTION_CACHE_TTL_SECONDS, SUBSCRIPTION_NEGATIVE_TTL_SECONDS, SUBSCRIPTION_CACHE_MAX,
+    CHANNEL_MEMBER_FRESH_SECONDS, SUBSCRIPTION_CHECK_TIMEOUT_SECONDS, SUBSCRIPTION_BREAKER_WINDOW_SECONDS,
+    SUBSCRIPTION_BREAKER_MIN_CALLS, SUBSCRIPTION_BREAKER_FAILURE_RATE, SUBSCRIPTION_BREAKER_OPEN_SECONDS,
+    SUBSCRIPTION_DEGRADED_ALLOW_UNKNOWN, logger
+)
 
-# Кэш для результатов проверки подписки
-_subscription_cache = {}
-_cache_timeout = 30  # 30 секунд (для быстрого обновления)
+# Статусы get_chat_member, при которых пользователь считается подписанным
+MEMBER_STATUSES = ('member', 'creator', 'administrator')
+
+# Кэш для результатов проверки подписки: ключ -> (подписан, момент истечения по time.monotonic())
+_subscription_cache = OrderedDict()
+# Срок жизни записи: подписку кэшируем дольше, отсутствие подписки - коротко (для быстрого обновления)
+_cache_timeout = {True: SUBSCRIPTION_CACHE_TTL_SECONDS, False: SUBSCRIPTION_NEGATIVE_TTL_SECONDS}
+# Запросы get_chat_member в полете: параллельные проверки одного пользователя ждут один и тот же запрос
+_subscription_inflight = {}
+# Предохранитель запросов get_chat_member: пока он разомкнут, статус берется из кэша и таблицы
+membership_breaker = CircuitBreaker(
+    'membership', window=SUBSCRIPTION_BREAKER_WINDOW_SECONDS, min_calls=SUBSCRIPTION_BREAKER_MIN_CALLS,
+    failure_rate=SUBSCRIPTION_BREAKER_FAILURE_RATE, open_seconds=SUBSCRIPTION_BREAKER_OPEN_SECONDS
+)
+# Таблица участников канала (async_db), которую пополняют обновления chat_member; None - не подключена
+_membership_store = None
+
+def set_membership_store(store):
+    """Подключение хранилища участников канала с get_channel_member/record_channel_member"""
+    global _membership_store
+    _membership_store = store
 
 def make_chat_url(raw: str) -> str:
     """Нормализация URL чата"""
@@ -26,38 +54,145 @@ def reset_broadcast_state(context):
     for key in ['broadcast_stage', 'broadcast_mode', 'broadcast_text', 'broadcast_photo']:
         context.user_data.pop(key, None)
 
+def _cache_key(user_id: int) -> str:
+    return f"{user_id}_{CHANNEL_ID}"
+
+def _cached_subscription(key: str, allow_stale: bool = False):
+    """Статус из кэша или None, если записи нет или она устарела.
+
+    Устаревшие записи не удаляются (их вытесняет ограничение размера):
+    пока предохранитель разомкнут, они служат последним известным статусом.
+    """
+    entry = _subscription_cache.get(key)
+    if entry is None or (entry[1] <= time.monotonic() and not allow_stale):
+        return None
+    return entry[0]
+
+def _store_subscription(key: str, is_member: bool):
+    """Запись статуса в кэш; при переполнении вытесняются самые старые записи"""
+    _subscription_cache[key] = (is_member, time.monotonic() + _cache_timeout[is_member])
+    _subscription_cache.move_to_end(key)
+    while len(_subscription_cache) > SUBSCRIPTION_CACHE_MAX:
+        _subscription_cache.popitem(last=False)
+
+async def _fetch_subscription(bot, user_id: int) -> str:
+    """Запрос статуса в Telegram и сохранение результата в кэш (ошибки не кэшируются)"""
+    try:
+        member = await asyncio.wait_for(
+            bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id), SUBSCRIPTION_CHECK_TIMEOUT_SECONDS
+        )
+    except (NetworkError, RetryAfter):
+        membership_breaker.record(False)
+        raise
+    except TelegramError:
+        # API ответил (например, Bad Request) - со связью все в порядке
+        membership_breaker.record(True)
+        raise
+    except BaseException:
+        # Таймаут, отмена и прочие сбои
+        membership_breaker.record(False)
+        raise
+    membership_breaker.record(True)
+    is_member = member.status in MEMBER_STATUSES
+    _store_subscription(_cache_key(user_id), is_member)
+    if _membership_store is not None:
+        try:
+            await _membership_store.record_channel_member(user_id, member.status)
+        except Exception as e:
+            logger.warning(f"Failed to record channel member {user_id}: {e}")
+    return member.status
+
+async def _stored_subscription(user_id: int, max_age=CHANNEL_MEMBER_FRESH_SECONDS):
+    """Статус из таблицы участников канала или None, если он неизвестен или старше max_age (None - любой)"""
+    if _membership_store is None:
+        return None
+    member = await _membership_store.get_channel_member(user_id)
+    if member is None or (max_age is not None and to_epoch() - member[3] > max_age):
+        return None
+    return member[0] in MEMBER_STATUSES
+
+async def _last_known_subscription(user_id: int, default: bool) -> bool:
+    """Последний известный статус (кэш, затем таблица, любой давности) без запроса к API"""
+    known = _cached_subscription(_cache_key(user_id), allow_stale=True)
+    if known is None:
+        try:
+            known = await _stored_subscription(user_id, max_age=None)
+        except Exception as e:
+            logger.warning(f"Failed to read channel member {user_id}: {e}")
+    return default if known is None else known
+
+async def _fetch_member_status(bot, user_id: int, join: bool):
+    """Статус из API через предохранитель и общий запрос в полете; None, если предохранитель разомкнут"""
+    key = _cache_key(user_id)
+    inflight = _subscription_inflight.get(key)
+    # Принудительная проверка не присоединяется к запросу, начатому до нее
+    if inflight is None or not join:
+        if not membership_breaker.allow():
+            return None
+        inflight = asyncio.ensure_future(_fetch_subscription(bot, user_id))
+        _subscription_inflight[key] = inflight
+
+        def forget(done):
+            if _subscription_inflight.get(key) is done:
+                del _subscription_inflight[key]
+
+        inflight.add_done_callback(forget)
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(inflight)
+
+async def _check_subscription(bot, user_id: int, use_cache: bool) -> bool:
+    """Проверка через кэш и общий запрос в полете"""
+    if use_cache:
+        cached = _cached_subscription(_cache_key(user_id))
+        if cached is None:
+            cached = await _stored_subscription(user_id)
+        if cached is not None:
+            return cached
+
+    status = await _fetch_member_status(bot, user_id, join=use_cache)
+    if status is None:
+        # Деградированный режим: API не дергаем, отвечаем последним известным статусом
+        return await _last_known_subscription(user_id, SUBSCRIPTION_DEGRADED_ALLOW_UNKNOWN)
+    return status in MEMBER_STATUSES
+
+def cached_subscription(user_id: int):
+    """Свежий статус подписки из кэша или None"""
+    return _cached_subscription(_cache_key(user_id))
+
+async def fetch_member_status(bot, user_id: int):
+    """Статус участника канала из API для массовых проверок.
+
+    Идет через тот же предохранитель и общий запрос в полете, что и проверка
+    подписки, результат обновляет кэш. None, если предохранитель разомкнут;
+    ошибки API (в том числе RetryAfter) поднимаются вызывающему.
+    """
+    return await _fetch_member_status(bot, user_id, join=True)
+
 async def is_user_subscribed(bot, user_id: int) -> bool:
-    """Проверка подписки пользователя на канал - МГНОВЕННАЯ"""
+    """Проверка подписки пользователя на канал с кэшем"""
     try:
-        # Мгновенная проверка статуса пользователя в канале
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return member.status in ('member', 'creator', 'administrator')
-        
+        return await _check_subscription(bot, user_id, use_cache=True)
     except Exception as e:
         logger.error(f"Subscription check failed for user {user_id}: {e}")
-        return False
+        return await _last_known_subscription(user_id, False)
 
 async def force_check_subscription(bot, user_id: int) -> bool:
-    """Принудительная проверка подписки без использования кэша - МГНОВЕННАЯ"""
+    """Принудительная проверка подписки мимо кэша; результат обновляет кэш"""
     try:
-        # Мгновенная проверка статуса пользователя в канале
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return member.status in ('member', 'creator', 'administrator')
-        
+        return await _check_subscription(bot, user_id, use_cache=False)
     except Exception as e:
         logger.error(f"Force subscription check failed for user {user_id}: {e}")
-        return False
+        return await _last_known_subscription(user_id, False)
 
 def clear_subscription_cache(user_id: int = None):
     """Очистка кэша подписки"""
-    global _subscription_cache
     if user_id is None:
         # Очищаем весь кэш
         _subscription_cache.clear()
         logger.info("Subscription cache cleared")
     else:
         # Очищаем кэш для конкретного пользователя
-        cache_key = f"{user_id}_{CHANNEL_ID}"
+        cache_key = _cache_key(user_id)
         if cache_key in _subscription_cache:
             del _subscription_cache[cache_key]
             logger.info(f"Subscription cache cleared for user {user_id}")
@@ -70,6 +205,7 @@ async def debug_subscription(bot, user_id: int) -> dict:
         'bot_can_access_channel': False,
         'channel_info': None,
         'user_status': None,
+        'circuit': membership_breaker.state,
         'error': None
     }
     
@@ -88,7 +224,7 @@ async def debug_subscription(bot, user_id: int) -> dict:
         member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
         debug_info['user_status'] = {
             'status': member.status,
-            'is_member': member.status in ('member', 'creator', 'administrator'),
+            'is_member': member.status in MEMBER_STATUSES,
             'until_date': getattr(member, 'until_date', None),
             'is_member_status': member.status == 'member',
             'is_creator_status': member.status == 'creator',
@@ -136,6 +272,19 @@ def format_task_text(template_text: str, promo_code: str) -> str:
         "🎁 И получи свой <b>ПОДАРОК</b>"
     )
 
+# Текст задания на репост (одинаковый для всех, в tasks не хранится)
+REPOST_TASK_TEXT = "Пожалуйста, сделайте репост нашего канала @ambsharing в одном из чатов ниже:"
+
+def render_task_description(template_kind, promo_code, template_text=None, stored=None) -> str:
+    """Текст задания по ссылке на шаблон (то, что видел пользователь)"""
+    if template_kind == 'meme':
+        return format_task_panel(promo_code)
+    if template_kind == 'text' and template_text is not None:
+        return format_task_text(template_text, promo_code)
+    if template_kind == 'repost':
+        return REPOST_TASK_TEXT
+    return stored or ""
+
 def get_welcome_caption() -> str:
     """Получение текста приветствия"""
     return (
@@ -223,12 +372,24 @@ def parse_start_parameter(text: str) -> int:
         except ValueError:
             return None
 
+def to_epoch(moment=None):
+    """datetime (по умолчанию текущее время) -> секунды Unix"""
+    return int((moment or datetime.now()).timestamp())
+
+def day_bucket(ts):
+    """Начало локальных суток, в которые попадает ts (секунды Unix)"""
+    day = datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(day.timestamp())
+
+def week_bucket(ts):
+    """Начало недели (понедельник 00:00), в которую попадает ts (секунды Unix)"""
+    day = datetime.fromtimestamp(day_bucket(ts))
+    return int((day - timedelta(days=day.weekday())).timestamp())
+
 def get_date_range():
-    """Получение диапазона дат для статистики"""
-    now = datetime.now()
-    today_start = datetime(now.year, now.month, now.day)
-    week_start = today_start - timedelta(days=now.weekday())
-    return today_start, week_start
+    """Начало сегодняшнего дня и текущей недели в секундах Unix для статистики"""
+    now = to_epoch()
+    return day_bucket(now), week_bucket(now)
 
 # Добавляем недостающие константы для совместимости
 BROADCAST_STAGE_TEXT = 'await_text'
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Разовый перевод базы на auto_vacuum=INCREMENTAL
+
+Использование: python vacuum_db.py [путь к базе, по умолчанию DB_PATH]
+
+Полный VACUUM переписывает весь файл: бот на это время нужно остановить,
+а на диске нужно свободное место размером с базу.
+"""
+
+import sqlite3
+import sys
+import time
+from config import DB_PATH
+from migrations import enable_incremental_vacuum
+
+def main():
+    if len(sys.argv) > 2:
+        print(__doc__.strip())
+        sys.exit(1)
+
+    path = sys.argv[1] if len(sys.argv) == 2 else DB_PATH
+    print("Бот должен быть остановлен на время VACUUM")
+    started = time.monotonic()
+    conn = sqlite3.connect(path)
+    try:
+        changed = enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+    if changed:
+        print(f"Готово за {time.monotonic() - started:.2f} с")
+    else:
+        print("База уже в режиме auto_vacuum=INCREMENTAL")
+
+if __name__ == "__main__":
+    main()